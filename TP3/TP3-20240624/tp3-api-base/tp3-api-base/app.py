@@ -1,6 +1,23 @@
-from flask import Flask, request, jsonify, g
-from models import Database
+from flask import Flask, Response, request, jsonify, g, url_for
+from models import Database, PoolTimeout, Rows, ShardedDatabase
+from formats import COMPRESSIBLE, compress, compress_chunks
+from cache import TTLCache
+from notify import NotificationHub, Wait
+from tokens import RevocationList, TokenSigner
+from limits import AdmissionController, RateLimiter, parse_budgets
+from metrics import Collector, Counter, DatabaseObserver, Gauge, Histogram, Registry
 from datetime import datetime, timezone
+import hashlib
+import hmac
+import io
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode
 
 # ==========
 #  Settings
@@ -9,14 +26,728 @@ from datetime import datetime, timezone
 app = Flask(__name__)
 app.config['STATIC_URL_PATH'] = '/static'
 app.config['DEBUG'] = True
+app.config['DATABASE'] = os.environ.get('TASKLISTS_DATABASE', ':memory:')
+app.config['DATABASE_SHARDS'] = int(os.environ.get('TASKLISTS_SHARDS', 0))
+app.config['DATABASE_POOL_SIZE'] = int(os.environ.get('TASKLISTS_POOL_SIZE', 0))
+app.config['DATABASE_BUSY_TIMEOUT'] = int(os.environ.get('TASKLISTS_BUSY_TIMEOUT', 5000))
+app.config['DATABASE_SYNCHRONOUS'] = os.environ.get('TASKLISTS_SYNCHRONOUS', 'NORMAL')
+app.config['DATABASE_CACHE_SIZE'] = int(os.environ.get('TASKLISTS_CACHE_SIZE', -2000))
+app.config['DATABASE_GROUP_COMMIT'] = os.environ.get('TASKLISTS_GROUP_COMMIT') == '1'
+app.config['DATABASE_COMMIT_BATCH_SIZE'] = int(os.environ.get('TASKLISTS_COMMIT_BATCH_SIZE', 64))
+app.config['DATABASE_COMMIT_MAX_WAIT'] = float(os.environ.get('TASKLISTS_COMMIT_MAX_WAIT', 0.002))
+app.config['DATABASE_WAIT_FOR_COMMIT'] = os.environ.get('TASKLISTS_WAIT_FOR_COMMIT', '1') == '1'
+app.config['PAGE_SIZE'] = 100
+app.config['MAX_PAGE_SIZE'] = 1000
+app.config['STREAM_CHUNK_SIZE'] = 500
+app.config['MAX_BATCH_SIZE'] = 1000
+app.config['AUTH_CACHE_SIZE'] = 4096
+app.config['AUTH_CACHE_TTL'] = 60.0
+# Without a configured secret, tokens are only valid in this process
+app.config['TOKEN_SECRET'] = os.environ.get('TASKLISTS_TOKEN_SECRET') or os.urandom(32)
+app.config['TOKEN_TTL'] = float(os.environ.get('TASKLISTS_TOKEN_TTL', 900))
+app.config['RESPONSE_CACHE_SIZE'] = 10000
+app.config['RESPONSE_CACHE_TTL'] = 30.0
+app.config['MESSAGE_POLL_TIMEOUT'] = 30.0
+app.config['MAX_MESSAGE_POLL_TIMEOUT'] = 60.0
+app.config['MESSAGE_STREAM_TIMEOUT'] = 300.0
+app.config['MESSAGE_KEEPALIVE'] = 15.0
+app.config['MAX_SEARCH_OFFSET'] = 10000
+app.config['IMPORT_BATCH_SIZE'] = 500
+# Tombstones of deleted rows are kept in the change log for SYNC_RETENTION
+# seconds; compaction runs at most every SYNC_COMPACT_INTERVAL seconds
+app.config['SYNC_RETENTION'] = float(os.environ.get('TASKLISTS_SYNC_RETENTION', 30 * 86400))
+app.config['SYNC_COMPACT_INTERVAL'] = float(os.environ.get('TASKLISTS_SYNC_COMPACT_INTERVAL', 3600))
+app.config['MAX_IMPORT_RECORD_SIZE'] = 1024 * 1024
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('TASKLISTS_COMPRESS_MIN_SIZE', 1024))
+app.config['COMPRESS_LEVEL'] = int(os.environ.get('TASKLISTS_COMPRESS_LEVEL', 6))
+# Token buckets of each client, as (requests per second, burst), by
+# endpoint; the other endpoints share the 'default' budget
+app.config['RATE_LIMIT_ENABLED'] = os.environ.get('TASKLISTS_RATE_LIMIT', '1') == '1'
+app.config['RATE_LIMITS'] = {'default': (50.0, 100), 'project_list': (20.0, 50),
+                             'message_list': (20.0, 50), 'workspace_export': (1.0, 5),
+                             'workspace_import': (1.0, 5),
+                             **parse_budgets(os.environ.get('TASKLISTS_RATE_LIMITS', ''))}
+# Requests are shed with 503 beyond these, unless 0
+app.config['MAX_IN_FLIGHT'] = int(os.environ.get('TASKLISTS_MAX_IN_FLIGHT', 128))
+app.config['MAX_DB_WAIT_MS'] = float(os.environ.get('TASKLISTS_MAX_DB_WAIT_MS', 250))
+app.config['SLOW_QUERY_MS'] = (float(os.environ['TASKLISTS_SLOW_QUERY_MS'])
+                               if os.environ.get('TASKLISTS_SLOW_QUERY_MS') else None)
+
+# =========
+#  Metrics
+# =========
+
+metrics = Registry()
+db_observer = DatabaseObserver(
+    metrics, slow_query_seconds=(app.config['SLOW_QUERY_MS'] / 1000
+                                 if app.config['SLOW_QUERY_MS'] is not None else None))
+request_duration = metrics.register(Histogram(
+    'tasklists_http_request_duration_seconds', 'Time spent handling HTTP requests.',
+    ('route', 'method')))
+requests_total = metrics.register(Counter(
+    'tasklists_http_requests_total', 'HTTP requests handled.', ('route', 'method', 'status')))
+requests_in_flight = metrics.register(Gauge(
+    'tasklists_http_requests_in_flight', 'HTTP requests being handled.'))
+
+@app.before_request
+def start_timer():
+    """Starts timing the request."""
+    g.start_time = time.perf_counter()
+    requests_in_flight.inc()
+
+@app.after_request
+def record_request(response):
+    """Records the latency and status of the request."""
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    request_duration.observe((route, request.method), time.perf_counter() - g.start_time)
+    requests_total.inc((route, request.method, str(response.status_code)))
+    return response
+
+@app.teardown_request
+def finish_request(exc):
+    """Stops counting the request as in flight."""
+    if 'start_time' in g:
+        requests_in_flight.dec()
+
+# ========
+#  Limits
+# ========
+
+# Endpoints that are never limited, so that an overloaded server can be observed
+UNLIMITED_ENDPOINTS = ('metrics_view',)
+# Endpoints that mostly wait for messages, and are not counted as in flight
+WAITING_ENDPOINTS = ('message_poll', 'message_events')
+
+rate_limiter = RateLimiter(app.config['RATE_LIMITS'])
+admission = AdmissionController(max_in_flight=app.config['MAX_IN_FLIGHT'],
+                                max_wait=app.config['MAX_DB_WAIT_MS'] / 1000)
+db_observer.on_wait = admission.observe_wait
+requests_rejected = metrics.register(Counter(
+    'tasklists_http_requests_rejected_total', 'HTTP requests rejected by the limits.',
+    ('reason',)))
+
+@app.before_request
+def admit_request():
+    """Sheds the request before any work while the server is overloaded."""
+    if request.endpoint in UNLIMITED_ENDPOINTS:
+        return None
+    counted = request.endpoint not in WAITING_ENDPOINTS
+    if not admission.enter(counted):
+        requests_rejected.inc(('overload',))
+        res = jsonify({'error': 'Server overloaded'})
+        res.headers['Retry-After'] = '1'
+        return res, 503
+    g.admitted = counted
+
+@app.after_request
+def count_streamed_body(response):
+    """Keeps a streamed response counted in flight until its body is sent."""
+    if response.is_streamed and g.pop('admitted', False):
+        response.call_on_close(admission.leave)
+    return response
+
+@app.teardown_request
+def leave_request(exc):
+    """Stops counting the request against the admission limit."""
+    if g.pop('admitted', False):
+        admission.leave()
+
+def limit_rate():
+    """
+    Takes a token from the budget of the request's endpoint for its user,
+    or its address if unauthenticated. Returns 429 if none is left.
+    """
+    if not app.config['RATE_LIMIT_ENABLED'] or request.endpoint in UNLIMITED_ENDPOINTS:
+        return None
+    budget = request.endpoint if request.endpoint in rate_limiter.budgets else 'default'
+    client = ('user', g.user['id']) if g.user else ('address', request.remote_addr)
+    wait = rate_limiter.acquire(client, budget)
+    if wait:
+        requests_rejected.inc(('rate_limit',))
+        res = jsonify({'error': 'Too many requests'})
+        res.headers['Retry-After'] = str(math.ceil(wait))
+        return res, 429
+    return None
+
+@app.errorhandler(PoolTimeout)
+def pool_exhausted(exc):
+    """Answers 503 when no pooled database connection frees up in time."""
+    requests_rejected.inc(('pool',))
+    res = jsonify({'error': 'Database busy'})
+    res.headers['Retry-After'] = '1'
+    return res, 503
 
 # ==========
 #  Database
 # ==========
 
-# Creates an sqlite database in memory
-db = Database(filename=':memory:', schema='schema.sql')
-db.recreate()
+# Creates an sqlite database in memory, unless a database file is configured.
+# File databases keep their data across restarts and can be pooled.
+# With shards, users are spread over that many databases (see
+# ShardedDatabase); the catalog of users is kept in its own database.
+db_options = dict(pool_size=app.config['DATABASE_POOL_SIZE'],
+                  busy_timeout=app.config['DATABASE_BUSY_TIMEOUT'],
+                  synchronous=app.config['DATABASE_SYNCHRONOUS'],
+                  cache_size=app.config['DATABASE_CACHE_SIZE'],
+                  group_commit=app.config['DATABASE_GROUP_COMMIT'],
+                  commit_batch_size=app.config['DATABASE_COMMIT_BATCH_SIZE'],
+                  commit_max_wait=app.config['DATABASE_COMMIT_MAX_WAIT'],
+                  wait_for_commit=app.config['DATABASE_WAIT_FOR_COMMIT'],
+                  observer=db_observer)
+if app.config['DATABASE_SHARDS']:
+    db = ShardedDatabase(filename=app.config['DATABASE'], schema='schema.sql',
+                         shards=app.config['DATABASE_SHARDS'], **db_options)
+else:
+    db = Database(filename=app.config['DATABASE'], schema='schema.sql', **db_options)
+if db.in_memory:
+    db.recreate()
+else:
+    db.ensure_schema()
+
+@app.teardown_appcontext
+def release_connection(exc):
+    """Returns the request's pooled connections and unroutes its shard."""
+    db.release()
+    db.route(None)
+
+# ========
+#  Caches
+# ========
+
+# Verified credentials, keyed by (username, password digest). Failed
+# logins are not cached, so that junk credentials cannot evict valid ones.
+auth_cache = TTLCache(maxsize=app.config['AUTH_CACHE_SIZE'],
+                      ttl=app.config['AUTH_CACHE_TTL'])
+
+def invalidate_credentials(*usernames):
+    """Drops cached credentials for the given usernames."""
+    auth_cache.invalidate_where(lambda key: key[0] in usernames)
+
+token_signer = TokenSigner(app.config['TOKEN_SECRET'], ttl=app.config['TOKEN_TTL'])
+
+# Token revocations, reloaded as often as cached credentials expire
+token_revocations = RevocationList(lambda since: [
+    (row['user_id'], row['revoked_at']) for row in db.catalog.execute_query(
+        'SELECT user_id, revoked_at FROM token_revocation WHERE revoked_at>?', (since,))],
+    ttl=app.config['AUTH_CACHE_TTL'])
+
+def revoke_tokens(user_id):
+    """Rejects every bearer token issued so far to a user."""
+    revoked_at = token_signer.now()
+    db.catalog.execute_update(
+        'INSERT INTO token_revocation (user_id, revoked_at) VALUES (?, ?) '
+        'ON CONFLICT(user_id) DO UPDATE SET revoked_at=excluded.revoked_at',
+        (user_id, revoked_at))
+    token_revocations.revoke(user_id, revoked_at)
+
+# Projects and tasks read by the views, keyed by (kind, user id, ...).
+# Writes in this process invalidate the affected entries; writes from
+# other processes are picked up after the TTL. Version stamps are not
+# cached, so that ETags change as soon as any process writes.
+response_cache = TTLCache(maxsize=app.config['RESPONSE_CACHE_SIZE'],
+                          ttl=app.config['RESPONSE_CACHE_TTL'])
+
+def cache_collector(field, kind):
+    """Reports one of the counters of the in-process caches."""
+    caches = (('auth', auth_cache), ('response', response_cache))
+    return Collector(
+        f'tasklists_cache_{field}' + ('_total' if kind == 'counter' else ''),
+        f'In-process cache {field}.', kind, ('cache',),
+        lambda: [((name,), cache.stats()[field]) for name, cache in caches])
+
+for field, kind in (('hits', 'counter'), ('misses', 'counter'),
+                    ('evictions', 'counter'), ('size', 'gauge')):
+    metrics.register(cache_collector(field, kind))
+
+def read_through(key, load, version=None):
+    """
+    Returns the cached value for key, loading and caching it on a miss.
+    A value loaded before a write invalidated key is returned, not cached.
+    With a version (e.g. the version stamp behind the request's ETag), a
+    value cached under another version is loaded again, as another
+    process may have changed it.
+    """
+    cached = response_cache.get(key)
+    if cached is not None and (version is None or cached[0] == version):
+        return cached[1]
+    generation = response_cache.generation()
+    value = load()
+    if value is not None:
+        response_cache.set(key, (version, value), generation)
+    return value
+
+def get_project(pk, version=None):
+    """Returns a project of the current user, or None."""
+    return read_through(('project', g.user['id'], pk), lambda: db.execute_query(
+        'SELECT * FROM project WHERE id=? AND user_id=?', (pk, g.user['id'])).fetchone(),
+        version)
+
+def get_task(project_id, task_id):
+    """Returns a task of a project of the current user, or None."""
+    return read_through(('task', g.user['id'], project_id, task_id), lambda: db.execute_query(
+        'SELECT * FROM task WHERE id=? AND project_id=?', (task_id, project_id)).fetchone())
+
+def invalidate_project(pk, tasks=False):
+    """Drops a project of the current user from the cache."""
+    user_id = g.user['id']
+    response_cache.invalidate(('project', user_id, pk))
+    if tasks:
+        response_cache.invalidate_where(
+            lambda key: key[0] == 'task' and key[1] == user_id and key[2] == pk)
+
+def invalidate_tasks(project_id, *task_ids):
+    """Drops tasks of a project of the current user from the cache."""
+    user_id = g.user['id']
+    for task_id in task_ids:
+        response_cache.invalidate(('task', user_id, project_id, task_id))
+
+def invalidate_workspace(user_id):
+    """Drops every cached project and task of a user."""
+    response_cache.invalidate_where(lambda key: key[1] == user_id)
+
+# ===============
+#  Notifications
+# ===============
+
+# Wakes the readers of /api/messages/poll/ and /api/messages/events/ when
+# this process sends them a message. Readers in other processes find it
+# when their wait times out and they query once more, or earlier if the
+# seeded message id expires while they wait.
+message_hub = NotificationHub(ttl=app.config['RESPONSE_CACHE_TTL'])
+
+metrics.register(Collector(
+    'tasklists_message_waiting', 'Readers waiting for new messages.', 'gauge', (),
+    lambda: [((), message_hub.stats()['waiting'])]))
+
+def newest_message(receiver_id):
+    """Returns the newest message id of a receiver (0 if none) and its hub generation."""
+    latest, generation = message_hub.state(receiver_id)
+    if latest is None:
+        latest = db.for_user(receiver_id).execute_query(
+            'SELECT MAX(id) AS id FROM message WHERE receiver_id=?',
+            (receiver_id,)).fetchone()['id'] or 0
+        message_hub.seed(receiver_id, latest)
+    return latest, generation
+
+def message_waits(receiver_id, after, timeout, limit, columns='*'):
+    """
+    Returns up to limit messages of a receiver with ids above after,
+    waiting up to timeout seconds for one to be sent, or None if none is.
+    This is a generator that yields a hub Wait whenever it has to wait, and
+    returns the messages once the caller has waited them all; callers may
+    send back the result of each wait, or resume it with None to check
+    again. While waiting, the messages are only queried when the hub knows
+    of a newer one, then once more when the wait times out.
+    """
+    stmt = f'SELECT {columns} FROM message WHERE receiver_id=? AND id>? ORDER BY id LIMIT ?'
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            latest, generation = newest_message(receiver_id)
+            if latest > after:
+                rows = db.for_user(receiver_id).fetch_rows(stmt, (receiver_id, after, limit))
+                if rows:
+                    return rows
+            # Waits without holding a pooled connection
+            db.release()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or (yield Wait(message_hub, receiver_id, generation, remaining)) is False:
+                break
+        # Messages sent through other processes do not wake the hub
+        return db.for_user(receiver_id).fetch_rows(stmt, (receiver_id, after, limit)) or None
+    finally:
+        db.release()
+
+def wait_for_messages(receiver_id, after, timeout, limit, columns='*'):
+    """Runs message_waits, blocking the calling thread on each of its waits."""
+    waits = message_waits(receiver_id, after, timeout, limit, columns)
+    try:
+        wait = next(waits)
+        while True:
+            wait = waits.send(wait())
+    except StopIteration as done:
+        return done.value
+
+# ============
+#  Workspaces
+# ============
+
+def export_workspace(database, user_id, chunk_size):
+    """
+    Yields the projects of a user, each followed by its tasks, then the
+    messages they received, as NDJSON records with a 'type' field. Rows
+    are read from cursors chunk by chunk, on a single connection that is
+    not bound to a thread.
+    """
+    with database.checkout() as conn:
+        for projects in database.iter_query(
+                "SELECT 'project' AS type, id, title, creation_date, last_updated "
+                'FROM project WHERE user_id=? ORDER BY id', (user_id,), chunk_size, conn):
+            for idx in range(len(projects)):
+                yield projects[idx:idx + 1].to_ndjson()
+                for tasks in database.iter_query(
+                        "SELECT 'task' AS type, id, project_id, title, creation_date, completed "
+                        'FROM task WHERE project_id=? ORDER BY id',
+                        (projects.value(idx, 'id'),), chunk_size, conn):
+                    yield tasks.to_ndjson()
+        for messages in database.iter_query(
+                "SELECT 'message' AS type, id, sender_id, content, timestamp "
+                'FROM message WHERE receiver_id=? ORDER BY id', (user_id,), chunk_size, conn):
+            yield messages.to_ndjson()
+
+def valid_completed(value):
+    """Whether value is a valid completed flag (0, 1 or a boolean), or None."""
+    return value is None or isinstance(value, int) and value in (0, 1)
+
+# Id, text and optional date fields of each type of exported record
+RECORD_FIELDS = {
+    'project': ('id', 'title', ('creation_date', 'last_updated')),
+    'task': ('project_id', 'title', ('creation_date',)),
+    'message': ('sender_id', 'content', ('timestamp',)),
+}
+
+def parse_record(line):
+    """Returns the exported record of an NDJSON line, or raises ValueError."""
+    record = json.loads(line)
+    if not isinstance(record, dict) or record.get('type') not in RECORD_FIELDS:
+        raise ValueError('Invalid record type')
+    # Checks the types of the values bound by import_batch, so that an
+    # invalid record is reported with its line instead of failing the batch
+    id_field, text_field, date_fields = RECORD_FIELDS[record['type']]
+    if (not isinstance(record.get(id_field), int) or isinstance(record[id_field], bool)
+            or not isinstance(record.get(text_field), str) or not record[text_field]
+            or any(not isinstance(record.get(field), (str, type(None))) for field in date_fields)
+            or not valid_completed(record.get('completed'))):
+        raise ValueError(f"Invalid {record['type']}")
+    return record
+
+def import_batch(database, user_id, records, projects):
+    """
+    Inserts records for a user in one transaction. projects maps the ids
+    that projects had in the export to their new ids; it is updated with
+    the projects inserted, and used for the project ids of tasks.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    message_id = None
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        for record in records:
+            if record['type'] == 'project':
+                cursor.execute(
+                    'INSERT INTO project (user_id, title, creation_date, last_updated) '
+                    'VALUES (?, ?, ?, ?)', (user_id, record['title'],
+                                            record.get('creation_date') or now,
+                                            record.get('last_updated') or now))
+                projects[record['id']] = cursor.lastrowid
+            elif record['type'] == 'task':
+                cursor.execute(
+                    'INSERT INTO task (project_id, title, creation_date, completed) '
+                    'VALUES (?, ?, ?, ?)', (projects[record['project_id']], record['title'],
+                                            record.get('creation_date') or now,
+                                            record.get('completed') or 0))
+            else:
+                # Sent by the user to themselves: the record's sender_id is not
+                # trusted, as the message would be shown to that user
+                cursor.execute(
+                    'INSERT INTO message (sender_id, receiver_id, content, timestamp) '
+                    'VALUES (?, ?, ?, ?)', (user_id, user_id, record['content'],
+                                            record.get('timestamp') or now))
+                message_id = cursor.lastrowid
+        cursor.close()
+    if message_id is not None:
+        message_hub.publish(user_id, message_id)
+
+# ======
+#  Sync
+# ======
+
+# Current rows of each kind of change, as the records of export_workspace
+SYNC_QUERIES = {
+    'project': "SELECT 'project' AS type, id, title, creation_date, last_updated "
+               'FROM project WHERE user_id=? AND id IN (SELECT value FROM json_each(?))',
+    'task': "SELECT 'task' AS type, task.id, task.project_id, task.title, task.creation_date, "
+            'task.completed FROM task JOIN project ON project.id = task.project_id '
+            'WHERE project.user_id=? AND task.id IN (SELECT value FROM json_each(?))',
+    'message': "SELECT 'message' AS type, id, sender_id, content, timestamp "
+               'FROM message WHERE receiver_id=? AND id IN (SELECT value FROM json_each(?))',
+}
+
+def read_changes(database, user_id, since, limit):
+    """
+    Returns up to limit changes of a user after seq since, in seq order:
+    the current record of each row changed, with its 'seq', or
+    {'seq', 'type', 'id', 'deleted': True} for a deleted row. Tombstones
+    are left out when since is 0, as the client has nothing to delete.
+    """
+    with database.connection():
+        changes = database.fetch_rows(
+            'SELECT seq, kind, row_id, deleted FROM change_log WHERE user_id=? AND seq>? '
+            + ('' if since else 'AND NOT deleted ') + 'ORDER BY seq LIMIT ?',
+            (user_id, since, limit))
+        row_ids = {}
+        for change in changes:
+            if not change['deleted']:
+                row_ids.setdefault(change['kind'], []).append(change['row_id'])
+        current = {}
+        for kind, ids in row_ids.items():
+            for record in database.fetch_rows(SYNC_QUERIES[kind], (user_id, json.dumps(ids))):
+                current[kind, record['id']] = record
+    records = []
+    for change in changes:
+        record = current.get((change['kind'], change['row_id']))
+        if record is None:
+            # Also covers rows deleted after the change log was read
+            records.append({'seq': change['seq'], 'type': change['kind'],
+                            'id': change['row_id'], 'deleted': True})
+        else:
+            records.append({'seq': change['seq'], **record})
+    return records
+
+def compact_changes(database, before):
+    """
+    Drops the tombstones of rows deleted before the unix time before, and
+    raises the horizon of their users to the highest seq dropped. Returns
+    the number of tombstones dropped.
+    """
+    with database.transaction() as conn:
+        # Without the index, SQLite walks every entry in user order to group them
+        conn.execute('INSERT INTO change_horizon (user_id, seq) '
+                     'SELECT user_id, max(seq) FROM change_log INDEXED BY change_log_tombstone '
+                     'WHERE deleted AND changed_at<? GROUP BY user_id '
+                     'ON CONFLICT(user_id) DO UPDATE SET seq = max(seq, excluded.seq)', (before,))
+        return conn.execute('DELETE FROM change_log WHERE deleted AND changed_at<?',
+                            (before,)).rowcount
+
+# Next time at which the change log of each database is compacted
+next_compaction = {}
+compaction_lock = threading.Lock()
+
+@app.after_request
+def compact_after_write(response):
+    """
+    Compacts the change log of the user's database after a successful
+    write, at most once every SYNC_COMPACT_INTERVAL seconds. The write is
+    already committed, so a failed compaction is logged and left to the
+    next interval rather than failing the response.
+    """
+    if (request.method in ('GET', 'HEAD', 'OPTIONS') or response.status_code >= 400
+            or not g.get('user')):
+        return response
+    database = db.for_user(g.user['id'])
+    now = time.time()
+    if now >= next_compaction.get(database, 0) and compaction_lock.acquire(blocking=False):
+        try:
+            next_compaction[database] = now + app.config['SYNC_COMPACT_INTERVAL']
+            compact_changes(database, int(now - app.config['SYNC_RETENTION']))
+        except Exception:
+            app.logger.exception('Compacting the change log failed')
+        finally:
+            compaction_lock.release()
+    return response
+
+# =============
+#  Collections
+# =============
+
+# Task counts of projects, maintained by triggers in schema.sql
+SUMMARY_COLUMNS = ('project_summary.task_count, project_summary.completed_count, '
+                   'CAST(project_summary.completed_count AS REAL) '
+                   '/ NULLIF(project_summary.task_count, 0) AS completion_ratio')
+SUMMARY_FROM = 'FROM project JOIN project_summary ON project_summary.project_id = project.id'
+
+# Columns that the 'fields' parameter can select, by table
+FIELDS = {
+    'project': ('id', 'user_id', 'title', 'creation_date', 'last_updated'),
+    'task': ('id', 'project_id', 'title', 'creation_date', 'completed'),
+    'message': ('id', 'sender_id', 'receiver_id', 'content', 'timestamp'),
+}
+
+def requested_fields(table):
+    """
+    Returns the columns of table named by the comma separated 'fields'
+    query parameter, always starting with id, or None if it is not given.
+    Raises ValueError for columns that are not in FIELDS.
+    """
+    fields = request.args.get('fields')
+    if fields is None:
+        return None
+    names = [name.strip() for name in fields.split(',')]
+    if not all(name in FIELDS[table] for name in names):
+        raise ValueError('Invalid fields')
+    return ('id',) + tuple(dict.fromkeys(name for name in names if name != 'id'))
+
+def select_list(table, fields):
+    """Returns the SELECT list of fields of table (every column if fields is None)."""
+    if fields is None:
+        return '*'
+    return ', '.join(f'{table}.{name}' for name in fields)
+
+def project_row(row, fields):
+    """Returns the given fields of a row (all of them if fields is None)."""
+    if fields is None:
+        return row
+    return {name: row[name] for name in fields}
+
+# Encodings of rows by media type, JSON first as the default
+ROW_FORMATS = {
+    'application/json': Rows.to_json,
+    'application/vnd.tasklists.columns+json': Rows.to_columns_json,
+    'application/msgpack': Rows.to_msgpack,
+    'application/x-msgpack': Rows.to_msgpack,
+}
+
+def rows_response(rows):
+    """
+    Returns rows in the format preferred by the 'Accept' header: JSON
+    objects, JSON columns (the column names once, then each row as an
+    array) or MessagePack.
+    """
+    mimetype = request.accept_mimetypes.best_match(ROW_FORMATS, default='application/json')
+    res = Response(ROW_FORMATS[mimetype](rows), mimetype=mimetype)
+    res.vary.add('Accept')
+    return res
+
+def next_link(params):
+    """
+    Returns the Link header of the next page: the request's path with the
+    given query parameters, which cannot clash with the route arguments.
+    """
+    return f'<{request.script_root}{request.path}?{urlencode(params)}>; rel="next"'
+
+def keyset_page(stmt, args):
+    """
+    Returns a page of the rows selected by stmt, in id order.
+    stmt must end in a WHERE clause. Pages are selected with the 'limit'
+    and 'after' (last id seen) query parameters, and the next page, if
+    any, is linked in the 'Link' header.
+    Clients that accept 'application/x-ndjson', or pass 'stream=1', get
+    every remaining row streamed instead of a single page.
+    """
+    ndjson = request.accept_mimetypes.best_match(
+        ['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+    streaming = ndjson or request.args.get('stream') == '1'
+    default_limit = 0 if streaming else app.config['PAGE_SIZE']
+    try:
+        limit = int(request.args.get('limit', default_limit))
+        after = int(request.args.get('after', 0))
+    except ValueError:
+        return jsonify({'error': 'Invalid pagination parameters'}), 400
+    if limit < 0 or (limit == 0 and not streaming) or after < 0:
+        return jsonify({'error': 'Invalid pagination parameters'}), 400
+
+    if streaming:
+        # Streams every row after the cursor (or 'limit' of them)
+        if limit:
+            return stream_rows(stmt + ' AND id>? ORDER BY id LIMIT ?', args + (after, limit), ndjson)
+        return stream_rows(stmt + ' AND id>? ORDER BY id', args + (after,), ndjson)
+
+    limit = min(limit, app.config['MAX_PAGE_SIZE'])
+
+    rows = db.fetch_rows(stmt + ' AND id>? ORDER BY id LIMIT ?', args + (after, limit + 1))
+    res = rows_response(rows[:limit])
+    if len(rows) > limit:
+        cursor = rows.value(limit - 1, 'id')
+        params = request.args.to_dict()
+        params.update(limit=limit, after=cursor)
+        res.headers['Link'] = next_link(params)
+        res.headers['X-Next-Cursor'] = str(cursor)
+    return res
+
+def stream_rows(stmt, args, ndjson=False):
+    """
+    Streams the rows selected by stmt as they are fetched from the cursor,
+    either as a JSON array or as newline delimited JSON.
+    """
+    chunks = db.iter_query(stmt, args, chunk_size=app.config['STREAM_CHUNK_SIZE'])
+
+    def generate_ndjson():
+        for rows in chunks:
+            yield rows.to_ndjson()
+
+    def generate_array():
+        sep = '['
+        for rows in chunks:
+            yield sep + rows.to_json()[1:-1]
+            sep = ','
+        yield ']' if sep == ',' else '[]'
+
+    if ndjson:
+        return Response(generate_ndjson(), mimetype='application/x-ndjson')
+    return Response(generate_array(), mimetype='application/json')
+
+# ======================
+#  Conditional requests
+# ======================
+
+# Keys the ETags with the server secret: otherwise a client could compute
+# the ETag of a resource it was never sent, and get 304 for it
+etag_key = hmac.new(token_signer.secret, b'etag', hashlib.sha256).digest()
+
+def version_stamp(scope, scope_id):
+    """Returns the version stamp of (scope, scope_id), read on every call."""
+    return (db.execute_query('SELECT version FROM version_stamp WHERE scope=? AND id=?',
+                             (scope, scope_id)).fetchone() or {'version': 0})['version']
+
+def resource_etag(scope, scope_id, stamp=None):
+    """
+    Returns the ETag of the current GET request for a resource whose
+    content changes whenever the version stamp of (scope, scope_id) does.
+    """
+    if stamp is None:
+        stamp = version_stamp(scope, scope_id)
+    key = '\0'.join((scope, str(scope_id), str(stamp),
+                     str(g.user['id']), request.full_path,
+                     request.headers.get('Accept', '')))
+    return hashlib.blake2b(key.encode(), key=etag_key, digest_size=20).hexdigest()
+
+def not_modified(etag):
+    """Returns a 304 response if the client already has the given ETag."""
+    # Compressed responses carry the ETag with the coding appended
+    if any(tag in request.if_none_match for tag in (etag, etag + '-gzip', etag + '-deflate')):
+        return Response(status=304)
+    return None
+
+def with_etag(res, etag):
+    """Sets the ETag of a successful response."""
+    if isinstance(res, Response) and res.status_code in (200, 304):
+        res.set_etag(etag)
+    return res
+
+# =============
+#  Compression
+# =============
+
+@app.after_request
+def compress_response(response):
+    """
+    Compresses responses with gzip or deflate when the client accepts it:
+    streamed responses as they are sent, others once they reach
+    COMPRESS_MIN_SIZE bytes. Server-sent events are left alone.
+    """
+    if response.mimetype not in COMPRESSIBLE:
+        return response
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or not request.headers.get('Accept-Encoding')):
+        return response
+    encoding = request.accept_encodings.best_match(('gzip', 'deflate'))
+    if encoding is None:
+        return response
+    level = app.config['COMPRESS_LEVEL']
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(compress(data, encoding, level))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f'{etag}-{encoding}', weak)
+    return response
 
 # ===========
 #  Web views
@@ -33,13 +764,47 @@ def index():
 @app.before_request
 def before_request():
     auth = request.authorization
-    if auth:
-        user = db.execute_query('SELECT * FROM user WHERE username=? AND password=?', (
-            auth.username, auth.password
-        )).fetchone()
+    if auth and auth.type == 'bearer':
+        # Bearer tokens are verified without reading the database, and
+        # only carry the user id
+        claims = token_signer.verify(auth.token)
+        if claims and not token_revocations.is_revoked(*claims):
+            g.user = {'id': claims[0]}
+        else:
+            g.user = None
+    elif auth:
+        key = (auth.username, hashlib.sha256((auth.password or '').encode()).digest())
+        user = auth_cache.get(key)
+        if user is None:
+            user = db.catalog.execute_query('SELECT * FROM user WHERE username=? AND password=?', (
+                auth.username, auth.password
+            )).fetchone()
+            if user is not None:
+                auth_cache.set(key, user)
         g.user = user
     else:
         g.user = None
+    db.route(g.user['id'] if g.user else None)
+    return limit_rate()
+
+def current_user():
+    """Returns the row of the authenticated user."""
+    if 'username' not in g.user:
+        g.user = db.catalog.execute_query('SELECT * FROM user WHERE id=?',
+                                          (g.user['id'],)).fetchone()
+    return g.user
+
+@app.route('/api/token/', methods=['POST'])
+def token():
+    """
+    Exchanges Basic credentials for a bearer token.
+    Requires Basic authorization.
+    """
+    if not g.user or request.authorization.type != 'basic':
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    return jsonify({'token': token_signer.issue(g.user['id']), 'token_type': 'Bearer',
+                    'expires_in': int(app.config['TOKEN_TTL'])}), 200
 
 @app.route('/api/user/register/', methods=['POST'])
 def user_register():
@@ -48,9 +813,12 @@ def user_register():
     Does not require authorization.
     """
     data = request.get_json()
-    db.execute_update('INSERT INTO user (name, email, username, password) VALUES (?, ?, ?, ?)', (
-        data['name'], data['email'], data['username'], data['password']
-    ))
+    try:
+        db.catalog.execute_update('INSERT INTO user (name, email, username, password) VALUES (?, ?, ?, ?)', (
+            data['name'], data['email'], data['username'], data['password']
+        ))
+    except sqlite3.IntegrityError:
+        return jsonify({'error': 'Username already taken'}), 409
     return jsonify({'status': 'User registered successfully'}), 201
 
 @app.route('/api/user/', methods=['GET', 'PUT'])
@@ -62,15 +830,24 @@ def user_detail():
     if not g.user:
         return jsonify({'error': 'Unauthorized'}), 403
 
+    user = current_user()
+    if not user:
+        return jsonify({'error': 'Unauthorized'}), 403
+
     if request.method == 'GET':
         # Returns user data
-        return jsonify(g.user)
+        return jsonify(user)
     else:
         # Updates user data
         data = request.get_json()
-        db.execute_update('UPDATE user SET name=?, email=?, username=?, password=? WHERE id=?', (
-            data['name'], data['email'], data['username'], data['password'], g.user['id']
-        ))
+        try:
+            db.catalog.execute_update('UPDATE user SET name=?, email=?, username=?, password=? WHERE id=?', (
+                data['name'], data['email'], data['username'], data['password'], user['id']
+            ))
+        except sqlite3.IntegrityError:
+            return jsonify({'error': 'Username already taken'}), 409
+        invalidate_credentials(user['username'], data['username'])
+        revoke_tokens(user['id'])
         return jsonify({'status': 'User updated successfully'}), 200
 
 @app.route('/api/projects/', methods=['GET', 'POST'])
@@ -83,10 +860,20 @@ def project_list():
         return jsonify({'error': 'Unauthorized'}), 403
 
     if request.method == 'GET':
-        # Returns the list of projects of a user
-        projects = db.execute_query(
-            'SELECT * FROM project WHERE user_id=?', (g.user['id'],)).fetchall()
-        return jsonify(projects)
+        # Returns a page of the projects of a user (only the columns named
+        # in 'fields' if given), with their task counts if 'summary=1' is given
+        try:
+            columns = select_list('project', requested_fields('project'))
+        except ValueError:
+            return jsonify({'error': 'Invalid fields'}), 400
+        etag = resource_etag('user', g.user['id'])
+        if request.args.get('summary') == '1':
+            columns = 'project.*' if columns == '*' else columns
+            stmt = f'SELECT {columns}, {SUMMARY_COLUMNS} {SUMMARY_FROM} WHERE project.user_id=?'
+        else:
+            stmt = f'SELECT {columns} FROM project WHERE user_id=?'
+        res = not_modified(etag) or keyset_page(stmt, (g.user['id'],))
+        return with_etag(res, etag)
     else:
         # Adds a project to the list
         data = request.get_json()
@@ -98,8 +885,25 @@ def project_list():
             'VALUES (?, ?, ?, ?)', (
             g.user['id'], data['title'], creation_date, creation_date
         ))
+        invalidate_project(project_id)
         return jsonify({'status': 'Project created successfully', 'id': project_id}), 201
 
+@app.route('/api/projects/summary/', methods=['GET'])
+def project_summary():
+    """
+    Task counts and completion ratio of every project, paginated like the
+    project list.
+    Requires authorization.
+    """
+    if not g.user:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    etag = resource_etag('user', g.user['id'])
+    res = not_modified(etag) or keyset_page(
+        f'SELECT project.id, project.title, {SUMMARY_COLUMNS} {SUMMARY_FROM} WHERE project.user_id=?',
+        (g.user['id'],))
+    return with_etag(res, etag)
+
 @app.route('/api/projects/<int:pk>/', methods=['GET', 'PUT', 'DELETE'])
 def project_detail(pk):
     """
@@ -109,15 +913,28 @@ def project_detail(pk):
     if not g.user:
         return jsonify({'error': 'Unauthorized'}), 403
 
-    project = db.execute_query(
-        'SELECT * FROM project WHERE id=? AND user_id=?', (pk, g.user['id'])).fetchone()
+    stamp = None
+    if request.method == 'GET':
+        try:
+            fields = requested_fields('project')
+        except ValueError:
+            return jsonify({'error': 'Invalid fields'}), 400
+        # ETags are keyed, and only sent with owned projects, so only those match
+        stamp = version_stamp('project', pk)
+        etag = resource_etag('project', pk, stamp)
+        res = not_modified(etag)
+        if res:
+            return with_etag(res, etag)
+
+    # The project is sent with the ETag of its stamp, so it is reloaded if the stamp moved
+    project = get_project(pk, stamp)
 
     if not project:
         return jsonify({'error': 'Project not found'}), 404
 
     if request.method == 'GET':
         # Returns a project
-        return jsonify(project)
+        return with_etag(jsonify(project_row(project, fields)), etag)
     elif request.method == 'PUT':
         # Updates a project
         data = request.get_json()
@@ -125,14 +942,17 @@ def project_detail(pk):
             'UPDATE project SET title=?, last_updated=? WHERE id=? AND user_id=?', (
             data['title'], datetime.now(timezone.utc).isoformat(), pk, g.user['id']
         ))
+        invalidate_project(pk)
         return jsonify({'status': 'Project updated successfully'}), 200
     else:
         # Deletes a project and associated tasks
-        db.execute_update(
-            'DELETE FROM task WHERE project_id=?', (pk,))
-        db.execute_update(
-            'DELETE FROM project WHERE id=? AND user_id=?',
-            (pk, g.user['id']))
+        with db.transaction():
+            db.execute_update(
+                'DELETE FROM task WHERE project_id=?', (pk,))
+            db.execute_update(
+                'DELETE FROM project WHERE id=? AND user_id=?',
+                (pk, g.user['id']))
+        invalidate_project(pk, tasks=True)
         return jsonify({'status':
                             'Project and associated tasks deleted successfully'}), 200
 
@@ -145,19 +965,25 @@ def task_list(pk):
     if not g.user:
         return jsonify({'error': 'Unauthorized'}), 403
 
+    if request.method == 'GET':
+        try:
+            columns = select_list('task', requested_fields('task'))
+        except ValueError:
+            return jsonify({'error': 'Invalid fields'}), 400
+        # ETags are keyed, and only sent with owned projects, so only those match
+        etag = resource_etag('project', pk)
+        res = not_modified(etag)
+        if res:
+            return with_etag(res, etag)
+
     # Ensure the project belongs to the user
-    project = db.execute_query(
-        'SELECT * FROM project WHERE id=? AND user_id=?',
-        (pk, g.user['id'])).fetchone()
+    project = get_project(pk)
     if not project:
         return jsonify({'error': 'Project not found'}), 404
 
     if request.method == 'GET':
-        # Returns the list of tasks of a project
-        tasks = db.execute_query(
-            'SELECT * FROM task WHERE project_id=?',
-            (pk,)).fetchall()
-        return jsonify(tasks)
+        # Returns a page of the tasks of a project
+        return with_etag(keyset_page(f'SELECT {columns} FROM task WHERE project_id=?', (pk,)), etag)
     else:
         # Adds a task to project
         data = request.get_json()
@@ -169,8 +995,78 @@ def task_list(pk):
             ' VALUES (?, ?, ?, ?)', (
             pk, data['title'], creation_date, data['completed']
         ))
+        invalidate_tasks(pk)
         return jsonify({'status': 'Task created successfully', 'id': task_id}), 201
 
+@app.route('/api/projects/<int:pk>/tasks/batch/', methods=['POST'])
+def task_batch(pk):
+    """
+    Creates, updates and deletes many tasks of a project in one transaction.
+    Expects a list of operations such as {"op": "create", "title": ...,
+    "completed": ...}, {"op": "update", "id": ..., "title": ...} or
+    {"op": "delete", "id": ...}, and returns one result per operation.
+    Requires authorization.
+    """
+    if not g.user:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    # Ensure the project belongs to the user
+    project = get_project(pk)
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+
+    data = request.get_json()
+    if not isinstance(data, list) or not data:
+        return jsonify({'error': 'Invalid data'}), 400
+    if len(data) > app.config['MAX_BATCH_SIZE']:
+        return jsonify({'error': 'Too many operations'}), 400
+
+    # Validates every operation before applying any of them
+    errors = []
+    for idx, item in enumerate(data):
+        if not isinstance(item, dict) or item.get('op') not in ('create', 'update', 'delete'):
+            errors.append({'index': idx, 'error': 'Invalid operation'})
+        elif item['op'] != 'create' and (not isinstance(item.get('id'), int)
+                                         or isinstance(item['id'], bool)):
+            errors.append({'index': idx, 'error': 'Invalid task id'})
+        elif item['op'] != 'delete' and (
+                (('title' in item or item['op'] == 'create')
+                 and not (isinstance(item.get('title'), str) and item['title']))
+                or not valid_completed(item.get('completed'))):
+            errors.append({'index': idx, 'error': 'Invalid data'})
+    if errors:
+        return jsonify({'error': 'Invalid data', 'errors': errors}), 400
+
+    creation_date = datetime.now(timezone.utc).isoformat()
+    operations = []
+    for item in data:
+        if item['op'] == 'create':
+            operations.append((
+                'INSERT INTO task (project_id, title, creation_date, completed) VALUES (?, ?, ?, ?)',
+                (pk, item['title'], creation_date, item.get('completed', 0))))
+        elif item['op'] == 'update':
+            operations.append((
+                'UPDATE task SET title=COALESCE(?, title), completed=COALESCE(?, completed) '
+                'WHERE id=? AND project_id=?',
+                (item.get('title'), item.get('completed'), item['id'], pk)))
+        else:
+            operations.append((
+                'DELETE FROM task WHERE id=? AND project_id=?', (item['id'], pk)))
+
+    applied = db.execute_batch(operations)
+    invalidate_tasks(pk, *[item['id'] for item in data if item['op'] != 'create'])
+
+    results = []
+    for item, (row_id, count) in zip(data, applied):
+        if item['op'] == 'create':
+            results.append({'op': 'create', 'status': 201, 'id': row_id})
+        elif count:
+            results.append({'op': item['op'], 'status': 200, 'id': item['id']})
+        else:
+            results.append({'op': item['op'], 'status': 404, 'id': item['id'],
+                            'error': 'Task not found'})
+    return jsonify({'status': 'Batch applied successfully', 'results': results}), 200
+
 @app.route('/api/projects/<int:project_id>/tasks/<int:task_id>/', methods=['GET', 'PUT', 'DELETE'])
 def task_detail(project_id, task_id):
     """
@@ -180,31 +1076,35 @@ def task_detail(project_id, task_id):
     if not g.user:
         return jsonify({'error': 'Unauthorized'}), 403
 
+    try:
+        fields = requested_fields('task') if request.method == 'GET' else None
+    except ValueError:
+        return jsonify({'error': 'Invalid fields'}), 400
+
     # Ensure the task belongs to the project and the project belongs to the user
-    project = db.execute_query(
-        'SELECT * FROM project WHERE id=? AND user_id=?', (project_id, g.user['id'])).fetchone()
+    project = get_project(project_id)
     if not project:
         return jsonify({'error': 'Project not found'}), 404
 
-    task = db.execute_query(
-        'SELECT * FROM task WHERE id=? AND project_id=?',
-        (task_id, project_id)).fetchone()
+    task = get_task(project_id, task_id)
     if not task:
         return jsonify({'error': 'Task not found'}), 404
 
     if request.method == 'GET':
         # Returns a task
-        return jsonify(task)
+        return jsonify(project_row(task, fields))
     elif request.method == 'PUT':
         # Updates a task
         data = request.get_json()
         db.execute_update('UPDATE task SET title=?, completed=? WHERE id=? AND project_id=?', (
             data['title'], data['completed'], task_id, project_id
         ))
+        invalidate_tasks(project_id, task_id)
         return jsonify({'status': 'Task updated successfully'}), 200
     else:
         # Deletes a task
         db.execute_update('DELETE FROM task WHERE id=? AND project_id=?', (task_id, project_id))
+        invalidate_tasks(project_id, task_id)
         return jsonify({'status': 'Task deleted successfully'}), 200
 
 @app.route('/api/tasks/<int:task_id>/completed/', methods=['PATCH'])
@@ -223,11 +1123,16 @@ def update_task_completed(task_id):
         return jsonify({'error': 'Task not found'}), 404
 
     data = request.get_json()
-    db.execute_update('UPDATE task SET completed=? WHERE id=?', (
-        data['completed'], task_id
-    ))
-    # Retorna o status atualizado para verificar se a atualização ocorreu corretamente
-    updated_task = db.execute_query('SELECT * FROM task WHERE id=?', (task_id,)).fetchone()
+    with db.transaction():
+        db.execute_update('UPDATE task SET completed=? WHERE id=?', (
+            data['completed'], task_id
+        ))
+        # Retorna o status atualizado para verificar se a atualização ocorreu corretamente
+        updated_task = db.execute_query('SELECT * FROM task WHERE id=?', (task_id,)).fetchone()
+    if not updated_task:
+        # Deleted since it was looked up
+        return jsonify({'error': 'Task not found'}), 404
+    invalidate_tasks(task['project_id'], task_id)
     return jsonify({'status': 'Task completion status updated successfully',
                     'completed': updated_task['completed']}), 200
 
@@ -241,23 +1146,119 @@ def message_list():
         return jsonify({'error': 'Unauthorized'}), 403
 
     if request.method == 'GET':
-        # Returns the list of messages for the user
-        messages = db.execute_query(
-            'SELECT * FROM message WHERE receiver_id=?', (g.user['id'],)).fetchall()
-        return jsonify(messages)
+        # Returns a page of the messages for the user
+        try:
+            columns = select_list('message', requested_fields('message'))
+        except ValueError:
+            return jsonify({'error': 'Invalid fields'}), 400
+        return keyset_page(f'SELECT {columns} FROM message WHERE receiver_id=?', (g.user['id'],))
     else:
         # Sends a message to another user
         data = request.get_json()
         if 'receiver_id' not in data or 'content' not in data or not data['content']:
             return jsonify({'error': 'Invalid data'}), 400
+        try:
+            receiver_id = int(data['receiver_id'])
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid data'}), 400
         timestamp = datetime.now(timezone.utc).isoformat()
-        message_id = db.execute_update(
+        # Stored with the receiver, who may live on another shard
+        message_id = db.for_user(receiver_id).execute_update(
             'INSERT INTO message (sender_id, receiver_id, content, timestamp) '
             'VALUES (?, ?, ?, ?)', (
-            g.user['id'], data['receiver_id'], data['content'], timestamp
+            g.user['id'], receiver_id, data['content'], timestamp
         ))
+        message_hub.publish(receiver_id, message_id)
         return jsonify({'status': 'Message sent successfully', 'id': message_id}), 201
 
+@app.route('/api/messages/poll/', methods=['GET'])
+def message_poll():
+    """
+    Waits for new messages (long polling).
+    Returns the messages after the 'after' id as soon as there are any, or
+    an empty list after 'timeout' seconds. Without 'after', waits for the
+    messages sent from now on. The last id is returned in 'X-Next-Cursor'.
+    Requires authorization.
+    """
+    if not g.user:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    try:
+        columns = select_list('message', requested_fields('message'))
+    except ValueError:
+        return jsonify({'error': 'Invalid fields'}), 400
+    try:
+        timeout = float(request.args.get('timeout', app.config['MESSAGE_POLL_TIMEOUT']))
+        limit = int(request.args.get('limit', app.config['PAGE_SIZE']))
+        after = int(request.args['after']) if 'after' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'Invalid poll parameters'}), 400
+    if not 0 <= timeout or limit <= 0 or (after is not None and after < 0):
+        return jsonify({'error': 'Invalid poll parameters'}), 400
+    timeout = min(timeout, app.config['MAX_MESSAGE_POLL_TIMEOUT'])
+    limit = min(limit, app.config['MAX_PAGE_SIZE'])
+
+    if after is None:
+        after = newest_message(g.user['id'])[0]
+    rows = wait_for_messages(g.user['id'], after, timeout, limit, columns)
+    res = rows_response(rows or Rows((), []))
+    res.headers['X-Next-Cursor'] = str(rows.value(len(rows) - 1, 'id') if rows else after)
+    return res
+
+@app.route('/api/messages/events/', methods=['GET'])
+def message_events():
+    """
+    Streams new messages as server-sent events, with the message id as the
+    event id. Resumes after the 'Last-Event-ID' header or 'after' parameter
+    if given. The stream ends after 'timeout' seconds; clients reconnect.
+    Requires authorization.
+    """
+    if not g.user:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    try:
+        after = request.headers.get('Last-Event-ID', request.args.get('after'))
+        after = int(after) if after is not None else None
+        timeout = float(request.args.get('timeout', app.config['MESSAGE_STREAM_TIMEOUT']))
+    except ValueError:
+        return jsonify({'error': 'Invalid stream parameters'}), 400
+    if not 0 <= timeout or (after is not None and after < 0):
+        return jsonify({'error': 'Invalid stream parameters'}), 400
+    timeout = min(timeout, app.config['MESSAGE_STREAM_TIMEOUT'])
+    keepalive = app.config['MESSAGE_KEEPALIVE']
+    limit = app.config['PAGE_SIZE']
+    receiver_id = g.user['id']
+    if after is None:
+        after = newest_message(receiver_id)[0]
+
+    # Servers that await the waits of response bodies (see asgi.py) hold
+    # no thread while the stream waits for messages
+    awaits = request.environ.get('asgiapp.awaits', False)
+
+    def generate(after):
+        deadline = time.monotonic() + timeout
+        yield f'retry: {int(keepalive * 1000)}\n\n'
+        # Holds no connection between events, so it can be resumed from any thread
+        while True:
+            remaining = deadline - time.monotonic()
+            wait = max(0, min(remaining, keepalive))
+            if awaits:
+                rows = yield from message_waits(receiver_id, after, wait, limit)
+            else:
+                rows = wait_for_messages(receiver_id, after, wait, limit)
+            if rows:
+                yield ''.join(f"id: {rows.value(idx, 'id')}\nevent: message\ndata: {data}\n\n"
+                              for idx, data in enumerate(rows.to_ndjson().splitlines()))
+                after = rows.value(len(rows) - 1, 'id')
+            elif remaining <= keepalive:
+                return
+            else:
+                yield ': keepalive\n\n'
+
+    res = Response(generate(after), mimetype='text/event-stream')
+    res.headers['Cache-Control'] = 'no-cache'
+    return res
+
 @app.route('/api/messages/<int:message_id>/', methods=['GET', 'DELETE'])
 def message_detail(message_id):
     """
@@ -267,8 +1268,13 @@ def message_detail(message_id):
     if not g.user:
         return jsonify({'error': 'Unauthorized'}), 403
 
-    message = db.execute_query(
-        'SELECT * FROM message WHERE id=? AND (sender_id=? OR receiver_id=?)',
+    try:
+        columns = select_list('message', requested_fields('message'))
+    except ValueError:
+        return jsonify({'error': 'Invalid fields'}), 400
+    shard = db.for_message(message_id)
+    message = shard.execute_query(
+        f'SELECT {columns} FROM message WHERE id=? AND (sender_id=? OR receiver_id=?)',
         (message_id, g.user['id'], g.user['id'])).fetchone()
     if not message:
         return jsonify({'error': 'Message not found'}), 404
@@ -278,8 +1284,207 @@ def message_detail(message_id):
         return jsonify(message)
     else:
         # Deletes a message
-        db.execute_update('DELETE FROM message WHERE id=?', (message_id,))
+        shard.execute_update('DELETE FROM message WHERE id=?', (message_id,))
         return jsonify({'status': 'Message deleted successfully'}), 200
 
+# Types of search results, in the order of their row id codes in schema.sql
+SEARCH_TYPES = ('project', 'task', 'message')
+
+def search_expression(user_id, query):
+    """
+    Returns the FTS5 expression matching every word of query in the rows
+    visible to user_id, or None if query has no words. A query ending in
+    '*' matches its last word as a prefix. Words are quoted, so query
+    cannot inject FTS5 syntax.
+    """
+    words = re.findall(r'\w+', query)
+    if not words:
+        return None
+    terms = [f'owner:"u{user_id}"']
+    terms.extend(f'body:"{word}"' for word in words)
+    if query.rstrip().endswith('*'):
+        terms[-1] += '*'
+    return ' AND '.join(terms)
+
+@app.route('/api/sync/', methods=['GET'])
+def sync():
+    """
+    Returns the changes to the projects, tasks and received messages of
+    the user after the 'since' seq, 'limit' at a time (see read_changes),
+    and the 'seq' to pass as since next. Clients whose since is older than
+    compacted tombstones get 410, and must sync again from 0.
+    Requires authorization.
+    """
+    if not g.user:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    try:
+        since = int(request.args.get('since', 0))
+        limit = int(request.args.get('limit', app.config['PAGE_SIZE']))
+    except ValueError:
+        return jsonify({'error': 'Invalid sync parameters'}), 400
+    if since < 0 or limit <= 0:
+        return jsonify({'error': 'Invalid sync parameters'}), 400
+    limit = min(limit, app.config['MAX_PAGE_SIZE'])
+
+    database = db.for_user(g.user['id'])
+    if since:
+        horizon = database.execute_query('SELECT seq FROM change_horizon WHERE user_id=?',
+                                         (g.user['id'],)).fetchone()
+        if horizon and since < horizon['seq']:
+            return jsonify({'error': 'Changes since this seq were compacted',
+                            'horizon': horizon['seq']}), 410
+    changes = read_changes(database, g.user['id'], since, limit + 1)
+    more = len(changes) > limit
+    changes = changes[:limit]
+    seq = changes[-1]['seq'] if changes else since
+    res = jsonify({'changes': changes, 'seq': seq, 'more': more})
+    if more:
+        res.headers['Link'] = f'<{url_for("sync", since=seq, limit=limit)}>; rel="next"'
+    return res
+
+@app.route('/api/search/', methods=['GET'])
+def search():
+    """
+    Searches the projects, tasks and messages of the user.
+    Returns the rows containing every word of 'q', best first, optionally
+    of one 'type' only.
+    Pages are selected with 'limit' and 'offset', and the next page, if
+    any, is linked in the 'Link' header.
+    Requires authorization.
+    """
+    if not g.user:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    kind = request.args.get('type')
+    try:
+        limit = int(request.args.get('limit', app.config['PAGE_SIZE']))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({'error': 'Invalid pagination parameters'}), 400
+    if limit <= 0 or not 0 <= offset <= app.config['MAX_SEARCH_OFFSET']:
+        return jsonify({'error': 'Invalid pagination parameters'}), 400
+    if kind is not None and kind not in SEARCH_TYPES:
+        return jsonify({'error': 'Invalid type'}), 400
+    expression = search_expression(g.user['id'], request.args.get('q', ''))
+    if expression is None:
+        return jsonify({'error': 'Invalid query'}), 400
+    limit = min(limit, app.config['MAX_PAGE_SIZE'])
+
+    # Filters the type on the row id rather than in the expression, where
+    # the bm25 statistics of a 'kind' term would cover every row of a type
+    stmt = ('SELECT kind AS type, rowid / 4 AS id, project_id, body AS text, rank AS score '
+            'FROM search WHERE search MATCH ?')
+    args = (expression,)
+    if kind:
+        stmt += ' AND rowid % 4 = ?'
+        args += (SEARCH_TYPES.index(kind) + 1,)
+    rows = db.fetch_rows(stmt + ' ORDER BY rank LIMIT ? OFFSET ?', args + (limit + 1, offset))
+    res = rows_response(rows[:limit])
+    if len(rows) > limit and offset + limit <= app.config['MAX_SEARCH_OFFSET']:
+        params = request.args.to_dict()
+        params.update(limit=limit, offset=offset + limit)
+        res.headers['Link'] = next_link(params)
+    return res
+
+@app.route('/api/export/', methods=['GET'])
+def workspace_export():
+    """
+    Streams the projects, tasks and received messages of the user as
+    newline delimited JSON, in the format read by /api/import/.
+    Requires authorization.
+    """
+    if not g.user:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    # Resolves the shard now, as the records are read after the request
+    database = db.for_user(g.user['id'])
+    chunks = export_workspace(database, g.user['id'], app.config['STREAM_CHUNK_SIZE'])
+    return Response(chunks, mimetype='application/x-ndjson')
+
+@app.route('/api/import/', methods=['POST'])
+def workspace_import():
+    """
+    Adds the records of an export (NDJSON, projects before their tasks) to
+    the workspace of the user. Tasks are attached to the new ids of their
+    projects. The upload is read line by line and committed every
+    IMPORT_BATCH_SIZE records; on an invalid record, the records before it
+    are kept and its line is returned.
+    Requires authorization.
+    """
+    if not g.user:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    user_id = g.user['id']
+    max_size = app.config['MAX_IMPORT_RECORD_SIZE']
+    counts = {'projects': 0, 'tasks': 0, 'messages': 0}
+    projects = {}
+    exported_projects = set()
+    batch = []
+
+    def flush():
+        import_batch(db, user_id, batch, projects)
+        for record in batch:
+            counts[record['type'] + 's'] += 1
+        batch.clear()
+
+    # The request stream is unbuffered, and would be read byte by byte
+    stream = io.BufferedReader(request.stream, buffer_size=64 * 1024)
+    line_number = 0
+    while True:
+        line = stream.readline(max_size + 1)
+        if not line:
+            break
+        line_number += 1
+        error = None
+        if len(line) > max_size:
+            error = 'Record too large'
+        elif line.strip():
+            try:
+                record = parse_record(line)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                error = 'Invalid JSON'
+            except ValueError as exc:
+                error = str(exc)
+            else:
+                if record['type'] == 'project':
+                    exported_projects.add(record['id'])
+                if record['type'] == 'task' and record['project_id'] not in exported_projects:
+                    error = 'Unknown project'
+                else:
+                    batch.append(record)
+        if error:
+            flush()
+            invalidate_workspace(user_id)
+            return jsonify({'error': error, 'line': line_number, 'imported': counts}), 400
+        if len(batch) >= app.config['IMPORT_BATCH_SIZE']:
+            flush()
+    flush()
+    invalidate_workspace(user_id)
+    return jsonify({'status': 'Workspace imported successfully', 'imported': counts}), 201
+
+@app.route('/api/stats/', methods=['GET'])
+def stats():
+    """
+    Returns the in-process cache counters.
+    Requires authorization.
+    """
+    if not g.user:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    return jsonify({'auth_cache': auth_cache.stats(),
+                    'response_cache': response_cache.stats(),
+                    'message_hub': message_hub.stats(),
+                    'rate_limiter': rate_limiter.stats(),
+                    'admission': admission.stats()})
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_view():
+    """
+    Returns the request, query and cache metrics in the Prometheus text format.
+    Does not require authorization.
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=8000)
@@ -0,0 +1,450 @@
+"""
+ Serves the API from asyncio.
+
+ASGIApp wraps the Flask app so that reading requests and writing
+responses happen on the event loop, while the views (and so every
+database call) run on a bounded thread pool that owns the database
+connections. Response bodies are read from the pool one chunk at a time,
+as the client takes them, so idle and slow clients only cost a
+coroutine, not a thread. Response bodies may also yield awaitables, such
+as the hub waits of message streams, which are awaited on the event loop
+so that waiting holds no thread either. Other requests that wait for
+events run on a pool of their own. The views behave exactly as under a
+WSGI server.
+
+Run with any ASGI server (e.g. ``uvicorn asgi:application``), or with the
+small HTTP/1.1 server included here: ``python asgi.py [--port 8000]``.
+
+"""
+
+import argparse
+import asyncio
+import io
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from werkzeug.exceptions import HTTPException
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of a response body
+_DONE = object()
+
+# Set in the environ, tells applications that their response bodies may
+# yield awaitables between chunks
+AWAITS = 'asgiapp.awaits'
+
+
+class ASGIApp:
+    """ASGI application that runs a WSGI application on a thread pool.
+
+    Requests for which waits(environ) is true may wait long for events
+    (e.g. long polls), and run on a separate pool of max_waiting threads
+    so that they cannot starve the others. Waits yielded by response
+    bodies hold none of these threads.
+    """
+
+    def __init__(self, wsgi_app, max_workers=None, max_body_size=16 * 1024 * 1024,
+                 waits=None, max_waiting=64):
+        self.wsgi_app = wsgi_app
+        self.max_body_size = max_body_size
+        self.waits = waits
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or min(32, (os.cpu_count() or 1) + 4),
+                                           thread_name_prefix='db')
+        self.wait_executor = ThreadPoolExecutor(max_workers=max_waiting, thread_name_prefix='wait')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(f"Unsupported scope type {scope['type']!r}")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.wait_executor.shutdown(wait=True)
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        # Reads the whole body on the event loop, so slow uploads hold no thread
+        body = bytearray()
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.extend(message.get('body', b''))
+            more_body = message.get('more_body', False)
+            if len(body) > self.max_body_size:
+                await _send_status(send, HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+                return
+
+        loop = asyncio.get_running_loop()
+        environ = build_environ(scope, bytes(body))
+        environ[AWAITS] = True
+        executor = self.wait_executor if self.waits and self.waits(environ) else self.executor
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin1'), value.encode('latin1'))
+                                  for name, value in headers]
+            return lambda data: None
+
+        def call():
+            # Runs the view and reads the first two chunks of its body, so
+            # that most responses are sent after a single task
+            result = self.wsgi_app(environ, start_response)
+            try:
+                chunks = iter(result)
+                first, following = _read_ahead(chunks)
+            except BaseException:
+                _close(result)
+                raise
+            if first is _DONE or following is _DONE:
+                _close(result)
+                result = None
+            return result, chunks, first, following
+
+        # The task currently running on the thread pool. Each chunk is read
+        # by its own task, and only once the previous one is being sent, so
+        # a slow client holds no thread and the body is read at its pace.
+        task = loop.run_in_executor(executor, call)
+        result = None
+        try:
+            result, chunks, pending, following = await asyncio.shield(task)
+            if pending is _DONE:
+                if 'status' in started:
+                    await send({'type': 'http.response.start', 'status': started['status'],
+                                'headers': started['headers']})
+                    await send({'type': 'http.response.body', 'body': b''})
+                return
+            await send({'type': 'http.response.start', 'status': started['status'],
+                        'headers': started['headers']})
+            more = True
+            while pending is not _DONE:
+                if not isinstance(pending, bytes):
+                    # The body waits on the event loop, then goes on from
+                    # any thread
+                    await pending
+                    task = loop.run_in_executor(executor, _read_ahead, chunks)
+                    pending, following = await asyncio.shield(task)
+                    continue
+                more = following is not _DONE
+                read = isinstance(following, bytes)
+                if read:
+                    task = loop.run_in_executor(executor, _next_chunk, chunks)
+                await send({'type': 'http.response.body', 'body': pending, 'more_body': more})
+                pending = following
+                if read:
+                    following = await asyncio.shield(task)
+            if more:
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            # Lets a running task finish (the client may have gone away),
+            # then stops the view
+            await asyncio.wait({task})
+            if not task.cancelled():
+                task.exception()
+            if result is not None:
+                await loop.run_in_executor(executor, _close, result)
+
+
+def _next_chunk(chunks):
+    """Returns the next non-empty chunk of a response body, or _DONE."""
+    for chunk in chunks:
+        if chunk:
+            return chunk
+    return _DONE
+
+
+def _read_ahead(chunks):
+    """
+    Returns the next two chunks of a response body, or only the next one
+    (and None) if it is an awaitable, which must be awaited before the body
+    goes on.
+    """
+    first = _next_chunk(chunks)
+    return first, _next_chunk(chunks) if isinstance(first, bytes) else None
+
+
+def _close(result):
+    if hasattr(result, 'close'):
+        result.close()
+
+
+def endpoint_matcher(flask_app, endpoints):
+    """Returns a function telling whether an environ is routed to one of endpoints."""
+    def matches(environ):
+        try:
+            endpoint, _ = flask_app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return False
+        return endpoint in endpoints
+    return matches
+
+
+def build_environ(scope, body):
+    """Builds the WSGI environ of an ASGI HTTP scope."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name in ('CONTENT_LENGTH', 'TRANSFER_ENCODING'):
+            # The body has already been read whole
+            continue
+        else:
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    if body:
+        environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+async def _send_status(send, status):
+    await send({'type': 'http.response.start', 'status': status.value,
+                'headers': [(b'content-type', b'text/plain'), (b'connection', b'close')]})
+    await send({'type': 'http.response.body', 'body': status.phrase.encode()})
+
+
+class HTTPServer:
+    """Minimal asyncio HTTP/1.1 server for an ASGI application.
+
+    Supports keep-alive, Content-Length and chunked request bodies, and
+    chunked responses when the application does not set Content-Length.
+    """
+
+    def __init__(self, app, host='127.0.0.1', port=8000, keep_alive=75.0,
+                 max_header_size=64 * 1024, backlog=2048):
+        self.app = app
+        self.backlog = backlog
+        self.host = host
+        self.port = port
+        self.keep_alive = keep_alive
+        self.max_header_size = max_header_size
+        self.server = None
+        self._tasks = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._connection, self.host, self.port,
+                                                 limit=self.max_header_size, backlog=self.backlog)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        """Stops listening and closes every open connection."""
+        self.server.close()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def _connection(self, reader, writer):
+        peer = writer.get_extra_info('peername') or ('', 0)
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keep_alive)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    return
+                except asyncio.LimitOverrunError:
+                    await self._reject(writer, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+                    return
+                request = self._parse_head(head)
+                if request is None:
+                    await self._reject(writer, HTTPStatus.BAD_REQUEST)
+                    return
+                method, target, version, headers = request
+                body = await self._read_body(reader, headers)
+                if body is None:
+                    await self._reject(writer, HTTPStatus.BAD_REQUEST)
+                    return
+                keep_alive = self._keep_alive(version, headers)
+                path, _, query = target.partition('?')
+                scope = {
+                    'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': version,
+                    'method': method, 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+                    'query_string': query.encode('latin1'), 'root_path': '',
+                    'headers': headers, 'client': peer[:2], 'server': (self.host, self.port),
+                }
+                keep_alive = await self._respond(scope, body, writer, keep_alive)
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        except Exception:
+            logger.exception('Error while handling a connection')
+        finally:
+            self._tasks.discard(task)
+            writer.close()
+
+    @staticmethod
+    def _parse_head(head):
+        lines = head.decode('latin1').split('\r\n')
+        try:
+            method, target, protocol = lines[0].split(' ')
+        except ValueError:
+            return None
+        if not protocol.startswith('HTTP/'):
+            return None
+        headers = []
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(':')
+            if not sep:
+                return None
+            headers.append((name.strip().lower().encode('latin1'), value.strip().encode('latin1')))
+        return method, target, protocol[5:], headers
+
+    @staticmethod
+    def _header(headers, name):
+        for key, value in headers:
+            if key == name:
+                return value.decode('latin1')
+        return None
+
+    async def _read_body(self, reader, headers):
+        if (self._header(headers, b'transfer-encoding') or '').lower() == 'chunked':
+            body = bytearray()
+            while True:
+                size = await reader.readuntil(b'\r\n')
+                try:
+                    size = int(size.split(b';', 1)[0], 16)
+                except ValueError:
+                    return None
+                if size == 0:
+                    await reader.readuntil(b'\r\n')
+                    return bytes(body)
+                body.extend(await reader.readexactly(size))
+                await reader.readexactly(2)
+        length = self._header(headers, b'content-length')
+        if not length:
+            return b''
+        try:
+            return await reader.readexactly(int(length))
+        except ValueError:
+            return None
+
+    def _keep_alive(self, version, headers):
+        connection = (self._header(headers, b'connection') or '').lower()
+        if version == '1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    async def _respond(self, scope, body, writer, keep_alive):
+        """Runs the application and writes its response; returns whether to keep alive."""
+        received = False
+        state = {'chunked': False, 'keep_alive': keep_alive}
+
+        async def receive():
+            nonlocal received
+            if received:
+                # Waits until the connection goes away
+                await asyncio.Event().wait()
+            received = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                headers = list(message.get('headers', []))
+                names = {name.lower() for name, _ in headers}
+                if b'connection' in names:
+                    state['keep_alive'] = state['keep_alive'] and self._header(
+                        headers, b'connection').lower() != 'close'
+                else:
+                    headers.append((b'connection', b'keep-alive' if state['keep_alive'] else b'close'))
+                if b'content-length' not in names and message['status'] not in (204, 304):
+                    state['chunked'] = True
+                    headers.append((b'transfer-encoding', b'chunked'))
+                status = HTTPStatus(message['status'])
+                lines = [f"HTTP/1.1 {status.value} {status.phrase}".encode()]
+                lines.extend(name + b': ' + value for name, value in headers)
+                # Sent with the first body message, in the same segment
+                state['head'] = b'\r\n'.join(lines) + b'\r\n\r\n'
+            elif message['type'] == 'http.response.body':
+                data = message.get('body', b'')
+                if state['chunked']:
+                    if data:
+                        data = b'%x\r\n%s\r\n' % (len(data), data)
+                    if not message.get('more_body', False):
+                        data += b'0\r\n\r\n'
+                writer.write(state.pop('head', b'') + data)
+                await writer.drain()
+
+        await self.app(scope, receive, send)
+        return state['keep_alive']
+
+    async def _reject(self, writer, status):
+        writer.write(f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+                     f'Content-Length: 0\r\nConnection: close\r\n\r\n'.encode())
+        await writer.drain()
+
+
+def _create_application():
+    from app import WAITING_ENDPOINTS, app, db
+    # One worker per pooled connection, so that no view waits for a connection
+    workers = int(os.environ.get('TASKLISTS_EXECUTOR_WORKERS', 0)) or db.pool_size or None
+    waiting = int(os.environ.get('TASKLISTS_WAITING_WORKERS', 0)) or 64
+    return ASGIApp(app, max_workers=workers, waits=endpoint_matcher(app, WAITING_ENDPOINTS),
+                   max_waiting=waiting)
+
+
+def __getattr__(name):
+    # Creates the application lazily, so importing this module does not
+    # import (and set up the database of) the Flask app
+    if name == 'application':
+        globals()['application'] = _create_application()
+        return globals()['application']
+    raise AttributeError(name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serves the Tasklists API from asyncio.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    server = HTTPServer(_create_application(), host=args.host, port=args.port)
+    asyncio.run(server.serve_forever())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Compares the size and encode time of the list response formats.
+
+For each row count, encodes a task list as JSON objects, JSON columns and
+MessagePack, each uncompressed, gzipped and deflated, and reports the bytes
+on the wire and the best encode time (compression included).
+
+Usage: python benchmarks/bench_formats.py [row counts...]
+
+"""
+
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from formats import compress, msgpack  # noqa: E402
+from models import Rows  # noqa: E402
+
+FORMATS = (('json', Rows.to_json), ('columns', Rows.to_columns_json),
+           ('msgpack', Rows.to_msgpack))
+ENCODINGS = ('identity', 'gzip', 'deflate')
+
+
+def seed(rows):
+    """Returns the rows of an in-memory task table with the given number of rows."""
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE task (id INTEGER PRIMARY KEY, project_id INTEGER, '
+                 'title TEXT, creation_date TEXT, completed INTEGER)')
+    conn.executemany('INSERT INTO task (project_id, title, creation_date, completed) '
+                     'VALUES (?, ?, ?, ?)',
+                     ((i % 100, f'Task {i}', '2024-06-28T10:00:00+00:00', i % 2)
+                      for i in range(rows)))
+    cursor = conn.execute('SELECT * FROM task')
+    result = Rows.from_cursor(cursor, cursor.fetchall())
+    conn.close()
+    return result
+
+
+def timed(fn):
+    """Returns the result and the best of three run times of fn, in seconds."""
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def encoder(encode, encoding):
+    """Returns a function encoding rows to bytes with a content coding."""
+    def run(rows):
+        data = encode(rows)
+        if isinstance(data, str):
+            data = data.encode()
+        return data if encoding == 'identity' else compress(data, encoding)
+    return run
+
+
+def main(counts):
+    print(f"MessagePack encoder: {'msgpack ' + msgpack.version_str if msgpack else 'local'}")
+    print(f"{'rows':>9} {'format':<9} {'encoding':<9} {'bytes':>12} {'ratio':>7} {'ms':>9}")
+    for count in counts:
+        rows = seed(count)
+        baseline = None
+        for name, encode in FORMATS:
+            for encoding in ENCODINGS:
+                data, elapsed = timed(lambda: encoder(encode, encoding)(rows))
+                baseline = baseline or len(data)
+                print(f'{count:>9} {name:<9} {encoding:<9} {len(data):>12} '
+                      f'{len(data) / baseline:>7.2f} {elapsed * 1000:>9.2f}')
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [100, 10_000, 100_000])
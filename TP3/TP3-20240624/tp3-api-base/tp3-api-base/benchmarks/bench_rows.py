@@ -0,0 +1,73 @@
+"""
+Compares the row materialization of the original dict_factory with Rows.
+
+Usage: python benchmarks/bench_rows.py [row counts...]
+
+"""
+
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, json  # noqa: E402
+from models import Rows, dict_factory  # noqa: E402
+
+
+def seed(rows):
+    """Creates an in-memory task table with the given number of rows."""
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE task (id INTEGER PRIMARY KEY, project_id INTEGER, '
+                 'title TEXT, creation_date TEXT, completed INTEGER)')
+    conn.executemany('INSERT INTO task (project_id, title, creation_date, completed) '
+                     'VALUES (?, ?, ?, ?)',
+                     ((i % 100, f'Task {i}', '2024-06-28T10:00:00+00:00', i % 2)
+                      for i in range(rows)))
+    return conn
+
+
+def timed(fn):
+    """Returns the best of three runs of fn, in seconds."""
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(counts):
+    app = Flask(__name__)
+    print(f"{'rows':>9} {'factory':>9} {'+jsonify':>9} {'Rows':>9} {'+to_json':>9} {'speedup':>8}")
+    for count in counts:
+        conn = seed(count)
+
+        def factory_fetch():
+            cursor = conn.cursor()
+            cursor.row_factory = dict_factory
+            return cursor.execute('SELECT * FROM task').fetchall()
+
+        def factory_encode():
+            with app.app_context():
+                json.dumps(factory_fetch())
+
+        def rows_fetch():
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM task')
+            return Rows.from_cursor(cursor, cursor.fetchall())
+
+        def rows_encode():
+            rows_fetch().to_json()
+
+        old_fetch, old_total = timed(factory_fetch), timed(factory_encode)
+        new_fetch, new_total = timed(rows_fetch), timed(rows_encode)
+        print(f'{count:>9} {old_fetch:>9.3f} {old_total:>9.3f} {new_fetch:>9.3f} '
+              f'{new_total:>9.3f} {old_total / new_total:>7.2f}x')
+        conn.close()
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10_000, 100_000, 1_000_000])
@@ -0,0 +1,455 @@
+"""
+ Load tests the Tasklists API.
+
+Seeds a database with a configurable volume of users, projects, tasks and
+messages, then drives every API endpoint with a weighted request mix,
+either through app.test_client(), against a real multi-threaded WSGI
+server on localhost, or against the asyncio server of asgi.py. Reports
+throughput and p50/p95/p99 latencies and saves them as JSON so runs can
+be compared across commits.
+
+Usage (from the directory of app.py):
+
+    python benchmarks/load.py --users 100 --projects 10 --tasks 50 \\
+        --messages 100 --driver both --mix read --threads 8 --duration 10
+    python benchmarks/load.py --database /tmp/tasklists.db --pool-size 8 \\
+        --shards 4 --driver server --mix write --threads 16
+    python benchmarks/load.py --compare old.json new.json
+
+"""
+
+import argparse
+import asyncio
+import base64
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Requests as (weight per mix, name, method, path, body). Paths and bodies
+# are callables of the worker's Session, so they target the user's data.
+MIXES = ('read', 'write', 'mixed')
+
+
+def _task_body(session):
+    return {'title': f'Task {random.random()}', 'completed': random.randint(0, 1)}
+
+
+ENDPOINTS = [
+    # read write mixed
+    ((10, 2, 5), 'user_detail GET', 'GET', lambda s: '/api/user/', None),
+    ((15, 3, 8), 'project_list GET', 'GET', lambda s: '/api/projects/', None),
+    ((5, 1, 3), 'project_summary GET', 'GET', lambda s: '/api/projects/summary/', None),
+    ((15, 3, 8), 'project_detail GET', 'GET', lambda s: f'/api/projects/{s.project()}/', None),
+    ((20, 4, 10), 'task_list GET', 'GET', lambda s: f'/api/projects/{s.project()}/tasks/', None),
+    ((15, 3, 8), 'task_detail GET', 'GET',
+     lambda s: '/api/projects/{}/tasks/{}/'.format(*s.task()), None),
+    ((10, 2, 5), 'message_list GET', 'GET', lambda s: '/api/messages/', None),
+    ((5, 1, 3), 'message_detail GET', 'GET', lambda s: f'/api/messages/{s.message()}/', None),
+    ((5, 1, 3), 'search GET', 'GET', lambda s: f'/api/search/?q=task+{s.task()[1]}', None),
+    ((5, 1, 3), 'message_poll GET', 'GET', lambda s: '/api/messages/poll/?timeout=0', None),
+    ((1, 0, 1), 'workspace_export GET', 'GET', lambda s: '/api/export/', None),
+    ((2, 0, 1), 'sync GET', 'GET', lambda s: '/api/sync/?since=0', None),
+    ((2, 10, 6), 'project_list POST', 'POST', lambda s: '/api/projects/',
+     lambda s: {'title': f'Project {random.random()}'}),
+    ((2, 10, 6), 'project_detail PUT', 'PUT', lambda s: f'/api/projects/{s.project()}/',
+     lambda s: {'title': f'Project {random.random()}'}),
+    ((2, 15, 8), 'task_list POST', 'POST', lambda s: f'/api/projects/{s.project()}/tasks/',
+     _task_body),
+    ((1, 10, 5), 'task_detail PUT', 'PUT',
+     lambda s: '/api/projects/{}/tasks/{}/'.format(*s.task()), _task_body),
+    ((1, 15, 8), 'update_task_completed PATCH', 'PATCH',
+     lambda s: f'/api/tasks/{s.task()[1]}/completed/',
+     lambda s: {'completed': random.randint(0, 1)}),
+    ((1, 5, 3), 'task_batch POST', 'POST', lambda s: f'/api/projects/{s.project()}/tasks/batch/',
+     lambda s: [dict(_task_body(s), op='create') for _ in range(10)]),
+    ((1, 10, 5), 'message_list POST', 'POST', lambda s: '/api/messages/',
+     lambda s: {'receiver_id': s.other_user(), 'content': f'Hello {random.random()}'}),
+    ((0, 2, 1), 'task_detail DELETE', 'DELETE',
+     lambda s: '/api/projects/{}/tasks/{}/'.format(*s.task()), None),
+    ((0, 2, 1), 'message_detail DELETE', 'DELETE', lambda s: f'/api/messages/{s.message()}/', None),
+]
+
+
+class Dataset:
+    """Ids of the seeded rows, by user."""
+
+    def __init__(self):
+        self.users = []
+        self.projects = {}
+        self.tasks = {}
+        self.messages = {}
+
+
+def seed(db, users, projects, tasks, messages):
+    """Seeds users x projects x tasks, plus messages per user, on each user's shard."""
+    dataset = Dataset()
+    now = datetime.now(timezone.utc).isoformat()
+    with db.catalog.transaction() as conn:
+        first_user = conn.execute('SELECT COALESCE(MAX(id), 0) + 1 AS id FROM user').fetchone()['id']
+        conn.executemany(
+            'INSERT INTO user (id, name, email, username, password) VALUES (?, ?, ?, ?, ?)',
+            ((first_user + i, f'User {i}', f'user{i}@example.org', f'user{i}', 'secret')
+             for i in range(users)))
+    dataset.users = [(first_user + i, f'user{i}') for i in range(users)]
+    next_ids = {}
+    for user_id, _ in dataset.users:
+        shard = db.for_user(user_id)
+        with shard.transaction() as conn:
+            if shard not in next_ids:
+                next_ids[shard] = [
+                    conn.execute('SELECT COALESCE(MAX(id), 0) + 1 AS id FROM project').fetchone()['id'],
+                    conn.execute('SELECT COALESCE(MAX(id), 0) + 1 AS id FROM task').fetchone()['id'],
+                    # Message ids continue the range reserved to the shard
+                    conn.execute("SELECT MAX(COALESCE(MAX(id), 0), COALESCE((SELECT seq FROM "
+                                 "sqlite_sequence WHERE name='message'), 0)) + 1 AS id "
+                                 "FROM message").fetchone()['id'],
+                ]
+            next_project, next_task, next_message = next_ids[shard]
+            project_ids = list(range(next_project, next_project + projects))
+            next_project += projects
+            conn.executemany(
+                'INSERT INTO project (id, user_id, title, creation_date, last_updated) '
+                'VALUES (?, ?, ?, ?, ?)',
+                ((pid, user_id, f'Project {pid}', now, now) for pid in project_ids))
+            dataset.projects[user_id] = project_ids
+            task_ids = []
+            for pid in project_ids:
+                conn.executemany(
+                    'INSERT INTO task (id, project_id, title, creation_date, completed) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    ((next_task + i, pid, f'Task {next_task + i}', now, i % 2)
+                     for i in range(tasks)))
+                task_ids.extend((pid, next_task + i) for i in range(tasks))
+                next_task += tasks
+            dataset.tasks[user_id] = task_ids
+            message_ids = list(range(next_message, next_message + messages))
+            next_message += messages
+            conn.executemany(
+                'INSERT INTO message (id, sender_id, receiver_id, content, timestamp) '
+                'VALUES (?, ?, ?, ?, ?)',
+                ((mid, random.choice(dataset.users)[0], user_id, f'Message {mid}', now)
+                 for mid in message_ids))
+            dataset.messages[user_id] = message_ids
+            next_ids[shard] = [next_project, next_task, next_message]
+    return dataset
+
+
+class Session:
+    """A simulated client logged in as one seeded user."""
+
+    def __init__(self, dataset, user_id, username, token=None):
+        self.dataset = dataset
+        self.user_id = user_id
+        if token:
+            authorization = f'Bearer {token}'
+        else:
+            authorization = 'Basic ' + base64.b64encode(f'{username}:secret'.encode()).decode()
+        self.headers = {'Authorization': authorization, 'Content-Type': 'application/json'}
+
+    def project(self):
+        return random.choice(self.dataset.projects[self.user_id] or [0])
+
+    def task(self):
+        return random.choice(self.dataset.tasks[self.user_id] or [(0, 0)])
+
+    def message(self):
+        return random.choice(self.dataset.messages[self.user_id] or [0])
+
+    def other_user(self):
+        return random.choice(self.dataset.users)[0]
+
+
+class TestClientDriver:
+    """Sends requests through Flask's test client."""
+
+    name = 'test_client'
+
+    def __init__(self, app):
+        self.app = app
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def connect(self):
+        client = self.app.test_client()
+
+        def send(method, path, body, headers):
+            res = client.open(path, method=method, headers=headers,
+                              data=None if body is None else json.dumps(body))
+            res.get_data()
+            return res.status_code
+        return send
+
+
+class ServerDriver:
+    """Sends requests over HTTP to a threaded WSGI server on localhost."""
+
+    name = 'server'
+
+    def __init__(self, app):
+        self.app = app
+        self.server = None
+
+    def start(self):
+        from werkzeug.serving import make_server
+        self.server = make_server('127.0.0.1', 0, self.app, threaded=True)
+        self.port = self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+    def connect(self):
+        port = self.port
+        state = {}
+
+        def send(method, path, body, headers):
+            for attempt in range(2):
+                conn = state.get('conn')
+                if conn is None:
+                    conn = state['conn'] = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                try:
+                    conn.request(method, path, body=None if body is None else json.dumps(body),
+                                 headers=headers)
+                    res = conn.getresponse()
+                    res.read()
+                    if res.getheader('Connection', '').lower() == 'close':
+                        conn.close()
+                        state['conn'] = None
+                    return res.status
+                except (http.client.HTTPException, OSError):
+                    conn.close()
+                    state['conn'] = None
+                    if attempt:
+                        raise
+        return send
+
+
+class AsyncServerDriver(ServerDriver):
+    """Sends requests over HTTP to the asyncio server of asgi.py on localhost."""
+
+    name = 'asyncio'
+
+    def start(self):
+        from asgi import ASGIApp, HTTPServer
+        self.loop = asyncio.new_event_loop()
+        self.server = HTTPServer(ASGIApp(self.app), port=0)
+        self.loop.run_until_complete(self.server.start())
+        self.port = self.server.port
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.server.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.server.app.executor.shutdown()
+
+
+def percentile(sorted_values, pct):
+    """Returns the pct percentile of sorted values (nearest rank)."""
+    if not sorted_values:
+        return None
+    idx = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[idx]
+
+
+def summarize(latencies, errors, elapsed):
+    """Summarizes latencies (in seconds) as throughput and percentiles in ms."""
+    values = sorted(latencies)
+    return {
+        'requests': len(values),
+        'errors': errors,
+        'throughput': len(values) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(values, 50) * 1000 if values else None,
+        'p95_ms': percentile(values, 95) * 1000 if values else None,
+        'p99_ms': percentile(values, 99) * 1000 if values else None,
+        'max_ms': values[-1] * 1000 if values else None,
+    }
+
+
+def run(driver, dataset, mix, threads, duration, requests, issue_token=None):
+    """
+    Drives the endpoints with the given mix and returns the summary.
+    Sessions use Basic credentials, or bearer tokens from issue_token(user_id).
+    """
+    weights = [weights[MIXES.index(mix)] for weights, *_ in ENDPOINTS]
+    per_endpoint = {name: [] for _, name, *_ in ENDPOINTS}
+    failures = {name: 0 for _, name, *_ in ENDPOINTS}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+    budget = [requests]
+
+    def worker(n):
+        user_id, username = dataset.users[n % len(dataset.users)]
+        session = Session(dataset, user_id, username,
+                          issue_token(user_id) if issue_token else None)
+        send = driver.connect()
+        samples = []
+        errors = {}
+        while time.perf_counter() < deadline:
+            if requests:
+                with lock:
+                    if budget[0] <= 0:
+                        break
+                    budget[0] -= 1
+            _, name, method, path, body = random.choices(ENDPOINTS, weights)[0]
+            start = time.perf_counter()
+            try:
+                status = send(method, path(session), body(session) if body else None,
+                              session.headers)
+            except Exception:
+                status = 599
+            samples.append((name, time.perf_counter() - start))
+            if status >= 500:
+                errors[name] = errors.get(name, 0) + 1
+        with lock:
+            for name, latency in samples:
+                per_endpoint[name].append(latency)
+            for name, count in errors.items():
+                failures[name] += count
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    overall = [latency for latencies in per_endpoint.values() for latency in latencies]
+    return {
+        'elapsed': elapsed,
+        'overall': summarize(overall, sum(failures.values()), elapsed),
+        'endpoints': {name: summarize(latencies, failures[name], elapsed)
+                      for name, latencies in per_endpoint.items() if latencies},
+    }
+
+
+def git_commit():
+    """Returns the current commit, if any."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report):
+    for driver, mixes in report['results'].items():
+        for mix, result in mixes.items():
+            overall = result['overall']
+            print(f"\n{driver} / {mix}: {overall['requests']} requests in "
+                  f"{result['elapsed']:.2f}s, {overall['throughput']:.1f} req/s, "
+                  f"{overall['errors']} errors")
+            print(f"  {'endpoint':<30} {'req':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+            for name, stats in sorted(result['endpoints'].items()):
+                print(f"  {name:<30} {stats['requests']:>7} {stats['p50_ms']:>8.2f} "
+                      f"{stats['p95_ms']:>8.2f} {stats['p99_ms']:>8.2f}")
+
+
+def compare(old_path, new_path):
+    """Prints the change in throughput and latency between two result files."""
+    with open(old_path) as fin:
+        old = json.load(fin)
+    with open(new_path) as fin:
+        new = json.load(fin)
+    print(f"{old.get('commit')} -> {new.get('commit')}")
+    for driver, mixes in new['results'].items():
+        for mix, result in mixes.items():
+            before = old['results'].get(driver, {}).get(mix)
+            if not before:
+                continue
+            for key in ('throughput', 'p50_ms', 'p95_ms', 'p99_ms'):
+                a, b = before['overall'][key], result['overall'][key]
+                if a and b is not None:
+                    print(f'{driver:<12} {mix:<6} {key:<10} {a:>10.2f} -> {b:>10.2f} '
+                          f'({(b - a) / a * 100:+.1f}%)')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--projects', type=int, default=5, help='projects per user')
+    parser.add_argument('--tasks', type=int, default=20, help='tasks per project')
+    parser.add_argument('--messages', type=int, default=20, help='messages per user')
+    parser.add_argument('--driver', choices=('test_client', 'server', 'asyncio', 'both', 'all'), default='both')
+    parser.add_argument('--mix', choices=MIXES + ('all',), default='all')
+    parser.add_argument('--auth', choices=('basic', 'bearer'), default='basic')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per run')
+    parser.add_argument('--requests', type=int, default=0,
+                        help='stop each run after this many requests (0: no limit)')
+    parser.add_argument('--database', help='SQLite file to use instead of memory')
+    parser.add_argument('--pool-size', type=int, default=0)
+    parser.add_argument('--shards', type=int, default=0,
+                        help='spread users over this many databases (0: no sharding)')
+    parser.add_argument('--rate-limit', action='store_true',
+                        help='keep the per-user rate limits (off, since few users are driven flat out)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--output', help='JSON file for the results')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files and exit')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    random.seed(args.seed)
+    os.chdir(ROOT)
+    if args.database:
+        os.environ['TASKLISTS_DATABASE'] = args.database
+        os.environ['TASKLISTS_POOL_SIZE'] = str(args.pool_size)
+    if args.shards:
+        os.environ['TASKLISTS_SHARDS'] = str(args.shards)
+    os.environ['TASKLISTS_RATE_LIMIT'] = '1' if args.rate_limit else '0'
+    import app as app_module
+    app_module.app.config['DEBUG'] = False
+    app_module.db.recreate()
+    dataset = seed(app_module.db, args.users, args.projects, args.tasks, args.messages)
+
+    drivers = {'test_client': [TestClientDriver], 'server': [ServerDriver],
+               'asyncio': [AsyncServerDriver], 'both': [TestClientDriver, ServerDriver],
+               'all': [TestClientDriver, ServerDriver, AsyncServerDriver]}[args.driver]
+    mixes = MIXES if args.mix == 'all' else (args.mix,)
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'config': {key: value for key, value in vars(args).items() if key != 'compare'},
+        'results': {},
+    }
+    for driver_class in drivers:
+        driver = driver_class(app_module.app)
+        driver.start()
+        try:
+            for mix in mixes:
+                result = run(driver, dataset, mix, args.threads, args.duration, args.requests,
+                             app_module.token_signer.issue if args.auth == 'bearer' else None)
+                report['results'].setdefault(driver.name, {})[mix] = result
+        finally:
+            driver.stop()
+
+    print_report(report)
+    output = args.output or os.path.join(
+        ROOT, 'benchmarks', 'results',
+        f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{report['commit'] or 'nocommit'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as fout:
+        json.dump(report, fout, indent=2)
+    print(f'\nResults saved to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+ Implements a small in-process cache with size and time limits.
+
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire after a fixed time.
+
+    Invalidations are numbered, so that a value loaded before one can be
+    refused: take generation() before loading and pass it to set(). The
+    last maxsize invalidated keys are remembered; older ones, and every
+    invalidate_where() or clear(), refuse all values loaded before them.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60.0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._invalidated = OrderedDict()
+        self._floor = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Returns the value stored for key, or default if missing or expired."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires > self.clock():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def generation(self):
+        """Returns the token to pass to set() for a value about to be loaded."""
+        with self._lock:
+            return self._generation
+
+    def set(self, key, value, generation=None):
+        """
+        Stores value for key, evicting the least recently used entries.
+        With a generation, the value is dropped if key was invalidated
+        since, as it may have been loaded before the write that did it.
+        Returns whether the value was stored.
+        """
+        with self._lock:
+            if generation is not None and (self._floor > generation or
+                                           self._invalidated.get(key, 0) > generation):
+                return False
+            self._data[key] = (value, self.clock() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, key):
+        """Removes key from the cache."""
+        with self._lock:
+            self._data.pop(key, None)
+            self._generation += 1
+            self._invalidated.pop(key, None)
+            self._invalidated[key] = self._generation
+            while len(self._invalidated) > self.maxsize:
+                self._floor = max(self._floor, self._invalidated.popitem(last=False)[1])
+
+    def invalidate_where(self, predicate):
+        """Removes every entry whose key satisfies predicate."""
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+            self._generation += 1
+            self._floor = self._generation
+
+    def clear(self):
+        """Removes every entry and resets the counters."""
+        with self._lock:
+            self._data.clear()
+            self._generation += 1
+            self._floor = self._generation
+            self._invalidated.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Returns the cache counters."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / total if total else 0.0,
+            }
@@ -0,0 +1,136 @@
+"""
+ Implements a MessagePack encoder and the compression of responses.
+
+"""
+
+import struct
+import zlib
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - the local encoder is used instead
+    msgpack = None
+
+_pack_double = struct.Struct('>Bd').pack
+
+
+def _pack_int(value):
+    if 0 <= value < 0x80:
+        return bytes((value,))
+    if -0x20 <= value < 0:
+        return bytes((value & 0xff,))
+    if value >= 0:
+        for code, fmt, limit in ((0xcc, '>BB', 0xff), (0xcd, '>BH', 0xffff),
+                                 (0xce, '>BI', 0xffffffff), (0xcf, '>BQ', 0xffffffffffffffff)):
+            if value <= limit:
+                return struct.pack(fmt, code, value)
+    else:
+        for code, fmt, limit in ((0xd0, '>Bb', 0x80), (0xd1, '>Bh', 0x8000),
+                                 (0xd2, '>Bi', 0x80000000), (0xd3, '>Bq', 0x8000000000000000)):
+            if -value <= limit:
+                return struct.pack(fmt, code, value)
+    raise OverflowError(f'Integer out of MessagePack range: {value}')
+
+
+def _header(size, fix, fix_limit, codes):
+    """Returns the header of a string, binary, array or map of size items."""
+    if fix is not None and size < fix_limit:
+        return bytes((fix | size,))
+    for code, fmt, limit in zip(codes, ('>BB', '>BH', '>BI'), (0xff, 0xffff, 0xffffffff)):
+        if code is not None and size <= limit:
+            return struct.pack(fmt, code, size)
+    raise OverflowError(f'Too many items for MessagePack: {size}')
+
+
+def _pack_str(value):
+    data = value.encode('utf-8')
+    if len(data) < 32:
+        return _FIXSTR[len(data)] + data
+    return _header(len(data), 0xa0, 32, (0xd9, 0xda, 0xdb)) + data
+
+
+_FIXSTR = [bytes((0xa0 | size,)) for size in range(32)]
+
+
+def array_header(size):
+    """Returns the header of a MessagePack array of size items."""
+    return _header(size, 0x90, 16, (None, 0xdc, 0xdd))
+
+
+def map_header(size):
+    """Returns the header of a MessagePack map of size pairs."""
+    return _header(size, 0x80, 16, (None, 0xde, 0xdf))
+
+
+def _pack_local(obj):
+    """Encodes obj as MessagePack (None, bools, ints, floats, strings, bytes, lists and dicts)."""
+    if obj is None:
+        return b'\xc0'
+    if obj is True:
+        return b'\xc3'
+    if obj is False:
+        return b'\xc2'
+    if isinstance(obj, int):
+        return _pack_int(obj)
+    if isinstance(obj, float):
+        return _pack_double(0xcb, obj)
+    if isinstance(obj, str):
+        return _pack_str(obj)
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return _header(len(obj), None, 0, (0xc4, 0xc5, 0xc6)) + bytes(obj)
+    if isinstance(obj, (list, tuple)):
+        return array_header(len(obj)) + b''.join(map(_pack_local, obj))
+    if isinstance(obj, dict):
+        return map_header(len(obj)) + b''.join(
+            _pack_local(key) + _pack_local(value) for key, value in obj.items())
+    raise TypeError(f'Cannot encode {type(obj).__name__} as MessagePack')
+
+
+packb = msgpack.packb if msgpack is not None else _pack_local
+
+
+def pack_column(values):
+    """Encodes each value of a column, with faster paths for columns of a single type."""
+    if msgpack is None:
+        types = set(map(type, values))
+        if types <= {int}:
+            # Small ids and flags repeat, so their encodings are reused
+            cache = {}
+            return [cache[value] if value in cache else cache.setdefault(value, _pack_int(value))
+                    for value in values]
+        if types <= {str}:
+            return list(map(_pack_str, values))
+    return list(map(packb, values))
+
+
+# Media types worth compressing
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'application/msgpack',
+                'application/x-msgpack', 'application/vnd.tasklists.columns+json', 'text/plain')
+
+# zlib window bits of each content coding
+_WBITS = {'gzip': 31, 'deflate': 15}
+
+
+def compress(data, encoding, level=6):
+    """Compresses data with the gzip or deflate (zlib) content coding."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _WBITS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_chunks(chunks, encoding, level=6):
+    """
+    Compresses an iterable of chunks as they come. Each chunk is flushed so
+    that streamed rows reach the client without waiting for the next ones.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _WBITS[encoding])
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
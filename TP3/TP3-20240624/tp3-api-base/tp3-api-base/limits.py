@@ -0,0 +1,146 @@
+"""
+ Implements per-client rate limiting and load shedding.
+
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+def parse_budgets(text):
+    """
+    Parses budgets written as 'name=rate:burst,...', e.g.
+    'default=50:100,project_list=20:50', into a dict of (rate, burst).
+    """
+    budgets = {}
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        name, _, value = item.partition('=')
+        rate, _, burst = value.partition(':')
+        budgets[name.strip()] = (float(rate), int(burst or max(1, math.ceil(float(rate)))))
+    return budgets
+
+
+class RateLimiter:
+    """Token buckets per client and budget.
+
+    budgets maps a budget name to (rate, burst): each bucket holds up to
+    burst tokens and refills at rate tokens per second, and every request
+    takes one. The least recently used buckets are dropped beyond maxsize;
+    a dropped bucket comes back full.
+    """
+
+    def __init__(self, budgets, maxsize=100000, clock=time.monotonic):
+        self.budgets = budgets
+        self.maxsize = maxsize
+        self._clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+
+    def acquire(self, key, budget):
+        """
+        Takes a token from the bucket of key under budget. Returns 0 if one
+        was available, or else the seconds until one will be.
+        """
+        rate, burst = self.budgets[budget]
+        now = self._clock()
+        with self._lock:
+            tokens, updated = self._buckets.pop((key, budget), (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+                self.allowed += 1
+            else:
+                wait = (1 - tokens) / rate
+                self.limited += 1
+            self._buckets[(key, budget)] = (tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        """Refills every bucket and resets the counters."""
+        with self._lock:
+            self._buckets.clear()
+            self.allowed = self.limited = 0
+
+    def stats(self):
+        with self._lock:
+            return {'buckets': len(self._buckets), 'allowed': self.allowed,
+                    'limited': self.limited}
+
+
+class AdmissionController:
+    """Rejects requests early while the server is overloaded.
+
+    A request is admitted unless max_in_flight requests are already being
+    handled, or the recent time spent waiting for database connections and
+    the write lock exceeds max_wait seconds. Recent waits are averaged
+    with a weight that halves every half_life seconds, so that an idle or
+    shedding server recovers. A limit of 0 is not enforced.
+    """
+
+    def __init__(self, max_in_flight=0, max_wait=0.0, half_life=1.0, clock=time.monotonic):
+        self.max_in_flight = max_in_flight
+        self.max_wait = max_wait
+        self.half_life = half_life
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._wait = 0.0
+        self._updated = clock()
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed = 0
+
+    def _decayed_wait(self, now):
+        return self._wait * math.pow(0.5, (now - self._updated) / self.half_life)
+
+    def observe_wait(self, seconds):
+        """Records the time a request waited for the database."""
+        with self._lock:
+            now = self._clock()
+            decay = math.pow(0.5, (now - self._updated) / self.half_life)
+            # Moves the average a quarter of the way to the new wait
+            self._wait = self._wait * decay + (seconds - self._wait * decay) / 4
+            self._updated = now
+
+    def recent_wait(self):
+        """Returns the recent average database wait, in seconds."""
+        with self._lock:
+            return self._decayed_wait(self._clock())
+
+    def enter(self, counted=True):
+        """
+        Admits a request, or returns False if it should be shed. Admitted
+        requests that are counted must call leave() when they are done.
+        """
+        with self._lock:
+            overloaded = ((self.max_in_flight and self.in_flight >= self.max_in_flight) or
+                          (self.max_wait and self._decayed_wait(self._clock()) > self.max_wait))
+            if overloaded:
+                self.shed += 1
+                return False
+            if counted:
+                self.in_flight += 1
+            self.admitted += 1
+            return True
+
+    def leave(self):
+        """Stops counting a request admitted by enter()."""
+        with self._lock:
+            self.in_flight -= 1
+
+    def clear(self):
+        """Forgets recent waits and resets the counters (not the requests in flight)."""
+        with self._lock:
+            self._wait = 0.0
+            self.admitted = self.shed = 0
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': self.in_flight, 'recent_wait': self._decayed_wait(self._clock()),
+                    'admitted': self.admitted, 'shed': self.shed}
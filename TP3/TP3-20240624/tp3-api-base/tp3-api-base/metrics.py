@@ -0,0 +1,186 @@
+"""
+ Implements in-process metrics rendered in the Prometheus text format.
+
+"""
+
+import bisect
+import logging
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """Monotonic counter with labels."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, _labels(self.labels, key), value) for key, value in values]
+
+
+class Gauge(Counter):
+    """Value that can go up and down."""
+
+    kind = 'gauge'
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+    def set(self, labels=(), value=0):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram:
+    """Distribution of observed values over fixed buckets, with labels."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][idx] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, labels=()):
+        series = self._values.get(labels)
+        return series[2] if series else 0
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total, count)
+                      for key, (counts, total, count) in self._values.items()]
+        samples = []
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket
+                samples.append((f'{self.name}_bucket',
+                                _labels(self.labels, key, [('le', bound)]), cumulative))
+            samples.append((f'{self.name}_sum', _labels(self.labels, key), total))
+            samples.append((f'{self.name}_count', _labels(self.labels, key), count))
+        return samples
+
+
+class Collector:
+    """Reports values computed when the metrics are rendered."""
+
+    def __init__(self, name, documentation, kind, labels, collect):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labels = labels
+        self.collect = collect
+
+    def samples(self):
+        return [(self.name, _labels(self.labels, key), value) for key, value in self.collect()]
+
+
+class Registry:
+    """Set of metrics rendered together."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Renders every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class DatabaseObserver:
+    """Records the queries and waits reported by a models.Database.
+
+    Statements taking at least slow_query_seconds are also logged, and
+    waits are also passed to on_wait(seconds) if given.
+    """
+
+    _whitespace = re.compile(r'\s+')
+
+    def __init__(self, registry, slow_query_seconds=None, on_wait=None):
+        self.slow_query_seconds = slow_query_seconds
+        self.on_wait = on_wait
+        self.query_duration = registry.register(Histogram(
+            'tasklists_db_query_duration_seconds', 'Time spent executing SQL statements.',
+            ('statement',)))
+        self.rows = registry.register(Counter(
+            'tasklists_db_rows_total', 'Rows returned or changed by SQL statements.',
+            ('statement',)))
+        self.wait_duration = registry.register(Histogram(
+            'tasklists_db_wait_seconds', 'Time spent waiting for a connection or the write lock.',
+            ('kind',)))
+        self._statements = {}
+
+    def statement(self, stmt):
+        """Returns the statement normalized as a label."""
+        label = self._statements.get(stmt)
+        if label is None:
+            label = self._statements[stmt] = self._whitespace.sub(' ', stmt).strip()
+        return label
+
+    def observe_query(self, stmt, seconds):
+        label = self.statement(stmt)
+        self.query_duration.observe((label,), seconds)
+        if self.slow_query_seconds is not None and seconds >= self.slow_query_seconds:
+            logger.warning('Slow query (%.1f ms): %s', seconds * 1000, label)
+
+    def observe_rows(self, stmt, count):
+        if count > 0:
+            self.rows.inc((self.statement(stmt),), count)
+
+    def observe_wait(self, kind, seconds):
+        self.wait_duration.observe((kind,), seconds)
+        if self.on_wait is not None:
+            self.on_wait(seconds)
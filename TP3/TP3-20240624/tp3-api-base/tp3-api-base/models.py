@@ -3,41 +3,975 @@
 
 """
 
+import hashlib
+import itertools
+import json
+import logging
+import os
+import queue
 import sqlite3
+import threading
+import time
+from json.encoder import encode_basestring_ascii
+from contextlib import contextmanager, nullcontext
+
+from formats import array_header, map_header, pack_column, packb
+
+logger = logging.getLogger(__name__)
+
+
+def dict_factory(cursor, row):
+    """Converts table row to dictionary."""
+    res = {}
+    for idx, col in enumerate(cursor.description):
+        res[col[0]] = row[idx]
+    return res
+
+
+class Rows:
+    """Rows of a query kept as tuples, with the column names resolved once.
+
+    Rows are only turned into dictionaries when they are iterated. They are
+    encoded to JSON or MessagePack column by column, straight from the tuples.
+    """
+
+    __slots__ = ('columns', 'rows')
+
+    _encode = json.JSONEncoder(separators=(',', ':')).encode
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+
+    @classmethod
+    def from_cursor(cls, cursor, rows):
+        return cls(tuple(col[0] for col in cursor.description or ()), rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        columns = self.columns
+        return (dict(zip(columns, row)) for row in self.rows)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return Rows(self.columns, self.rows[idx])
+        return dict(zip(self.columns, self.rows[idx]))
+
+    def value(self, idx, column):
+        """Returns a single column of a row."""
+        return self.rows[idx][self.columns.index(column)]
+
+    def to_list(self):
+        """Returns the rows as a list of dictionaries."""
+        columns = self.columns
+        return [dict(zip(columns, row)) for row in self.rows]
+
+    def _values(self):
+        """Encodes the values of each column as JSON."""
+        encode = self._encode
+        values = []
+        for column in zip(*self.rows):
+            types = set(map(type, column))
+            if types <= {int}:
+                values.append(map(int.__repr__, column))
+            elif types <= {str}:
+                values.append(map(encode_basestring_ascii, column))
+            else:
+                values.append(map(encode, column))
+        return zip(*values)
+
+    def _objects(self):
+        """Encodes each row as a JSON object."""
+        template = '{' + ','.join([self._encode(col) + ':%s' for col in self.columns]) + '}'
+        return map(template.__mod__, self._values())
+
+    def to_json(self):
+        """Encodes the rows as a JSON array of objects."""
+        return '[' + ','.join(self._objects()) + ']'
+
+    def to_ndjson(self):
+        """Encodes the rows as newline delimited JSON objects."""
+        if not self.rows:
+            return ''
+        return '\n'.join(self._objects()) + '\n'
+
+    def to_columns_json(self):
+        """Encodes the rows as a JSON object of column names and rows as arrays."""
+        template = '[' + ','.join(['%s'] * len(self.columns)) + ']'
+        return ('{"columns":' + self._encode(list(self.columns)) + ',"rows":['
+                + ','.join(map(template.__mod__, self._values())) + ']}')
+
+    def to_msgpack(self):
+        """Encodes the rows as a MessagePack array of maps."""
+        header = map_header(len(self.columns))
+        keys = [packb(col) for col in self.columns]
+        values = zip(*map(pack_column, zip(*self.rows)))
+        return array_header(len(self.rows)) + b''.join(
+            header + b''.join(map(bytes.__add__, keys, row)) for row in values)
+
+
+class ObservedCursor(sqlite3.Cursor):
+    """Cursor that reports the rows it fetches to a database observer."""
+
+    observer = None
+    stmt = None
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self.observer.observe_rows(self.stmt, 1)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = super().fetchmany(*args, **kwargs)
+        self.observer.observe_rows(self.stmt, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self.observer.observe_rows(self.stmt, len(rows))
+        return rows
+
+
+class FetchedCursor:
+    """The rows of an executed cursor, fetched at once and read like a cursor."""
+
+    def __init__(self, cursor):
+        self.description = cursor.description
+        self.rowcount = cursor.rowcount
+        self.lastrowid = cursor.lastrowid
+        self._rows = iter(cursor.fetchall())
+        cursor.close()
+
+    def __iter__(self):
+        return self._rows
+
+    def fetchone(self):
+        return next(self._rows, None)
+
+    def fetchmany(self, size=1):
+        return list(itertools.islice(self._rows, size))
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def close(self):
+        self._rows = iter(())
+
+
+# Databases created from each schema file, keyed by (path, modification time)
+_baselines = {}
+_baselines_lock = threading.Lock()
+
+
+def baseline(schema):
+    """
+    Returns an in-memory database created from a schema file. It is only
+    built once per version of the file, and copied by Database.recreate().
+    """
+    key = (os.path.abspath(schema), os.stat(schema).st_mtime_ns)
+    with _baselines_lock:
+        conn = _baselines.get(key)
+        if conn is None:
+            conn = sqlite3.connect(':memory:', check_same_thread=False)
+            with open(schema) as fin:
+                conn.executescript(fin.read())
+            _baselines[key] = conn
+        return conn
+
+
+def schema_version(schema):
+    """Returns the version of a schema file, as set by its PRAGMA user_version."""
+    conn = baseline(schema)
+    with _baselines_lock:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection becomes available in time."""
+
+
+class SchemaVersionError(Exception):
+    """Raised when a database was created from another version of the schema."""
+
+
+class GroupCommitter:
+    """Commits the statements of many writers in batches.
+
+    Writers queue a job and a writer thread runs the queued jobs on its own
+    connection, each inside a savepoint so a failing job only rolls back
+    itself, and commits them together once max_batch jobs are queued or
+    max_wait seconds have passed. With wait_for_commit, writers return once
+    their job is committed; otherwise they return as soon as it has run,
+    and a crash before the commit may lose it.
+    """
+
+    def __init__(self, conn, max_batch=64, max_wait=0.002, wait_for_commit=True):
+        self.conn = conn
+        self.conn.isolation_level = None
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.wait_for_commit = wait_for_commit
+        self.commits = 0
+        self.jobs = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+        self._thread.start()
+
+    def submit(self, fn):
+        """Queues fn(cursor) and returns its result once it is done."""
+        job = _Job(fn)
+        self._queue.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def close(self):
+        """Commits the queued jobs and stops the writer thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self):
+        """Waits for a job and collects the ones queued after it."""
+        job = self._queue.get()
+        if job is None:
+            return None
+        batch = [job]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                job = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is None:
+                self._queue.put(None)
+                break
+            batch.append(job)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self._apply(batch)
+            except Exception as exc:
+                # Keep the writer alive: its death would hang every later submit
+                logger.exception('Group commit writer failed')
+                self._rollback()
+                for job in batch:
+                    job.finish(error=exc)
+
+    def _rollback(self):
+        """Rolls back the open transaction, if SQLite has not done so already."""
+        if not self.conn.in_transaction:
+            return
+        try:
+            self.conn.execute('ROLLBACK')
+        except sqlite3.Error:
+            logger.exception('Group commit rollback failed')
+
+    def _apply(self, batch):
+        """Runs a batch of jobs in one transaction."""
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+        except sqlite3.Error as exc:
+            for job in batch:
+                job.finish(error=exc)
+            cursor.close()
+            return
+        executed = []
+        try:
+            for job in batch:
+                cursor.execute('SAVEPOINT job')
+                try:
+                    job.result = job.fn(cursor)
+                except Exception as exc:
+                    cursor.execute('ROLLBACK TO job')
+                    cursor.execute('RELEASE job')
+                    job.finish(error=exc)
+                    continue
+                cursor.execute('RELEASE job')
+                executed.append(job)
+                if not self.wait_for_commit:
+                    job.finish()
+            cursor.execute('COMMIT')
+        except sqlite3.Error as exc:
+            # SQLite may already have rolled the whole transaction back (a full
+            # disk, an I/O error), which also fails the savepoint statements
+            logger.error('Group commit of %d jobs failed: %s', len(batch), exc)
+            self._rollback()
+            for job in batch:
+                job.finish(error=exc)
+        else:
+            self.commits += 1
+            self.jobs += len(batch)
+            for job in executed:
+                job.finish()
+        finally:
+            cursor.close()
+
+
+class _Job:
+    """Work queued for a GroupCommitter."""
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self, error=None):
+        if self.done.is_set():
+            return
+        self.error = error
+        self.done.set()
 
 
 class Database:
-    """Database connectivity."""
+    """Database connectivity.
+
+    By default a single connection is shared by every thread, which take
+    turns on it: an open transaction keeps the others' reads and writes
+    out until it ends, so none sees uncommitted rows. With a
+    pool_size, each thread checks out its own connection from a bounded
+    pool of connections to a file-backed database in WAL journal mode, so
+    readers do not block the writer. Checked out connections stay bound to
+    the thread until release() is called.
 
-    def __init__(self, filename, schema):
+    With group_commit, writes are handed to a GroupCommitter that commits
+    them in batches instead of once per statement.
+
+    An observer, if given, is told how long each statement takes
+    (observe_query), how many rows it returns or changes (observe_rows) and
+    how long callers wait for a pooled connection or the write lock
+    (observe_wait).
+
+    A single database holds every user, so the routing methods of
+    ShardedDatabase (catalog, for_user, for_message, route) all resolve
+    to itself.
+    """
+
+    def __init__(self, filename, schema, pool_size=0, pool_timeout=30.0,
+                 busy_timeout=5000, synchronous='NORMAL', cache_size=-2000,
+                 journal_mode='WAL', group_commit=False, commit_batch_size=64,
+                 commit_max_wait=0.002, wait_for_commit=True, observer=None):
         self.filename = filename
         self.schema = schema
-        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.busy_timeout = busy_timeout
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.journal_mode = journal_mode
+        self.observer = observer
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._tx_lock = threading.RLock()
+        self._connections = []
+        self._pooled = 0
+        if pool_size:
+            if self.in_memory:
+                raise ValueError('A pooled database must be file-backed')
+            self._pool = queue.LifoQueue()
+            self._shared = None
+        else:
+            self._pool = None
+            self._shared = self._connect()
+        if group_commit:
+            if self.in_memory:
+                raise ValueError('Group commit needs a file-backed database')
+            self._commit_options = dict(max_batch=commit_batch_size, max_wait=commit_max_wait,
+                                        wait_for_commit=wait_for_commit)
+            self._committer = GroupCommitter(self._connect(), **self._commit_options)
+        else:
+            self._committer = None
+
+    @property
+    def in_memory(self):
+        """Whether the database lives in memory."""
+        return self.filename == ':memory:' or self.filename.startswith('file::memory:')
 
-        def dict_factory(cursor, row):
-            """Converts table row to dictionary."""
-            res = {}
-            for idx, col in enumerate(cursor.description):
-                res[col[0]] = row[idx]
-            return res
+    @property
+    def catalog(self):
+        """Returns the database holding the users."""
+        return self
 
-        self.conn.row_factory = dict_factory
+    def for_user(self, user_id):
+        """Returns the database holding the data of a user."""
+        return self
+
+    def for_message(self, message_id):
+        """Returns the database holding a message."""
+        return self
+
+    def route(self, user_id):
+        """Routes the statements of the current thread to the data of a user."""
+
+    @property
+    def conn(self):
+        """Returns the connection bound to the current thread."""
+        if self._pool is None:
+            return self._shared
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._acquire()
+        return conn
+
+    def _connect(self):
+        """Opens a new connection and applies the configured pragmas."""
+        conn = sqlite3.connect(self.filename, check_same_thread=False,
+                               timeout=self.busy_timeout / 1000)
+        conn.row_factory = dict_factory
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout)}')
+        conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        conn.execute(f'PRAGMA cache_size={int(self.cache_size)}')
+        if not self.in_memory:
+            conn.execute(f'PRAGMA journal_mode={self.journal_mode}')
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def _acquire(self):
+        """Checks out a connection from the pool, opening one if allowed."""
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = self._pooled < self.pool_size
+            if can_open:
+                self._pooled += 1
+        if can_open:
+            return self._connect()
+        start = time.perf_counter()
+        try:
+            return self._pool.get(timeout=self.pool_timeout)
+        except queue.Empty:
+            raise PoolTimeout(f'No connection available after {self.pool_timeout}s')
+        finally:
+            if self.observer is not None:
+                self.observer.observe_wait('pool', time.perf_counter() - start)
+
+    def release(self):
+        """Returns the connection bound to the current thread to the pool."""
+        if self._pool is None:
+            return
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            return
+        self._local.conn = None
+        self._checkin(conn)
+
+    def _checkin(self, conn):
+        """Returns a checked out connection to the pool."""
+        if conn.in_transaction:
+            conn.rollback()
+        self._pool.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Binds a connection to the current thread for the duration of the block."""
+        bound = self._pool is None or getattr(self._local, 'conn', None) is not None
+        try:
+            yield self.conn
+        finally:
+            if not bound:
+                self.release()
+
+    @contextmanager
+    def checkout(self):
+        """
+        Checks out a connection for the duration of the block without binding
+        it to the current thread, so that a generator holding it can be
+        resumed from any thread. Uses the connection bound to the current
+        thread, if any.
+        """
+        conn = self._shared if self._pool is None else getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._checkin(conn)
+
+    def close(self):
+        """Closes every connection opened by this database."""
+        if self._committer is not None:
+            self._committer.close()
+            self._committer = None
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+        if self._pool is not None:
+            self._pool = queue.LifoQueue()
+            self._pooled = 0
 
     def recreate(self):
-        """Recreates the database from the schema file."""
-        with open(self.schema) as fin:
-            self.conn.cursor().executescript(fin.read())
+        """
+        Recreates the database from the schema file, by copying a baseline
+        built from it once rather than running the script again.
+        """
+        self.restore(baseline(self.schema))
+
+    def snapshot(self):
+        """Returns an in-memory copy of the database, to be passed to restore()."""
+        copy = sqlite3.connect(':memory:', check_same_thread=False)
+        with self.connection() as conn, self._shared_lock():
+            conn.backup(copy)
+        return copy
+
+    def restore(self, snapshot):
+        """
+        Replaces the whole database with a snapshot. Version stamps are drawn
+        again, as after running the schema, so that ETags do not repeat.
+        """
+        conn = self.conn
+        with self._shared_lock(), _baselines_lock:
+            snapshot.backup(conn)
+            conn.execute('UPDATE version_stamp SET version = abs(random() % 1000000000)')
+            conn.commit()
+        self._reopen_connections()
+
+    def _reopen_connections(self):
+        """
+        Closes the idle pooled connections and restarts the group committer
+        on a new connection. After a restore, they would keep using the
+        schema they cached before, as the backup also copies the schema
+        cookie that tells them to reload it. Connections checked out by
+        other threads must not be in use during a restore.
+        """
+        stale = []
+        if self._pool is not None:
+            while True:
+                try:
+                    stale.append(self._pool.get_nowait())
+                except queue.Empty:
+                    break
+        pooled = len(stale)
+        if self._committer is not None:
+            self._committer.close()
+            stale.append(self._committer.conn)
+            self._committer = GroupCommitter(self._connect(), **self._commit_options)
+        with self._lock:
+            self._pooled -= pooled
+            self._connections = [conn for conn in self._connections if conn not in stale]
+        for conn in stale:
+            conn.close()
+
+    def check_schema(self):
+        """
+        Returns whether the database has been created. Raises
+        SchemaVersionError if it was created from another version of the
+        schema file, as its tables, triggers or indexes would not match the
+        statements run on them. The connection used is returned to the pool.
+        """
+        with self.connection():
+            if not self.execute_query(
+                    "SELECT name FROM sqlite_master WHERE type='table' AND name='user'").fetchone():
+                return False
+            version = self.execute_query('PRAGMA user_version').fetchone()['user_version']
+        expected = schema_version(self.schema)
+        if version != expected:
+            raise SchemaVersionError(
+                f'{self.filename} has schema version {version}, but {self.schema} is version '
+                f'{expected}: migrate or recreate the database')
+        return True
+
+    def ensure_schema(self):
+        """
+        Creates the database from the schema file unless it already exists
+        (see check_schema). The connection used is returned to the pool.
+        """
+        if not self.check_schema():
+            with self.connection():
+                self.recreate()
+
+    def _execute(self, cursor, stmt, args):
+        """Executes a statement on cursor, reporting it to the observer."""
+        observer = self.observer
+        if observer is None:
+            return cursor.execute(stmt, args)
+        start = time.perf_counter()
+        cursor.execute(stmt, args)
+        observer.observe_query(stmt, time.perf_counter() - start)
+        observer.observe_rows(stmt, cursor.rowcount)
+        return cursor
 
     def execute_query(self, stmt, args=()):
-        """Executes a query."""
-        res = self.conn.cursor().execute(stmt, args)
-        return res
+        """
+        Executes a query. On a shared connection, its rows are fetched at
+        once, under the shared lock.
+        """
+        if self.observer is None:
+            cursor = self.conn.cursor()
+        else:
+            cursor = self.conn.cursor(ObservedCursor)
+            cursor.observer = self.observer
+            cursor.stmt = stmt
+        if self._pool is not None:
+            return self._execute(cursor, stmt, args)
+        with self._reading():
+            return FetchedCursor(self._execute(cursor, stmt, args))
+
+    def fetch_rows(self, stmt, args=()):
+        """Executes a query and returns all of its rows as Rows."""
+        cursor = self.conn.cursor()
+        cursor.row_factory = None
+        start = time.perf_counter()
+        try:
+            with self._reading():
+                cursor.execute(stmt, args)
+                rows = Rows.from_cursor(cursor, cursor.fetchall())
+        finally:
+            cursor.close()
+        if self.observer is not None:
+            self.observer.observe_query(stmt, time.perf_counter() - start)
+            self.observer.observe_rows(stmt, len(rows))
+        return rows
+
+    def iter_query(self, stmt, args=(), chunk_size=500, conn=None):
+        """
+        Executes a query and yields its rows as Rows of chunk_size rows, on
+        conn if given, or else on a connection from checkout().
+        """
+        with nullcontext(conn) if conn is not None else self.checkout() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            count = 0
+            try:
+                with self._reading():
+                    self._execute(cursor, stmt, args)
+                while True:
+                    with self._reading():
+                        rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    count += len(rows)
+                    yield Rows.from_cursor(cursor, rows)
+            finally:
+                cursor.close()
+                if self.observer is not None:
+                    self.observer.observe_rows(stmt, count)
+
+    def in_transaction(self):
+        """Whether the current thread is inside transaction()."""
+        return getattr(self._local, 'depth', 0) > 0
+
+    def _shared_lock(self):
+        """
+        Serializes the threads that share a single connection: transactions
+        hold it until they end, and readers take it for each statement and
+        fetch, so that no thread reads another's uncommitted rows.
+        """
+        return self._tx_lock if self._pool is None else nullcontext()
+
+    @contextmanager
+    def _reading(self):
+        """Takes the shared lock for a read, reporting the wait to the observer."""
+        if self._pool is not None:
+            yield
+            return
+        start = time.perf_counter()
+        with self._tx_lock:
+            if self.observer is not None:
+                self.observer.observe_wait('lock', time.perf_counter() - start)
+            yield
+
+    def _submit(self, fn):
+        """
+        Hands fn(cursor) to the group committer, reporting the time it waits
+        to run (behind other jobs, and for the write lock) to the observer.
+        """
+        observer = self.observer
+        if observer is None:
+            return self._committer.submit(fn)
+        start = time.perf_counter()
+
+        def job(cursor):
+            observer.observe_wait('lock', time.perf_counter() - start)
+            return fn(cursor)
+        return self._committer.submit(job)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the block as one unit of work on one connection, with a single
+        commit at the end, or a rollback if it raises. Nested blocks use
+        savepoints, so they can fail without undoing the outer block.
+        """
+        start = time.perf_counter()
+        with self.connection() as conn, self._shared_lock():
+            depth = getattr(self._local, 'depth', 0)
+            savepoint = f'tx{depth}'
+            if depth:
+                conn.execute(f'SAVEPOINT {savepoint}')
+            else:
+                conn.execute('BEGIN IMMEDIATE')
+                if self.observer is not None:
+                    self.observer.observe_wait('lock', time.perf_counter() - start)
+            self._local.depth = depth + 1
+            try:
+                yield conn
+            except BaseException:
+                if depth:
+                    conn.execute(f'ROLLBACK TO {savepoint}')
+                    conn.execute(f'RELEASE {savepoint}')
+                else:
+                    conn.rollback()
+                raise
+            else:
+                if depth:
+                    conn.execute(f'RELEASE {savepoint}')
+                else:
+                    conn.commit()
+            finally:
+                self._local.depth = depth
 
     def execute_update(self, stmt, args=()):
         """Executes an insert or update and returns the last row id."""
-        cursor = self.conn.cursor()
-        cursor.execute(stmt, args)
-        self.conn.commit()
-        uid = cursor.lastrowid
-        cursor.close()
+        if self._committer is not None and not self.in_transaction():
+            def job(cursor):
+                self._execute(cursor, stmt, args)
+                return cursor.lastrowid
+            return self._submit(job)
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            self._execute(cursor, stmt, args)
+            uid = cursor.lastrowid
+            cursor.close()
         return uid
+
+    def execute_batch(self, operations):
+        """
+        Executes (stmt, args) pairs in a single transaction and returns the
+        (last row id, row count) of each of them.
+        """
+        def run(cursor):
+            results = []
+            for stmt, args in operations:
+                self._execute(cursor, stmt, args)
+                results.append((cursor.lastrowid, cursor.rowcount))
+            return results
+
+        if self._committer is not None and not self.in_transaction():
+            return self._submit(run)
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            try:
+                return run(cursor)
+            finally:
+                cursor.close()
+
+
+class ShardedDatabase:
+    """Users' data spread over several databases (shards).
+
+    Each user, with their projects, tasks and received messages, is placed
+    on a shard by a stable hash of their id. The users themselves (and
+    their token revocations) are kept in a separate catalog database, so
+    that usernames stay unique and can be looked up without knowing the
+    shard. Every shard has its own connections and write lock, so writes
+    to different shards run in parallel.
+
+    Statements run on the shard that route() bound to the current thread;
+    for_user() and for_message() return a shard explicitly.
+
+    Messages are stored on the shard of their receiver. Message ids are
+    taken from a range reserved to that shard, so that the sender, who may
+    live on another shard, can still find a message from its id.
+    """
+
+    MESSAGE_ID_RANGE = 1 << 40
+
+    def __init__(self, filename, schema, shards, **options):
+        if shards < 1:
+            raise ValueError('A sharded database needs at least one shard')
+        self.filename = filename
+        self.schema = schema
+        self.pool_size = options.get('pool_size', 0)
+        if filename == ':memory:':
+            self.catalog = Database(filename, schema, **options)
+            self.shards = [Database(filename, schema, **options) for _ in range(shards)]
+        else:
+            base, ext = os.path.splitext(filename)
+            self.catalog = Database(f'{base}.catalog{ext}', schema, **options)
+            self.shards = [Database(f'{base}.shard{idx}{ext}', schema, **options)
+                           for idx in range(shards)]
+        self._local = threading.local()
+        self._snapshots = None
+
+    @property
+    def in_memory(self):
+        """Whether the databases live in memory."""
+        return self.catalog.in_memory
+
+    @property
+    def observer(self):
+        return self.catalog.observer
+
+    def shard_index(self, user_id):
+        """Returns the index of the shard of a user."""
+        digest = hashlib.blake2b(str(int(user_id)).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'big') % len(self.shards)
+
+    def for_user(self, user_id):
+        """Returns the shard holding the data of a user."""
+        return self.shards[self.shard_index(user_id)]
+
+    def for_message(self, message_id):
+        """Returns the shard holding a message."""
+        return self.shards[min(message_id // self.MESSAGE_ID_RANGE, len(self.shards) - 1)]
+
+    def route(self, user_id):
+        """Routes the statements of the current thread to the shard of a user (None to unroute)."""
+        self._local.shard = self.for_user(user_id) if user_id is not None else None
+
+    def current(self):
+        """Returns the shard routed to the current thread."""
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            raise RuntimeError('No shard is routed to this thread')
+        return shard
+
+    @property
+    def conn(self):
+        return self.current().conn
+
+    def connection(self):
+        return self.current().connection()
+
+    def checkout(self):
+        return self.current().checkout()
+
+    def execute_query(self, stmt, args=()):
+        return self.current().execute_query(stmt, args)
+
+    def fetch_rows(self, stmt, args=()):
+        return self.current().fetch_rows(stmt, args)
+
+    def iter_query(self, stmt, args=(), chunk_size=500, conn=None):
+        # Resolves the shard now, as the rows may be read after unrouting
+        return self.current().iter_query(stmt, args, chunk_size, conn)
+
+    def in_transaction(self):
+        return self.current().in_transaction()
+
+    def transaction(self):
+        return self.current().transaction()
+
+    def execute_update(self, stmt, args=()):
+        return self.current().execute_update(stmt, args)
+
+    def execute_batch(self, operations):
+        return self.current().execute_batch(operations)
+
+    def release(self):
+        """Returns the connections bound to the current thread to their pools."""
+        self.catalog.release()
+        for shard in self.shards:
+            shard.release()
+
+    def close(self):
+        """Closes every connection of the catalog and the shards."""
+        self.catalog.close()
+        for shard in self.shards:
+            shard.close()
+
+    def recreate(self):
+        """
+        Recreates every database from the schema file, then keeps only the
+        users in the catalog and only the data of its own users in each shard.
+        The result is kept as snapshots, restored by later calls.
+        """
+        if self._snapshots is not None:
+            self.catalog.restore(self._snapshots[0])
+            for shard, snapshot in zip(self.shards, self._snapshots[1:]):
+                shard.restore(snapshot)
+            return
+        self.catalog.recreate()
+        self._prune_catalog(keep_users=True)
+        self._check_layout()
+        user_ids = [row['id'] for row in self.catalog.execute_query('SELECT id FROM user')]
+        for idx, shard in enumerate(self.shards):
+            shard.recreate()
+            self._prune_shard(idx, [uid for uid in user_ids if self.shard_index(uid) == idx])
+        self._snapshots = [database.snapshot() for database in [self.catalog] + self.shards]
+
+    def _prune_catalog(self, keep_users):
+        """Deletes the data seeded by the schema from the catalog, and its users unless keep_users."""
+        tables = ['task', 'project', 'message', 'change_log']
+        if not keep_users:
+            tables += ['token_revocation', 'user']
+        self.catalog.execute_batch([(f'DELETE FROM {table}', ()) for table in tables])
+
+    def _prune_shard(self, idx, user_ids):
+        """Deletes the data seeded by the schema from shard idx, except that of user_ids."""
+        kept = json.dumps(user_ids)
+        others = 'NOT IN (SELECT value FROM json_each(?))'
+        self.shards[idx].execute_batch([
+            ('DELETE FROM task WHERE project_id IN '
+             f'(SELECT id FROM project WHERE user_id {others})', (kept,)),
+            (f'DELETE FROM project WHERE user_id {others}', (kept,)),
+            (f'DELETE FROM message WHERE receiver_id {others}', (kept,)),
+            (f'DELETE FROM change_log WHERE user_id {others}', (kept,)),
+            ('DELETE FROM token_revocation', ()),
+            ('DELETE FROM user', ()),
+            # Starts the message ids of the shard at its reserved range
+            ("DELETE FROM sqlite_sequence WHERE name='message'", ()),
+            ("INSERT INTO sqlite_sequence (name, seq) "
+             "SELECT 'message', MAX(COALESCE(MAX(id), 0), ?) FROM message",
+             (idx * self.MESSAGE_ID_RANGE,)),
+        ])
+
+    def _check_layout(self):
+        """
+        Records the number of shards in the catalog, or raises ValueError if
+        the catalog was created for another number, as users would then be
+        looked up on the wrong shards.
+        """
+        with self.catalog.transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS shard_layout (shards INTEGER NOT NULL)')
+            row = conn.execute('SELECT shards FROM shard_layout').fetchone()
+            if row is None:
+                conn.execute('INSERT INTO shard_layout (shards) VALUES (?)', (len(self.shards),))
+        if row is not None and row['shards'] != len(self.shards):
+            raise ValueError(f"{self.catalog.filename} was created for {row['shards']} shards, "
+                             f'not {len(self.shards)}: its users would have to be moved')
+
+    def ensure_schema(self):
+        """
+        Creates the databases from the schema file unless they already exist
+        (see Database.check_schema). A new set of databases is seeded as by
+        recreate(). Otherwise the shard count is checked, a missing database
+        is created empty, and existing ones are left alone.
+        """
+        catalog_exists = self.catalog.check_schema()
+        if catalog_exists:
+            # Before opening the shards, so that no file is created for a wrong count
+            self._check_layout()
+        existing = [shard.check_schema() for shard in self.shards]
+        if not catalog_exists and not any(existing):
+            self.recreate()
+            self.release()
+            return
+        if not catalog_exists:
+            with self.catalog.connection():
+                self.catalog.recreate()
+            self._prune_catalog(keep_users=False)
+            self._check_layout()
+        for idx, (shard, exists) in enumerate(zip(self.shards, existing)):
+            if not exists:
+                with shard.connection():
+                    shard.recreate()
+                self._prune_shard(idx, [])
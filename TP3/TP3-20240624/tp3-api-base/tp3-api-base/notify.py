@@ -0,0 +1,148 @@
+"""
+ Implements an in-process hub that wakes the readers of new messages.
+
+"""
+
+import asyncio
+import threading
+import time
+
+
+class NotificationHub:
+    """Tracks the newest message of each receiver and wakes waiting threads.
+
+    Each receiver has a generation, bumped by every publish(). Readers
+    take the generation, check for new rows, then wait() for a later
+    generation, so a message published in between is never missed.
+    Coroutines on an event loop use wait_async() instead, which holds no
+    thread while it waits.
+
+    The newest message id of a receiver is known from publish() and from
+    seed() (a query made by the reader). Seeded ids expire after ttl
+    seconds, so messages inserted by other processes are noticed.
+    """
+
+    def __init__(self, ttl=30.0, clock=time.monotonic):
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._latest = {}
+        self._generations = {}
+        self._conditions = {}
+        self._futures = {}
+        self.published = 0
+        self.wakeups = 0
+
+    def state(self, receiver):
+        """Returns the newest known message id (None if unknown) and the generation."""
+        with self._lock:
+            latest = self._latest.get(receiver)
+            generation = self._generations.get(receiver, 0)
+        if latest is not None and self._clock() - latest[1] >= self.ttl:
+            return None, generation
+        return (latest[0] if latest else None), generation
+
+    def seed(self, receiver, message_id):
+        """Records the newest message id of receiver, as read from the database."""
+        with self._lock:
+            self._latest[receiver] = (message_id or 0, self._clock())
+
+    def publish(self, receiver, message_id):
+        """Records a new message for receiver and wakes its waiting readers."""
+        with self._lock:
+            latest = self._latest.get(receiver)
+            if latest is not None and message_id > latest[0]:
+                self._latest[receiver] = (message_id, latest[1])
+            self._generations[receiver] = self._generations.get(receiver, 0) + 1
+            self.published += 1
+            waiting = self._conditions.get(receiver)
+            if waiting is not None:
+                waiting[0].notify_all()
+            for loop, future in self._futures.get(receiver, ()):
+                loop.call_soon_threadsafe(_resolve, future)
+
+    def wait(self, receiver, generation, timeout):
+        """
+        Blocks until receiver gets a message after generation, or timeout
+        seconds pass. Returns whether a message was published.
+        """
+        deadline = self._clock() + timeout
+        with self._lock:
+            waiting = self._conditions.get(receiver)
+            if waiting is None:
+                waiting = self._conditions[receiver] = [threading.Condition(self._lock), 0]
+            waiting[1] += 1
+            try:
+                while self._generations.get(receiver, 0) == generation:
+                    remaining = deadline - self._clock()
+                    if remaining <= 0:
+                        return False
+                    waiting[0].wait(remaining)
+                self.wakeups += 1
+                return True
+            finally:
+                waiting[1] -= 1
+                if not waiting[1]:
+                    del self._conditions[receiver]
+
+    async def wait_async(self, receiver, generation, timeout):
+        """Like wait(), but awaits on the running event loop."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if self._generations.get(receiver, 0) != generation:
+                self.wakeups += 1
+                return True
+            self._futures.setdefault(receiver, []).append((loop, future))
+        try:
+            await asyncio.wait({future}, timeout=max(timeout, 0))
+        finally:
+            with self._lock:
+                waiting = self._futures[receiver]
+                waiting.remove((loop, future))
+                if not waiting:
+                    del self._futures[receiver]
+                published = self._generations.get(receiver, 0) != generation
+                if published:
+                    self.wakeups += 1
+        return published
+
+    def clear(self):
+        """Forgets the known message ids, e.g. after the database is recreated."""
+        with self._lock:
+            self._latest.clear()
+
+    def stats(self):
+        """Returns the number of waiting readers and the publish and wakeup counters."""
+        with self._lock:
+            return {'waiting': sum(waiting[1] for waiting in self._conditions.values())
+                               + sum(len(waiting) for waiting in self._futures.values()),
+                    'receivers': len(self._conditions.keys() | self._futures.keys()),
+                    'published': self.published,
+                    'wakeups': self.wakeups}
+
+
+class Wait:
+    """A wait for a message to receiver after generation, for up to timeout seconds.
+
+    Blocks the calling thread when called, and awaits on the event loop
+    when awaited, so that the bodies of streamed responses can hand it to
+    an asynchronous server (see asgi.py) instead of blocking.
+    """
+
+    def __init__(self, hub, receiver, generation, timeout):
+        self.hub = hub
+        self.receiver = receiver
+        self.generation = generation
+        self.timeout = timeout
+
+    def __call__(self):
+        return self.hub.wait(self.receiver, self.generation, self.timeout)
+
+    def __await__(self):
+        return self.hub.wait_async(self.receiver, self.generation, self.timeout).__await__()
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(True)
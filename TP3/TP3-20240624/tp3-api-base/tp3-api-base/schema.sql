@@ -1,3 +1,7 @@
+-- Version of this schema, stored in the database header. Bump it with every
+-- change: existing databases of another version are refused at startup.
+PRAGMA user_version = 7;
+
 -- USERS
 DROP TABLE IF EXISTS user;
 CREATE TABLE user (
@@ -7,6 +11,16 @@ CREATE TABLE user (
     username TEXT,
     password TEXT
 );
+CREATE UNIQUE INDEX user_username ON user(username);
+
+-- Bearer tokens of a user issued up to revoked_at (ms) are rejected
+DROP TABLE IF EXISTS token_revocation;
+CREATE TABLE token_revocation (
+    user_id INTEGER PRIMARY KEY,
+    revoked_at INTEGER NOT NULL,
+    FOREIGN KEY(user_id) REFERENCES user(id)
+);
+CREATE INDEX token_revocation_revoked_at ON token_revocation(revoked_at);
 
 INSERT INTO user VALUES (NULL, 'Homer Simpson', 'homer@simpsons.org', 'homer', '1234');
 INSERT INTO user VALUES (NULL, 'Bart Simpson', 'bart@simpsons.org', 'bart', '1234');
@@ -21,6 +35,7 @@ CREATE TABLE project (
     last_updated TEXT,
     FOREIGN KEY(user_id) REFERENCES user(id)
 );
+CREATE INDEX project_user_id ON project(user_id);
 
 INSERT INTO project VALUES (NULL, 1, 'Doughnuts', '2020-05-01', '2020-06-01');
 INSERT INTO project VALUES (NULL, 1, 'Eat well', '2020-05-01', '2020-05-02');
@@ -36,6 +51,7 @@ CREATE TABLE task (
     completed INTEGER,
     FOREIGN KEY(project_id) REFERENCES project(id) ON DELETE CASCADE
 );
+CREATE INDEX task_project_id ON task(project_id);
 
 INSERT INTO task VALUES (NULL, 1, 'Search for doughnuts', '2020-05-05', 1);
 INSERT INTO task VALUES (NULL, 1, 'Eat cream', '2020-05-05', 0);
@@ -47,9 +63,10 @@ INSERT INTO task VALUES (NULL, 3, 'Save those who need to be saved', '2020-05-07
 INSERT INTO task VALUES (NULL, 3, 'Save those from being not saved', '2020-05-08', 1);
 
 -- MESSAGES
+-- Ids are never reused, so that they can be reserved in ranges
 DROP TABLE IF EXISTS message;
 CREATE TABLE message (
-    id INTEGER PRIMARY KEY,
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
     sender_id INTEGER,
     receiver_id INTEGER,
     content TEXT,
@@ -57,3 +74,242 @@ CREATE TABLE message (
     FOREIGN KEY(sender_id) REFERENCES user(id),
     FOREIGN KEY(receiver_id) REFERENCES user(id)
 );
+CREATE INDEX message_receiver_id ON message(receiver_id);
+CREATE INDEX message_sender_id ON message(sender_id);
+
+-- VERSION STAMPS
+-- Bumped by the triggers below on every write to a user's projects or to
+-- a project's tasks (which also bumps its owner's stamp, as project lists
+-- can include task counts), and used to compute ETags. New stamps start at a
+-- random version so that ETags do not repeat when the database is
+-- recreated; rows that were never written have no stamp (version 0).
+DROP TABLE IF EXISTS version_stamp;
+CREATE TABLE version_stamp (
+    scope TEXT,
+    id INTEGER,
+    version INTEGER NOT NULL,
+    PRIMARY KEY(scope, id)
+) WITHOUT ROWID;
+
+CREATE TRIGGER project_insert_stamp AFTER INSERT ON project BEGIN
+    INSERT INTO version_stamp VALUES ('user', NEW.user_id, abs(random() % 1000000000))
+        ON CONFLICT(scope, id) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER project_update_stamp AFTER UPDATE ON project BEGIN
+    INSERT INTO version_stamp VALUES ('user', NEW.user_id, abs(random() % 1000000000))
+        ON CONFLICT(scope, id) DO UPDATE SET version = version + 1;
+    INSERT INTO version_stamp VALUES ('project', NEW.id, abs(random() % 1000000000))
+        ON CONFLICT(scope, id) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER project_delete_stamp AFTER DELETE ON project BEGIN
+    INSERT INTO version_stamp VALUES ('user', OLD.user_id, abs(random() % 1000000000))
+        ON CONFLICT(scope, id) DO UPDATE SET version = version + 1;
+    INSERT INTO version_stamp VALUES ('project', OLD.id, abs(random() % 1000000000))
+        ON CONFLICT(scope, id) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER task_insert_stamp AFTER INSERT ON task BEGIN
+    INSERT INTO version_stamp VALUES ('project', NEW.project_id, abs(random() % 1000000000))
+        ON CONFLICT(scope, id) DO UPDATE SET version = version + 1;
+    INSERT INTO version_stamp
+        SELECT 'user', user_id, abs(random() % 1000000000) FROM project WHERE id = NEW.project_id
+        ON CONFLICT(scope, id) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER task_update_stamp AFTER UPDATE ON task BEGIN
+    INSERT INTO version_stamp VALUES ('project', NEW.project_id, abs(random() % 1000000000))
+        ON CONFLICT(scope, id) DO UPDATE SET version = version + 1;
+    INSERT INTO version_stamp
+        SELECT 'user', user_id, abs(random() % 1000000000) FROM project WHERE id = NEW.project_id
+        ON CONFLICT(scope, id) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER task_delete_stamp AFTER DELETE ON task BEGIN
+    INSERT INTO version_stamp VALUES ('project', OLD.project_id, abs(random() % 1000000000))
+        ON CONFLICT(scope, id) DO UPDATE SET version = version + 1;
+    INSERT INTO version_stamp
+        SELECT 'user', user_id, abs(random() % 1000000000) FROM project WHERE id = OLD.project_id
+        ON CONFLICT(scope, id) DO UPDATE SET version = version + 1;
+END;
+
+-- SEARCH
+-- Full-text index of project titles, task titles and message contents,
+-- kept in sync by the triggers below. The owner column holds a 'u<id>'
+-- token for every user allowed to see a row (the owner of the project,
+-- or the sender and the receiver of the message), so that searches are
+-- scoped to a user within the index. Row ids encode the source row as
+-- id * 4 + 1 (project), + 2 (task) or + 3 (message).
+DROP TABLE IF EXISTS search;
+CREATE VIRTUAL TABLE search USING fts5(
+    owner, kind UNINDEXED, project_id UNINDEXED, body,
+    tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+);
+-- Ranks rows by the relevance of their body only
+INSERT INTO search (search, rank) VALUES ('rank', 'bm25(0.0, 0.0, 0.0, 1.0)');
+
+CREATE TRIGGER project_insert_search AFTER INSERT ON project BEGIN
+    INSERT INTO search (rowid, owner, kind, project_id, body)
+        VALUES (NEW.id * 4 + 1, 'u' || NEW.user_id, 'project', NEW.id, NEW.title);
+END;
+
+CREATE TRIGGER project_update_search AFTER UPDATE OF user_id, title ON project BEGIN
+    UPDATE search SET owner = 'u' || NEW.user_id, body = NEW.title WHERE rowid = NEW.id * 4 + 1;
+END;
+
+CREATE TRIGGER project_delete_search AFTER DELETE ON project BEGIN
+    DELETE FROM search WHERE rowid = OLD.id * 4 + 1;
+END;
+
+CREATE TRIGGER task_insert_search AFTER INSERT ON task BEGIN
+    INSERT INTO search (rowid, owner, kind, project_id, body)
+        VALUES (NEW.id * 4 + 2, (SELECT 'u' || user_id FROM project WHERE id = NEW.project_id),
+                'task', NEW.project_id, NEW.title);
+END;
+
+CREATE TRIGGER task_update_search AFTER UPDATE OF project_id, title ON task BEGIN
+    UPDATE search SET owner = (SELECT 'u' || user_id FROM project WHERE id = NEW.project_id),
+                      project_id = NEW.project_id, body = NEW.title
+        WHERE rowid = NEW.id * 4 + 2;
+END;
+
+CREATE TRIGGER task_delete_search AFTER DELETE ON task BEGIN
+    DELETE FROM search WHERE rowid = OLD.id * 4 + 2;
+END;
+
+CREATE TRIGGER message_insert_search AFTER INSERT ON message BEGIN
+    INSERT INTO search (rowid, owner, kind, project_id, body)
+        VALUES (NEW.id * 4 + 3, 'u' || NEW.sender_id || ' u' || NEW.receiver_id,
+                'message', NULL, NEW.content);
+END;
+
+CREATE TRIGGER message_delete_search AFTER DELETE ON message BEGIN
+    DELETE FROM search WHERE rowid = OLD.id * 4 + 3;
+END;
+
+-- Indexes the rows inserted above
+INSERT INTO search (rowid, owner, kind, project_id, body)
+    SELECT id * 4 + 1, 'u' || user_id, 'project', id, title FROM project;
+INSERT INTO search (rowid, owner, kind, project_id, body)
+    SELECT task.id * 4 + 2, 'u' || project.user_id, 'task', task.project_id, task.title
+    FROM task JOIN project ON project.id = task.project_id;
+INSERT INTO search (rowid, owner, kind, project_id, body)
+    SELECT id * 4 + 3, 'u' || sender_id || ' u' || receiver_id, 'message', NULL, content
+    FROM message;
+
+-- PROJECT SUMMARIES
+-- Task counts of every project, kept up to date by the triggers below so
+-- that summaries are read without counting tasks.
+DROP TABLE IF EXISTS project_summary;
+CREATE TABLE project_summary (
+    project_id INTEGER PRIMARY KEY,
+    task_count INTEGER NOT NULL DEFAULT 0,
+    completed_count INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER project_insert_summary AFTER INSERT ON project BEGIN
+    INSERT INTO project_summary (project_id) VALUES (NEW.id);
+END;
+
+CREATE TRIGGER project_delete_summary AFTER DELETE ON project BEGIN
+    DELETE FROM project_summary WHERE project_id = OLD.id;
+END;
+
+CREATE TRIGGER task_insert_summary AFTER INSERT ON task BEGIN
+    UPDATE project_summary SET task_count = task_count + 1,
+                               completed_count = completed_count + (coalesce(NEW.completed, 0) != 0)
+        WHERE project_id = NEW.project_id;
+END;
+
+CREATE TRIGGER task_update_summary AFTER UPDATE OF project_id, completed ON task BEGIN
+    UPDATE project_summary SET task_count = task_count - 1,
+                               completed_count = completed_count - (coalesce(OLD.completed, 0) != 0)
+        WHERE project_id = OLD.project_id;
+    UPDATE project_summary SET task_count = task_count + 1,
+                               completed_count = completed_count + (coalesce(NEW.completed, 0) != 0)
+        WHERE project_id = NEW.project_id;
+END;
+
+CREATE TRIGGER task_delete_summary AFTER DELETE ON task BEGIN
+    UPDATE project_summary SET task_count = task_count - 1,
+                               completed_count = completed_count - (coalesce(OLD.completed, 0) != 0)
+        WHERE project_id = OLD.project_id;
+END;
+
+-- Counts the rows inserted above
+INSERT INTO project_summary (project_id, task_count, completed_count)
+    SELECT project.id, count(task.id), coalesce(sum(coalesce(task.completed, 0) != 0), 0)
+    FROM project LEFT JOIN task ON task.project_id = project.id
+    GROUP BY project.id;
+
+-- CHANGE LOG
+-- The latest write to every project, task and message, recorded by the
+-- triggers below under the user who lists the row (the owner of the
+-- project, or the receiver of the message), so that /api/sync/ reads
+-- only the rows changed after a client's seq. A write replaces the
+-- row's entry with one under a new seq, so entries never pile up for a
+-- row; deletes leave a tombstone until compact_changes() in app.py drops
+-- it, and records the highest seq dropped for the user in change_horizon.
+DROP TABLE IF EXISTS change_log;
+CREATE TABLE change_log (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    row_id INTEGER NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    changed_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+    UNIQUE(user_id, kind, row_id)
+);
+CREATE INDEX change_log_user_seq ON change_log(user_id, seq);
+CREATE INDEX change_log_tombstone ON change_log(changed_at) WHERE deleted;
+
+DROP TABLE IF EXISTS change_horizon;
+CREATE TABLE change_horizon (
+    user_id INTEGER PRIMARY KEY,
+    seq INTEGER NOT NULL
+);
+
+CREATE TRIGGER project_insert_change AFTER INSERT ON project BEGIN
+    INSERT OR REPLACE INTO change_log (user_id, kind, row_id) VALUES (NEW.user_id, 'project', NEW.id);
+END;
+
+CREATE TRIGGER project_update_change AFTER UPDATE ON project BEGIN
+    INSERT OR REPLACE INTO change_log (user_id, kind, row_id) VALUES (NEW.user_id, 'project', NEW.id);
+END;
+
+CREATE TRIGGER project_delete_change AFTER DELETE ON project BEGIN
+    INSERT OR REPLACE INTO change_log (user_id, kind, row_id, deleted)
+        VALUES (OLD.user_id, 'project', OLD.id, 1);
+END;
+
+CREATE TRIGGER task_insert_change AFTER INSERT ON task BEGIN
+    INSERT OR REPLACE INTO change_log (user_id, kind, row_id)
+        SELECT user_id, 'task', NEW.id FROM project WHERE id = NEW.project_id;
+END;
+
+CREATE TRIGGER task_update_change AFTER UPDATE ON task BEGIN
+    INSERT OR REPLACE INTO change_log (user_id, kind, row_id)
+        SELECT user_id, 'task', NEW.id FROM project WHERE id = NEW.project_id;
+END;
+
+CREATE TRIGGER task_delete_change AFTER DELETE ON task BEGIN
+    INSERT OR REPLACE INTO change_log (user_id, kind, row_id, deleted)
+        SELECT user_id, 'task', OLD.id, 1 FROM project WHERE id = OLD.project_id;
+END;
+
+CREATE TRIGGER message_insert_change AFTER INSERT ON message BEGIN
+    INSERT OR REPLACE INTO change_log (user_id, kind, row_id)
+        VALUES (NEW.receiver_id, 'message', NEW.id);
+END;
+
+CREATE TRIGGER message_delete_change AFTER DELETE ON message BEGIN
+    INSERT OR REPLACE INTO change_log (user_id, kind, row_id, deleted)
+        VALUES (OLD.receiver_id, 'message', OLD.id, 1);
+END;
+
+-- Logs the rows inserted above
+INSERT INTO change_log (user_id, kind, row_id) SELECT user_id, 'project', id FROM project;
+INSERT INTO change_log (user_id, kind, row_id)
+    SELECT project.user_id, 'task', task.id FROM task JOIN project ON project.id = task.project_id;
+INSERT INTO change_log (user_id, kind, row_id) SELECT receiver_id, 'message', id FROM message;
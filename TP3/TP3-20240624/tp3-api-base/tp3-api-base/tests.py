@@ -2,10 +2,50 @@
 Tests the application API
 """
 
+import asyncio
 import base64
+import gzip
+import hashlib
+import http.client
+import json
+import os
+import re
+import shutil
+import socket
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
 import unittest
+import zlib
+from unittest import mock
 
-from app import app, db
+from flask import g, request, request_started
+from flask.testing import FlaskClient
+
+from app import (app, db, admission, auth_cache, compact_changes, invalidate_project,
+                 WAITING_ENDPOINTS,
+                 rate_limiter, read_through, response_cache, message_hub, next_compaction,
+                 token_revocations, token_signer)
+from asgi import ASGIApp, HTTPServer, endpoint_matcher
+from cache import TTLCache
+from formats import packb
+from limits import AdmissionController, RateLimiter, parse_budgets
+from models import (Database, PoolTimeout, Rows, SchemaVersionError, ShardedDatabase, baseline,
+                    schema_version)
+from notify import NotificationHub
+from tokens import TokenSigner
+
+
+class BufferedClient(FlaskClient):
+    """Test client that reads and closes every response body, as a server does."""
+
+    def open(self, *args, buffered=True, **kwargs):
+        return super().open(*args, buffered=buffered, **kwargs)
+
+
+app.test_client_class = BufferedClient
 
 
 def auth_header(username, password):
@@ -15,6 +55,55 @@ def auth_header(username, password):
     return {'Authorization': f'Basic {b64credentials}'}
 
 
+def next_link(res):
+    """Returns the url of the next page, if any."""
+    link = res.headers.get('Link')
+    if link and link.endswith('; rel="next"'):
+        return link[1:link.index('>')]
+    return None
+
+
+def unpack(data):
+    """Decodes MessagePack data (the subset written by formats.packb)."""
+    def read(pos):
+        code = data[pos]
+        if code <= 0x7f:
+            return code, pos + 1
+        if code >= 0xe0:
+            return code - 0x100, pos + 1
+        if 0x80 <= code <= 0x9f:
+            return read_items(pos + 1, code & 0x0f, code < 0x90)
+        if 0xa0 <= code <= 0xbf:
+            size = code & 0x1f
+            return data[pos + 1:pos + 1 + size].decode(), pos + 1 + size
+        if code in (0xc0, 0xc2, 0xc3):
+            return {0xc0: None, 0xc2: False, 0xc3: True}[code], pos + 1
+        fmt = {0xcb: '>d', 0xcc: '>B', 0xcd: '>H', 0xce: '>I', 0xcf: '>Q', 0xd0: '>b',
+               0xd1: '>h', 0xd2: '>i', 0xd3: '>q', 0xd9: '>B', 0xda: '>H', 0xdb: '>I',
+               0xc4: '>B', 0xc5: '>H', 0xc6: '>I', 0xdc: '>H', 0xdd: '>I', 0xde: '>H',
+               0xdf: '>I'}[code]
+        value, = struct.unpack_from(fmt, data, pos + 1)
+        pos += 1 + struct.calcsize(fmt)
+        if code in (0xd9, 0xda, 0xdb):
+            return data[pos:pos + value].decode(), pos + value
+        if code in (0xc4, 0xc5, 0xc6):
+            return data[pos:pos + value], pos + value
+        if code in (0xdc, 0xdd, 0xde, 0xdf):
+            return read_items(pos, value, code >= 0xde)
+        return value, pos
+
+    def read_items(pos, size, is_map):
+        items = []
+        for _ in range(size * 2 if is_map else size):
+            item, pos = read(pos)
+            items.append(item)
+        return (dict(zip(items[::2], items[1::2])) if is_map else items), pos
+
+    value, pos = read(0)
+    assert pos == len(data)
+    return value
+
+
 class TestBase(unittest.TestCase):
     """Base for all tests."""
 
@@ -23,6 +112,13 @@ class TestBase(unittest.TestCase):
         self.client = app.test_client()
         self.db = db
         self.db.recreate()
+        auth_cache.clear()
+        response_cache.clear()
+        message_hub.clear()
+        token_revocations.clear()
+        rate_limiter.clear()
+        admission.clear()
+        next_compaction.clear()
 
     def tearDown(self):
         pass
@@ -46,6 +142,147 @@ class TestUsers(TestBase):
         res = self.client.get('/api/user/', headers=credentials)
         self.assertEqual(res.status_code, 403)
 
+    def test_register_duplicate_username(self):
+        """Tests registering a username that is already taken."""
+        data = {
+            'name': 'Homer Simpson',
+            'email': 'homer@simpsons.org',
+            'username': 'homer',
+            'password': '4321'
+        }
+        res = self.client.post('/api/user/register/', json=data)
+        self.assertEqual(res.status_code, 409)
+
+
+class TestAuthCache(TestBase):
+    """Tests for the credential cache."""
+
+    def test_cache_hit(self):
+        """Tests that repeated requests are served from the cache."""
+        credentials = auth_header('homer', '1234')
+        self.client.get('/api/user/', headers=credentials)
+        res = self.client.get('/api/user/', headers=credentials)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(auth_cache.misses, 1)
+        self.assertEqual(auth_cache.hits, 1)
+
+    def test_update_invalidates_credentials(self):
+        """Tests that changing the password invalidates the old credentials."""
+        credentials = auth_header('homer', '1234')
+        self.client.get('/api/user/', headers=credentials)
+        data = {
+            'name': 'Homer Simpson',
+            'email': 'homer@simpsons.org',
+            'username': 'homer',
+            'password': '4321'
+        }
+        res = self.client.put('/api/user/', json=data, headers=credentials)
+        self.assertEqual(res.status_code, 200)
+        res = self.client.get('/api/user/', headers=credentials)
+        self.assertEqual(res.status_code, 403)
+        res = self.client.get('/api/user/', headers=auth_header('homer', '4321'))
+        self.assertEqual(res.status_code, 200)
+
+    def test_failed_logins_are_not_cached(self):
+        """Tests that invalid credentials cannot fill the cache."""
+        self.client.get('/api/user/', headers=auth_header('homer', '1234'))
+        for i in range(3):
+            res = self.client.get('/api/user/', headers=auth_header(f'junk{i}', 'x'))
+            self.assertEqual(res.status_code, 403)
+        self.assertEqual(auth_cache.stats()['size'], 1)
+
+    def test_register_after_failed_login(self):
+        """Tests that a user can log in right after a failed login and registering."""
+        credentials = auth_header('lisa', '1234')
+        res = self.client.get('/api/user/', headers=credentials)
+        self.assertEqual(res.status_code, 403)
+        data = {
+            'name': 'Lisa Simpson',
+            'email': 'lisa@simpsons.org',
+            'username': 'lisa',
+            'password': '1234'
+        }
+        res = self.client.post('/api/user/register/', json=data)
+        self.assertEqual(res.status_code, 201)
+        res = self.client.get('/api/user/', headers=credentials)
+        self.assertEqual(res.status_code, 200)
+
+    def test_stats(self):
+        """Tests that the cache counters are exposed."""
+        credentials = auth_header('homer', '1234')
+        res = self.client.get('/api/stats/', headers=credentials)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json['auth_cache']['misses'], 1)
+        self.assertIn('hit_ratio', res.json['auth_cache'])
+
+
+class TestTokens(TestBase):
+    """Tests for the bearer tokens."""
+
+    def setUp(self):
+        super().setUp()
+        self.credentials = auth_header('homer', '1234')
+
+    def issue(self, credentials=None):
+        """Returns the authorization header of a new token."""
+        res = self.client.post('/api/token/', headers=credentials or self.credentials)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json['token_type'], 'Bearer')
+        return {'Authorization': f"Bearer {res.json['token']}"}
+
+    def test_token(self):
+        """Tests that a token authenticates without reading the user table."""
+        bearer = self.issue()
+        statements = []
+        db.conn.set_trace_callback(statements.append)
+        try:
+            res = self.client.get('/api/projects/1/', headers=bearer)
+        finally:
+            db.conn.set_trace_callback(None)
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse([stmt for stmt in statements if re.search(r'\bFROM user\b', stmt)])
+        res = self.client.get('/api/user/', headers=bearer)
+        self.assertEqual(res.json['username'], 'homer')
+
+    def test_invalid_tokens(self):
+        """Tests that tampered, foreign and expired tokens are rejected."""
+        token = self.issue()['Authorization'][len('Bearer '):]
+        version, payload, signature = token.split('.')
+        forged = base64.urlsafe_b64encode(b'2' + base64.urlsafe_b64decode(payload + '==')[1:])
+        for bad in (f'{version}.{forged.decode().rstrip("=")}.{signature}', token[:-2], 'x',
+                    TokenSigner(b'other').issue(1), TokenSigner(token_signer.secret, ttl=-1).issue(1)):
+            res = self.client.get('/api/user/', headers={'Authorization': f'Bearer {bad}'})
+            self.assertEqual(res.status_code, 403, bad)
+
+    def test_requires_basic_credentials(self):
+        """Tests that tokens cannot be exchanged for new tokens."""
+        res = self.client.post('/api/token/', headers=self.issue())
+        self.assertEqual(res.status_code, 403)
+        res = self.client.post('/api/token/', headers=auth_header('homer', 'wrong'))
+        self.assertEqual(res.status_code, 403)
+
+    def test_user_update_revokes_tokens(self):
+        """Tests that updating the user rejects the tokens issued before."""
+        bearer = self.issue()
+        data = {'name': 'Homer', 'email': 'homer@simpsons.org', 'username': 'homer', 'password': '4321'}
+        res = self.client.put('/api/user/', json=data, headers=bearer)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.client.get('/api/user/', headers=bearer).status_code, 403)
+        time.sleep(0.002)
+        bearer = self.issue(auth_header('homer', '4321'))
+        self.assertEqual(self.client.get('/api/user/', headers=bearer).status_code, 200)
+
+    def test_revocations_are_reloaded(self):
+        """Tests that revocations recorded by another process are picked up."""
+        bearer = self.issue()
+        self.assertEqual(self.client.get('/api/user/', headers=bearer).status_code, 200)
+        db.execute_update('INSERT INTO token_revocation (user_id, revoked_at) VALUES (?, ?)',
+                          (1, token_signer.now()))
+        self.assertEqual(self.client.get('/api/user/', headers=bearer).status_code, 200)
+        # Forces a reload of the revocations
+        token_revocations.clear()
+        self.assertEqual(self.client.get('/api/user/', headers=bearer).status_code, 403)
+
 
 class TestProjects(TestBase):
     """Tests for the project endpoints."""
@@ -223,6 +460,77 @@ class TestTasks(TestBase):
         self.assertEqual(res.status_code, 404)
 
 
+class TestTaskBatch(TestBase):
+    """Tests for the batch task endpoint."""
+
+    def setUp(self):
+        super().setUp()
+        self.credentials = auth_header('homer', '1234')
+
+    def test_batch(self):
+        """Tests creating, updating and deleting tasks in one batch."""
+        data = [
+            {'op': 'create', 'title': 'Batch Task', 'completed': 0},
+            {'op': 'update', 'id': 1, 'completed': 0},
+            {'op': 'delete', 'id': 2},
+            {'op': 'delete', 'id': 999},
+        ]
+        res = self.client.post('/api/projects/1/tasks/batch/', json=data, headers=self.credentials)
+        self.assertEqual(res.status_code, 200)
+        results = res.json['results']
+        self.assertEqual([result['status'] for result in results], [201, 200, 200, 404])
+        res = self.client.get(f"/api/projects/1/tasks/{results[0]['id']}/", headers=self.credentials)
+        self.assertEqual(res.json['title'], 'Batch Task')
+        res = self.client.get('/api/projects/1/tasks/1/', headers=self.credentials)
+        self.assertEqual(res.json['title'], 'Search for doughnuts')
+        self.assertEqual(res.json['completed'], 0)
+        res = self.client.get('/api/projects/1/tasks/2/', headers=self.credentials)
+        self.assertEqual(res.status_code, 404)
+
+    def test_batch_other_project_tasks(self):
+        """Tests that tasks of another project are not touched."""
+        data = [{'op': 'delete', 'id': 3}]
+        res = self.client.post('/api/projects/1/tasks/batch/', json=data, headers=self.credentials)
+        self.assertEqual(res.json['results'][0]['status'], 404)
+        res = self.client.get('/api/projects/2/tasks/3/', headers=self.credentials)
+        self.assertEqual(res.status_code, 200)
+
+    def test_batch_invalid_data(self):
+        """Tests that an invalid operation rejects the whole batch."""
+        data = [
+            {'op': 'create', 'title': 'Batch Task', 'completed': 0},
+            {'op': 'create', 'title': ''},
+            {'op': 'rename', 'id': 1},
+        ]
+        res = self.client.post('/api/projects/1/tasks/batch/', json=data, headers=self.credentials)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual([error['index'] for error in res.json['errors']], [1, 2])
+        res = self.client.get('/api/projects/1/tasks/', headers=self.credentials)
+        self.assertEqual(len(res.json), 2)
+
+    def test_batch_invalid_types(self):
+        """Tests that ids, titles and completed flags of the wrong type are rejected."""
+        data = [
+            {'op': 'delete', 'id': True},
+            {'op': 'update', 'id': 1, 'completed': 2},
+            {'op': 'update', 'id': 1, 'completed': 'yes'},
+            {'op': 'update', 'id': 1, 'title': ['x']},
+            {'op': 'create', 'title': 'Batch Task', 'completed': {}},
+            {'op': 'update', 'id': 1, 'completed': True},
+        ]
+        res = self.client.post('/api/projects/1/tasks/batch/', json=data, headers=self.credentials)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual([error['index'] for error in res.json['errors']], [0, 1, 2, 3, 4])
+        res = self.client.get('/api/projects/1/tasks/', headers=self.credentials)
+        self.assertEqual(len(res.json), 2)
+
+    def test_batch_nonexistent_project(self):
+        """Tests a batch on a project of another user."""
+        data = [{'op': 'delete', 'id': 6}]
+        res = self.client.post('/api/projects/3/tasks/batch/', json=data, headers=self.credentials)
+        self.assertEqual(res.status_code, 404)
+
+
 class TestMessages(TestBase):
     """Tests for the messages endpoints."""
 
@@ -263,6 +571,474 @@ class TestMessages(TestBase):
         self.assertEqual(res.status_code, 404)
 
 
+class TestMessageNotifications(TestBase):
+    """Tests for the long-poll and server-sent events endpoints."""
+
+    def setUp(self):
+        super().setUp()
+        self.credentials = auth_header('homer', '1234')
+        self.receiver_credentials = auth_header('bart', '1234')
+
+    def send(self, content, delay=0.0):
+        """Sends a message from homer to bart, after delay seconds in a thread."""
+        def run():
+            time.sleep(delay)
+            app.test_client().post('/api/messages/', json={'receiver_id': 2, 'content': content},
+                                   headers=self.credentials)
+        if not delay:
+            return run()
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.addCleanup(thread.join)
+
+    def test_poll_wakes_on_new_message(self):
+        """Tests that a waiting poll returns as soon as a message is sent."""
+        self.send('Hello, Bart!', delay=0.1)
+        start = time.monotonic()
+        res = self.client.get('/api/messages/poll/?timeout=5', headers=self.receiver_credentials)
+        self.assertLess(time.monotonic() - start, 4)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([message['content'] for message in res.json], ['Hello, Bart!'])
+        self.assertEqual(res.headers['X-Next-Cursor'], str(res.json[0]['id']))
+
+    def test_poll_resumes_after_id(self):
+        """Tests that a poll returns the messages after the given id at once."""
+        self.send('One')
+        self.send('Two')
+        res = self.client.get('/api/messages/poll/?after=0&timeout=5', headers=self.receiver_credentials)
+        self.assertEqual([message['content'] for message in res.json], ['One', 'Two'])
+        cursor = res.headers['X-Next-Cursor']
+        res = self.client.get(f'/api/messages/poll/?after={cursor}&timeout=0',
+                              headers=self.receiver_credentials)
+        self.assertEqual(res.json, [])
+        self.assertEqual(res.headers['X-Next-Cursor'], cursor)
+
+    def test_idle_poll_queries_once(self):
+        """Tests that polls without new messages only query the database when they time out."""
+        self.send('Hello, Bart!')
+        url = '/api/messages/poll/?after=1&timeout=0.05'
+        self.client.get(url, headers=self.receiver_credentials)
+        statements = []
+        db.conn.set_trace_callback(statements.append)
+        try:
+            res = self.client.get(url, headers=self.receiver_credentials)
+        finally:
+            db.conn.set_trace_callback(None)
+        self.assertEqual(res.json, [])
+        self.assertEqual(len(statements), 1)
+        self.assertIn('FROM message WHERE receiver_id=2 AND id>1 ', statements[0])
+
+    def test_poll_finds_messages_of_other_processes(self):
+        """Tests that a message that did not wake the hub is returned when the wait times out."""
+        self.client.get('/api/messages/poll/?after=0&timeout=0', headers=self.receiver_credentials)
+        db.execute_update("INSERT INTO message (sender_id, receiver_id, content, timestamp) "
+                          "VALUES (1, 2, 'Elsewhere', '2024-06-24')")
+        res = self.client.get('/api/messages/poll/?after=0&timeout=0.05',
+                              headers=self.receiver_credentials)
+        self.assertEqual([message['content'] for message in res.json], ['Elsewhere'])
+
+    def test_events(self):
+        """Tests the server-sent events stream and resuming it."""
+        self.send('One')
+        self.send('Two')
+        res = self.client.get('/api/messages/events/?timeout=0',
+                              headers={**self.receiver_credentials, 'Last-Event-ID': '1'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        events = [event for event in res.get_data(as_text=True).split('\n\n') if event.startswith('id:')]
+        self.assertEqual(len(events), 1)
+        lines = events[0].split('\n')
+        self.assertEqual(lines[:2], ['id: 2', 'event: message'])
+        self.assertEqual(json.loads(lines[2][len('data: '):])['content'], 'Two')
+
+    def test_invalid_parameters(self):
+        """Tests that invalid cursors and timeouts are rejected."""
+        for url in ('/api/messages/poll/?after=x', '/api/messages/poll/?timeout=-1',
+                    '/api/messages/poll/?timeout=nan', '/api/messages/events/?after=-1'):
+            res = self.client.get(url, headers=self.receiver_credentials)
+            self.assertEqual(res.status_code, 400, url)
+
+    def test_hub(self):
+        """Tests that waits end on publish or on timeout."""
+        hub = NotificationHub()
+        self.assertFalse(hub.wait(1, 0, 0.01))
+        threading.Timer(0.05, hub.publish, (1, 10)).start()
+        self.assertTrue(hub.wait(1, 0, 5))
+        self.assertEqual(hub.state(1), (None, 1))
+        self.assertEqual(hub.stats()['waiting'], 0)
+
+    def test_hub_async(self):
+        """Tests that waits on the event loop end on publish or on timeout."""
+        hub = NotificationHub()
+
+        async def run():
+            timed_out = await hub.wait_async(1, 0, 0.01)
+            loop = asyncio.get_running_loop()
+            loop.call_later(0.05, threading.Thread(target=hub.publish, args=(1, 10)).start)
+            return timed_out, await hub.wait_async(1, 0, 5), hub.stats()['waiting']
+
+        self.assertEqual(asyncio.run(run()), (False, True, 0))
+        self.assertTrue(asyncio.run(hub.wait_async(1, 0, 5)))
+
+
+class TestSearch(TestBase):
+    """Tests for the full-text search endpoint."""
+
+    def setUp(self):
+        super().setUp()
+        self.credentials = auth_header('homer', '1234')
+
+    def search(self, query, credentials=None):
+        """Returns the (type, id) of the results of a search."""
+        res = self.client.get(f'/api/search/?{query}', headers=credentials or self.credentials)
+        self.assertEqual(res.status_code, 200)
+        return [(item['type'], item['id']) for item in res.json]
+
+    def test_search(self):
+        """Tests that results are ranked and scoped to the user."""
+        res = self.client.get('/api/search/?q=doughnuts', headers=self.credentials)
+        self.assertEqual(res.json[0], {'type': 'project', 'id': 1, 'project_id': 1,
+                                       'text': 'Doughnuts', 'score': res.json[0]['score']})
+        self.assertEqual(sorted(self.search('q=doughnuts')[1:]), [('task', 1), ('task', 4)])
+        self.assertEqual(self.search('q=eat+everyday'), [('task', 3), ('task', 4)])
+        self.assertEqual(self.search('q=doughnuts', auth_header('bart', '1234')), [])
+
+    def test_prefix(self):
+        """Tests that a trailing '*' matches the last word as a prefix."""
+        self.assertEqual(self.search('q=dough'), [])
+        self.assertEqual(len(self.search('q=dough*')), 3)
+
+    def test_type_and_pagination(self):
+        """Tests filtering by type and following the next links."""
+        res = self.client.get('/api/search/?q=eat&type=task&limit=2', headers=self.credentials)
+        found = [item['id'] for item in res.json]
+        while next_link(res):
+            res = self.client.get(next_link(res), headers=self.credentials)
+            found.extend(item['id'] for item in res.json)
+        self.assertEqual(sorted(found), [2, 3, 4, 5])
+
+    def test_index_follows_writes(self):
+        """Tests that inserts, updates and deletes are reflected in the index."""
+        res = self.client.post('/api/projects/1/tasks/', json={'title': 'Buy sprinkles', 'completed': 0},
+                               headers=self.credentials)
+        task_id = res.json['id']
+        self.assertEqual(self.search('q=sprinkles'), [('task', task_id)])
+        self.client.put(f'/api/projects/1/tasks/{task_id}/', json={'title': 'Buy icing', 'completed': 0},
+                        headers=self.credentials)
+        self.assertEqual(self.search('q=sprinkles'), [])
+        self.assertEqual(self.search('q=icing'), [('task', task_id)])
+        self.client.delete('/api/projects/1/', headers=self.credentials)
+        self.assertEqual(self.search('q=icing'), [])
+        self.assertEqual(self.search('q=doughnuts'), [('task', 4)])
+
+    def test_messages(self):
+        """Tests that messages are found by their sender and receiver only."""
+        self.client.post('/api/messages/', json={'receiver_id': 2, 'content': 'Skateboard later?'},
+                         headers=self.credentials)
+        self.client.post('/api/user/register/', json={'name': 'Lisa', 'email': 'lisa@simpsons.org',
+                                                      'username': 'lisa', 'password': '1234'})
+        self.assertEqual(self.search('q=skateboard'), [('message', 1)])
+        self.assertEqual(self.search('q=skateboard', auth_header('bart', '1234')), [('message', 1)])
+        self.assertEqual(self.search('q=skateboard', auth_header('lisa', '1234')), [])
+        self.client.delete('/api/messages/1/', headers=self.credentials)
+        self.assertEqual(self.search('q=skateboard'), [])
+
+    def test_invalid_parameters(self):
+        """Tests that empty queries, unknown types and bad pages are rejected."""
+        for query in ('q=', 'q=%22*%22', 'q=eat&type=user', 'q=eat&offset=-1', 'q=eat&limit=0'):
+            res = self.client.get(f'/api/search/?{query}', headers=self.credentials)
+            self.assertEqual(res.status_code, 400, query)
+
+
+class TestProjectSummary(TestBase):
+    """Tests for the task counters of projects."""
+
+    def setUp(self):
+        super().setUp()
+        self.credentials = auth_header('homer', '1234')
+
+    def summaries(self):
+        """Returns the summaries of homer's projects by id."""
+        res = self.client.get('/api/projects/summary/', headers=self.credentials)
+        self.assertEqual(res.status_code, 200)
+        return {item['id']: (item['task_count'], item['completed_count'], item['completion_ratio'])
+                for item in res.json}
+
+    def assert_counts_match_tasks(self):
+        """Asserts that the counters equal the counts of the task table."""
+        for project_id, (total, completed, _) in self.summaries().items():
+            row = db.execute_query('SELECT COUNT(*) AS total, SUM(completed != 0) AS completed '
+                                   'FROM task WHERE project_id=?', (project_id,)).fetchone()
+            self.assertEqual((total, completed), (row['total'], row['completed'] or 0), project_id)
+
+    def test_summary(self):
+        """Tests the summary endpoint and the inline fields of the project list."""
+        self.assertEqual(self.summaries(), {1: (2, 1, 0.5), 2: (3, 2, 2 / 3)})
+        res = self.client.get('/api/projects/?summary=1', headers=self.credentials)
+        self.assertEqual(res.json[0]['title'], 'Doughnuts')
+        self.assertEqual(res.json[0]['task_count'], 2)
+        res = self.client.get('/api/projects/', headers=self.credentials)
+        self.assertNotIn('task_count', res.json[0])
+
+    def test_counters_follow_writes(self):
+        """Tests that every task write keeps the counters exact."""
+        self.client.post('/api/projects/1/tasks/', json={'title': 'More', 'completed': 1},
+                         headers=self.credentials)
+        self.client.patch('/api/tasks/1/completed/', json={'completed': 0}, headers=self.credentials)
+        self.client.put('/api/projects/2/tasks/3/', json={'title': 'Veg', 'completed': 0},
+                        headers=self.credentials)
+        self.client.post('/api/projects/2/tasks/batch/', json=[
+            {'op': 'create', 'title': 'A', 'completed': 1},
+            {'op': 'update', 'id': 5, 'completed': 1},
+            {'op': 'delete', 'id': 4}], headers=self.credentials)
+        self.client.delete('/api/projects/1/tasks/2/', headers=self.credentials)
+        self.assertEqual(self.summaries(), {1: (2, 1, 0.5), 2: (3, 2, 2 / 3)})
+        self.assert_counts_match_tasks()
+        self.client.post('/api/projects/', json={'title': 'Empty'}, headers=self.credentials)
+        self.client.delete('/api/projects/1/', headers=self.credentials)
+        self.assertEqual(self.summaries(), {2: (3, 2, 2 / 3), 4: (0, 0, None)})
+
+    def test_task_writes_change_etag(self):
+        """Tests that the summary ETag changes when a task is completed."""
+        res = self.client.get('/api/projects/summary/', headers=self.credentials)
+        self.client.patch('/api/tasks/2/completed/', json={'completed': 1}, headers=self.credentials)
+        res = self.client.get('/api/projects/summary/',
+                              headers={**self.credentials, 'If-None-Match': res.get_etag()[0]})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json[0]['completed_count'], 2)
+
+
+class TestWorkspaces(TestBase):
+    """Tests for the NDJSON export and import of a user's workspace."""
+
+    def setUp(self):
+        super().setUp()
+        self.homer = auth_header('homer', '1234')
+        self.bart = auth_header('bart', '1234')
+        self.client.post('/api/messages/', json={'receiver_id': 1, 'content': 'Eat my shorts'},
+                         headers=self.bart)
+
+    def tearDown(self):
+        app.config['IMPORT_BATCH_SIZE'] = 500
+
+    def export(self, headers):
+        res = self.client.get('/api/export/', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        return [json.loads(line) for line in res.get_data(as_text=True).splitlines()]
+
+    def import_(self, body, headers):
+        return self.client.post('/api/import/', data=body, headers=headers,
+                                content_type='application/x-ndjson')
+
+    def test_export(self):
+        """Tests that projects are followed by their tasks, then messages come."""
+        with self.client.get('/api/export/', headers=self.homer, buffered=False) as res:
+            self.assertTrue(res.is_streamed)
+        records = self.export(self.homer)
+        self.assertEqual([(r['type'], r['id']) for r in records],
+                         [('project', 1), ('task', 1), ('task', 2), ('project', 2),
+                          ('task', 3), ('task', 4), ('task', 5), ('message', 1)])
+        self.assertEqual(records[0]['title'], 'Doughnuts')
+        self.assertNotIn('user_id', records[0])
+        self.assertEqual(records[-1]['sender_id'], 2)
+
+    def test_export_requires_auth(self):
+        """Tests that exporting requires authorization."""
+        self.assertEqual(self.client.get('/api/export/').status_code, 403)
+        self.assertEqual(self.import_('', {}).status_code, 403)
+
+    def test_round_trip(self):
+        """Tests importing an export into another workspace in small batches."""
+        app.config['IMPORT_BATCH_SIZE'] = 3
+        body = self.client.get('/api/export/', headers=self.homer).data
+        res = self.import_(body, self.bart)
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(res.json['imported'], {'projects': 2, 'tasks': 5, 'messages': 1})
+        records = self.export(self.bart)
+        projects = [r for r in records if r['type'] == 'project']
+        self.assertEqual([p['title'] for p in projects],
+                         ['Save the world!', 'Doughnuts', 'Eat well'])
+        tasks = [r for r in records if r['type'] == 'task']
+        by_project = {p['id']: p['title'] for p in projects}
+        self.assertEqual([(by_project[t['project_id']], t['title']) for t in tasks][3:],
+                         [('Doughnuts', 'Search for doughnuts'), ('Doughnuts', 'Eat cream'),
+                          ('Eat well', 'Eat vegetables everyday'),
+                          ('Eat well', 'Eat doughnuts everyday'), ('Eat well', 'Eat lots of sugar')])
+        res = self.client.get('/api/projects/summary/', headers=self.bart)
+        self.assertEqual([p['task_count'] for p in res.json], [3, 2, 3])
+        res = self.client.get('/api/messages/', headers=self.bart)
+        self.assertEqual(res.json[-1]['content'], 'Eat my shorts')
+
+    def test_invalid_record(self):
+        """Tests that the records before an invalid one are kept."""
+        app.config['IMPORT_BATCH_SIZE'] = 2
+        body = '\n'.join([
+            json.dumps({'type': 'project', 'id': 10, 'title': 'Skate'}),
+            '',
+            json.dumps({'type': 'task', 'id': 1, 'project_id': 10, 'title': 'Ollie'}),
+            json.dumps({'type': 'task', 'id': 2, 'project_id': 10, 'title': 'Kickflip'}),
+            json.dumps({'type': 'task', 'id': 3, 'project_id': 11, 'title': 'Grind'}),
+            json.dumps({'type': 'task', 'id': 4, 'project_id': 10, 'title': 'Never'}),
+        ])
+        res = self.import_(body, self.bart)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.json['error'], 'Unknown project')
+        self.assertEqual(res.json['line'], 5)
+        self.assertEqual(res.json['imported'], {'projects': 1, 'tasks': 2, 'messages': 0})
+        res = self.import_('{"type": "project", "id": 1', self.bart)
+        self.assertEqual((res.status_code, res.json['error']), (400, 'Invalid JSON'))
+        res = self.import_('{"type": "user", "id": 1}', self.bart)
+        self.assertEqual(res.json['error'], 'Invalid record type')
+
+    def test_invalid_values(self):
+        """Tests that records with values of the wrong type are rejected with their line."""
+        for record in ({'type': 'project', 'id': 10, 'title': ['Skate']},
+                       {'type': 'project', 'id': 10, 'title': 'Skate', 'creation_date': [1]},
+                       {'type': 'task', 'id': 1, 'project_id': 1, 'title': 'Ollie', 'completed': {}},
+                       {'type': 'task', 'id': 1, 'project_id': 1, 'title': 'Ollie', 'completed': 2},
+                       {'type': 'task', 'id': 1, 'project_id': True, 'title': 'Ollie'},
+                       {'type': 'message', 'sender_id': 1, 'content': {}},
+                       {'type': 'message', 'sender_id': 1, 'content': 'Hi', 'timestamp': 1}):
+            rate_limiter.clear()
+            body = json.dumps({'type': 'project', 'id': 1, 'title': 'Skate'}) + '\n' + json.dumps(record)
+            res = self.import_(body, self.bart)
+            self.assertEqual(res.status_code, 400, record)
+            self.assertEqual((res.json['error'], res.json['line']), (f"Invalid {record['type']}", 2))
+        body = json.dumps({'type': 'project', 'id': 1, 'title': 'Skate'}) + '\n' + json.dumps(
+            {'type': 'task', 'id': 1, 'project_id': 1, 'title': 'Ollie', 'completed': True})
+        res = self.import_(body, self.bart)
+        self.assertEqual(res.status_code, 201)
+
+    def test_imported_messages_are_not_forged(self):
+        """Tests that an imported message cannot be attributed to, or shown to, another user."""
+        res = self.import_(json.dumps({'type': 'message', 'sender_id': 2, 'content': 'Forged'}),
+                           self.homer)
+        self.assertEqual(res.status_code, 201)
+        res = self.client.get('/api/messages/', headers=self.homer)
+        forged = [message for message in res.json if message['content'] == 'Forged']
+        self.assertEqual([(m['sender_id'], m['receiver_id']) for m in forged], [(1, 1)])
+        res = self.client.get(f"/api/messages/{forged[0]['id']}/", headers=self.bart)
+        self.assertEqual(res.status_code, 404)
+        res = self.client.get('/api/search/?q=Forged', headers=self.bart)
+        self.assertEqual(res.json, [])
+
+    def test_record_too_large(self):
+        """Tests that records are read with a bounded size."""
+        app.config['MAX_IMPORT_RECORD_SIZE'] = 64
+        try:
+            res = self.import_(json.dumps({'type': 'project', 'id': 1, 'title': 'x' * 100}),
+                               self.bart)
+        finally:
+            app.config['MAX_IMPORT_RECORD_SIZE'] = 1024 * 1024
+        self.assertEqual((res.status_code, res.json['error']), (400, 'Record too large'))
+
+    def test_import_invalidates_cached_lists(self):
+        """Tests that imported projects show up in cached and conditional reads."""
+        res = self.client.get('/api/projects/', headers=self.bart)
+        etag = res.headers['ETag']
+        self.import_(json.dumps({'type': 'project', 'id': 1, 'title': 'Skate'}), self.bart)
+        res = self.client.get('/api/projects/', headers=dict(self.bart, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.json), 2)
+
+
+class TestSync(TestBase):
+    """Tests for the change log and the delta sync."""
+
+    def setUp(self):
+        super().setUp()
+        self.homer = auth_header('homer', '1234')
+
+    def sync(self, since=0, **params):
+        res = self.client.get('/api/sync/', query_string={'since': since, **params},
+                              headers=self.homer)
+        self.assertEqual(res.status_code, 200)
+        return res.get_json()
+
+    def test_full_sync(self):
+        """Tests that syncing from 0 returns every row of the user."""
+        data = self.sync()
+        self.assertEqual([(c['type'], c['id']) for c in data['changes']],
+                         [('project', 1), ('project', 2)] + [('task', i) for i in range(1, 6)])
+        self.assertEqual(data['changes'][0], {'seq': 1, 'type': 'project', 'id': 1,
+                                              'title': 'Doughnuts', 'creation_date': '2020-05-01',
+                                              'last_updated': '2020-06-01'})
+        self.assertEqual(data['seq'], data['changes'][-1]['seq'])
+        self.assertFalse(data['more'])
+
+    def test_changes_since(self):
+        """Tests that only the latest change of each row written since is returned."""
+        since = self.sync()['seq']
+        self.assertEqual(self.sync(since), {'changes': [], 'seq': since, 'more': False})
+        self.client.put('/api/projects/1/tasks/2/', json={'title': 'Eat more cream', 'completed': 0},
+                        headers=self.homer)
+        self.client.patch('/api/tasks/2/completed/', json={'completed': 1}, headers=self.homer)
+        self.client.delete('/api/projects/1/tasks/1/', headers=self.homer)
+        res = self.client.post('/api/projects/', json={'title': 'Beer'}, headers=self.homer)
+        project_id = res.get_json()['id']
+        self.client.post('/api/messages/', json={'receiver_id': 1, 'content': 'Hi dad'},
+                         headers=auth_header('bart', '1234'))
+        # Bart's own writes are not in Homer's log
+        self.client.put('/api/projects/3/', json={'title': 'Save Springfield'},
+                        headers=auth_header('bart', '1234'))
+        changes = self.sync(since)['changes']
+        self.assertEqual([(c['type'], c['id'], c.get('deleted', False)) for c in changes],
+                         [('task', 2, False), ('task', 1, True), ('project', project_id, False),
+                          ('message', 1, False)])
+        self.assertEqual((changes[0]['title'], changes[0]['completed']), ('Eat more cream', 1))
+        self.assertEqual(changes[1], {'seq': changes[1]['seq'], 'type': 'task', 'id': 1,
+                                      'deleted': True})
+        self.assertEqual(changes[3]['content'], 'Hi dad')
+        # A full sync leaves out deleted rows
+        self.assertNotIn(('task', 1), [(c['type'], c['id']) for c in self.sync()['changes']])
+
+    def test_paging(self):
+        """Tests that changes are returned a page at a time."""
+        res = self.client.get('/api/sync/?limit=3', headers=self.homer)
+        data = res.get_json()
+        self.assertTrue(data['more'])
+        self.assertEqual(len(data['changes']), 3)
+        self.assertIn(f'since={data["seq"]}', res.headers['Link'])
+        changes = data['changes']
+        while data['more']:
+            data = self.sync(data['seq'], limit=3)
+            changes += data['changes']
+        self.assertEqual(changes, self.sync()['changes'])
+
+    def test_failed_compaction(self):
+        """Tests that a write whose compaction fails still succeeds."""
+        locked = sqlite3.OperationalError('database is locked')
+        with mock.patch('app.compact_changes', side_effect=locked), self.assertLogs(app.logger, 'ERROR'):
+            res = self.client.post('/api/projects/', json={'title': 'Once'}, headers=self.homer)
+        self.assertEqual(res.status_code, 201)
+        res = self.client.get('/api/projects/', headers=self.homer)
+        self.assertEqual([project['title'] for project in res.json].count('Once'), 1)
+
+    def test_compaction(self):
+        """Tests that old tombstones are dropped and older syncs are refused."""
+        since = self.sync()['seq']
+        self.client.delete('/api/projects/1/tasks/1/', headers=self.homer)
+        self.assertEqual(compact_changes(db, int(time.time()) - 60), 0)
+        self.assertEqual(len(self.sync(since)['changes']), 1)
+        self.assertEqual(compact_changes(db, int(time.time()) + 1), 1)
+        res = self.client.get(f'/api/sync/?since={since}', headers=self.homer)
+        self.assertEqual(res.status_code, 410)
+        horizon = res.get_json()['horizon']
+        self.assertEqual(self.sync(horizon)['changes'], [])
+        # Other users are not affected, and full syncs still work
+        res = self.client.get(f'/api/sync/?since={since}', headers=auth_header('bart', '1234'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(self.sync()['changes']), 6)
+
+    def test_invalid_parameters(self):
+        """Tests that invalid parameters and anonymous requests are rejected."""
+        for query in ('since=-1', 'since=x', 'limit=0'):
+            res = self.client.get(f'/api/sync/?{query}', headers=self.homer)
+            self.assertEqual(res.status_code, 400, query)
+        self.assertEqual(self.client.get('/api/sync/').status_code, 403)
+
+
 class TestTaskCompleted(TestBase):
     """Tests for updating task completed status."""
 
@@ -288,5 +1064,1516 @@ class TestTaskCompleted(TestBase):
         self.assertEqual(res.status_code, 404)
 
 
+class TestFields(TestBase):
+    """Tests for the sparse fieldsets selected with 'fields'."""
+
+    def setUp(self):
+        super().setUp()
+        self.credentials = auth_header('homer', '1234')
+        self.client.post('/api/messages/', json={'receiver_id': 1, 'content': 'Hi dad'},
+                         headers=auth_header('bart', '1234'))
+
+    def get(self, url):
+        return self.client.get(url, headers=self.credentials)
+
+    def test_project_list(self):
+        """Tests that only the requested columns, and the id, are returned."""
+        res = self.get('/api/projects/?fields=title')
+        self.assertEqual(res.json, [{'id': 1, 'title': 'Doughnuts'}, {'id': 2, 'title': 'Eat well'}])
+        res = self.get('/api/projects/?fields=title&summary=1')
+        self.assertEqual(set(res.json[0]), {'id', 'title', 'task_count', 'completed_count',
+                                            'completion_ratio'})
+
+    def test_selected_columns(self):
+        """Tests that the query only selects the requested columns."""
+        statements = []
+        db.conn.set_trace_callback(statements.append)
+        try:
+            self.get('/api/projects/1/tasks/?fields=completed,title')
+        finally:
+            db.conn.set_trace_callback(None)
+        self.assertIn('SELECT task.id, task.completed, task.title FROM task WHERE project_id=1 '
+                      'AND id>0 ORDER BY id LIMIT 101', statements)
+
+    def test_pagination_and_streaming(self):
+        """Tests that pages are still linked when id is not requested."""
+        res = self.get('/api/projects/1/tasks/?fields=title&limit=1')
+        self.assertEqual(res.json, [{'id': 1, 'title': 'Search for doughnuts'}])
+        self.assertEqual(res.headers['X-Next-Cursor'], '1')
+        res = self.get('/api/projects/1/tasks/?fields=completed&stream=1')
+        self.assertEqual(res.json, [{'id': 1, 'completed': 1}, {'id': 2, 'completed': 0}])
+
+    def test_details(self):
+        """Tests the fields of single projects, tasks and messages."""
+        self.assertEqual(self.get('/api/projects/1/?fields=title').json,
+                         {'id': 1, 'title': 'Doughnuts'})
+        self.assertEqual(self.get('/api/projects/1/tasks/2/?fields=completed').json,
+                         {'id': 2, 'completed': 0})
+        self.assertEqual(self.get('/api/messages/1/?fields=content,sender_id').json,
+                         {'id': 1, 'content': 'Hi dad', 'sender_id': 2})
+        self.assertEqual(self.get('/api/messages/?fields=content').json,
+                         [{'id': 1, 'content': 'Hi dad'}])
+        self.assertEqual(self.get('/api/messages/poll/?after=0&timeout=0&fields=content').json,
+                         [{'id': 1, 'content': 'Hi dad'}])
+
+    def test_invalid_fields(self):
+        """Tests that fields are checked against the columns of each table."""
+        for url in ('/api/projects/?fields=password', '/api/projects/?fields=',
+                    '/api/projects/1/?fields=title,completed',
+                    '/api/projects/1/tasks/?fields=title;DROP TABLE task',
+                    '/api/projects/1/tasks/1/?fields=user_id', '/api/messages/?fields=*',
+                    '/api/messages/1/?fields=title', '/api/messages/poll/?fields=x'):
+            res = self.get(url)
+            self.assertEqual(res.status_code, 400, url)
+            self.assertEqual(res.json['error'], 'Invalid fields')
+
+    def test_etag_depends_on_fields(self):
+        """Tests that fieldsets of a list do not share an ETag."""
+        full = self.get('/api/projects/1/tasks/')
+        sparse = self.get('/api/projects/1/tasks/?fields=title')
+        self.assertNotEqual(full.headers['ETag'], sparse.headers['ETag'])
+
+
+class TestPagination(TestBase):
+    """Tests for the keyset pagination of the list endpoints."""
+
+    def setUp(self):
+        super().setUp()
+        self.credentials = auth_header('homer', '1234')
+        for i in range(25):
+            self.db.execute_update(
+                'INSERT INTO task (project_id, title, creation_date, completed) VALUES (?, ?, ?, ?)',
+                (1, f'Task {i}', '2024-06-28', 0))
+
+    def test_pages_follow_cursor(self):
+        """Tests walking every page through the next links."""
+        url = '/api/projects/1/tasks/?limit=10'
+        ids = []
+        pages = 0
+        while url:
+            res = self.client.get(url, headers=self.credentials)
+            self.assertEqual(res.status_code, 200)
+            self.assertLessEqual(len(res.json), 10)
+            ids.extend(task['id'] for task in res.json)
+            pages += 1
+            url = next_link(res)
+        self.assertEqual(pages, 3)
+        self.assertEqual(len(ids), 27)
+        self.assertEqual(ids, sorted(ids))
+
+    def test_next_cursor(self):
+        """Tests that the next cursor is the last id of the page."""
+        res = self.client.get('/api/projects/1/tasks/?limit=2', headers=self.credentials)
+        self.assertEqual(res.headers['X-Next-Cursor'], str(res.json[-1]['id']))
+        res = self.client.get('/api/projects/1/tasks/?limit=2&after=' + res.headers['X-Next-Cursor'],
+                              headers=self.credentials)
+        self.assertEqual(res.json[0]['title'], 'Task 0')
+
+    def test_link_keeps_query_parameters(self):
+        """Tests that query parameters named like route or url_for arguments do not alter the link."""
+        res = self.client.get('/api/projects/1/tasks/?limit=1&pk=9&_anchor=zz&_scheme=https',
+                              headers=self.credentials)
+        self.assertEqual(res.status_code, 200)
+        link = next_link(res)
+        self.assertTrue(link.startswith('/api/projects/1/tasks/?'), link)
+        self.assertNotIn('#', link)
+        self.assertIn('pk=9', link)
+        self.assertIn('_scheme=https', link)
+
+    def test_last_page_has_no_link(self):
+        """Tests that the last page does not link to a next page."""
+        res = self.client.get('/api/projects/', headers=self.credentials)
+        self.assertEqual(len(res.json), 2)
+        self.assertNotIn('Link', res.headers)
+
+    def test_page_size_is_capped(self):
+        """Tests that the page size is capped."""
+        max_page_size = app.config['MAX_PAGE_SIZE']
+        app.config['MAX_PAGE_SIZE'] = 5
+        try:
+            res = self.client.get('/api/projects/1/tasks/?limit=100', headers=self.credentials)
+        finally:
+            app.config['MAX_PAGE_SIZE'] = max_page_size
+        self.assertEqual(len(res.json), 5)
+        self.assertIn('limit=5', next_link(res))
+
+    def test_invalid_parameters(self):
+        """Tests invalid pagination parameters."""
+        for query in ('limit=0', 'limit=abc', 'after=-1'):
+            res = self.client.get('/api/messages/?' + query, headers=self.credentials)
+            self.assertEqual(res.status_code, 400, query)
+
+
+class TestStreaming(TestBase):
+    """Tests for the streamed list responses."""
+
+    def setUp(self):
+        super().setUp()
+        self.credentials = auth_header('homer', '1234')
+        app.config['STREAM_CHUNK_SIZE'] = 2
+        for i in range(5):
+            self.db.execute_update(
+                'INSERT INTO task (project_id, title, creation_date, completed) VALUES (?, ?, ?, ?)',
+                (1, f'Task {i}', '2024-06-28', 0))
+
+    def tearDown(self):
+        app.config['STREAM_CHUNK_SIZE'] = 500
+
+    def test_stream_json_array(self):
+        """Tests streaming a list as a JSON array."""
+        res = self.client.get('/api/projects/1/tasks/?stream=1', headers=self.credentials,
+                              buffered=False)
+        self.addCleanup(res.close)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.is_streamed)
+        self.assertEqual([task['title'] for task in res.json][-1], 'Task 4')
+        self.assertEqual(len(res.json), 7)
+
+    def test_stream_ndjson(self):
+        """Tests streaming a list as newline delimited JSON."""
+        headers = dict(self.credentials, Accept='application/x-ndjson')
+        res = self.client.get('/api/projects/1/tasks/?after=3', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        lines = res.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], [9, 10, 11, 12, 13])
+
+    def test_stream_empty_list(self):
+        """Tests streaming an empty list."""
+        res = self.client.get('/api/messages/?stream=1', headers=self.credentials)
+        self.assertEqual(res.json, [])
+
+    def test_stream_with_limit(self):
+        """Tests streaming a limited number of rows."""
+        res = self.client.get('/api/projects/1/tasks/?stream=1&limit=3', headers=self.credentials)
+        self.assertEqual(len(res.json), 3)
+
+
+class TestFormats(TestBase):
+    """Tests for the negotiated formats and the compression of responses."""
+
+    def setUp(self):
+        super().setUp()
+        self.credentials = auth_header('homer', '1234')
+        for i in range(50):
+            self.db.execute_update(
+                'INSERT INTO task (project_id, title, creation_date, completed) VALUES (?, ?, ?, ?)',
+                (1, f'Task {i}', '2024-06-28', i % 2))
+
+    def get(self, url, **headers):
+        return self.client.get(url, headers=dict(self.credentials, **headers))
+
+    def test_msgpack(self):
+        """Tests listing rows as MessagePack."""
+        expected = self.get('/api/projects/1/tasks/').json
+        res = self.get('/api/projects/1/tasks/', Accept='application/msgpack')
+        self.assertEqual(res.mimetype, 'application/msgpack')
+        self.assertIn('Accept', res.headers['Vary'])
+        self.assertEqual(unpack(res.data), expected)
+
+    def test_columns_json(self):
+        """Tests listing rows as JSON columns."""
+        expected = self.get('/api/projects/1/tasks/').json
+        res = self.get('/api/projects/1/tasks/', Accept='application/vnd.tasklists.columns+json')
+        self.assertEqual(res.mimetype, 'application/vnd.tasklists.columns+json')
+        data = res.json
+        self.assertEqual([dict(zip(data['columns'], row)) for row in data['rows']], expected)
+        self.assertLess(len(res.data), len(json.dumps(expected)))
+
+    def test_json_by_default(self):
+        """Tests that JSON is kept for clients accepting anything."""
+        res = self.get('/api/projects/1/tasks/', Accept='*/*')
+        self.assertEqual(res.mimetype, 'application/json')
+        res = self.get('/api/messages/poll/?timeout=0', Accept='application/msgpack')
+        self.assertEqual(unpack(res.data), [])
+
+    def test_gzip(self):
+        """Tests that large responses are compressed with gzip."""
+        plain = self.get('/api/projects/1/tasks/')
+        res = self.get('/api/projects/1/tasks/', **{'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(int(res.headers['Content-Length']), len(res.data))
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        self.assertLess(len(res.data), len(plain.data) / 3)
+
+    def test_deflate(self):
+        """Tests the deflate coding."""
+        plain = self.get('/api/projects/1/tasks/', Accept='application/msgpack')
+        res = self.get('/api/projects/1/tasks/', Accept='application/msgpack',
+                       **{'Accept-Encoding': 'deflate'})
+        self.assertEqual(res.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(res.data), plain.data)
+
+    def test_small_responses_are_not_compressed(self):
+        """Tests the size threshold and clients that refuse compression."""
+        res = self.get('/api/user/', **{'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+        res = self.get('/api/projects/1/tasks/', **{'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', res.headers)
+        res = self.get('/api/projects/1/tasks/')
+        self.assertNotIn('Content-Encoding', res.headers)
+
+    def test_streamed_gzip(self):
+        """Tests that streamed responses are compressed as they are sent."""
+        plain = self.get('/api/projects/1/tasks/?stream=1')
+        res = self.client.get('/api/projects/1/tasks/?stream=1', buffered=False,
+                              headers=dict(self.credentials, **{'Accept-Encoding': 'gzip'}))
+        self.addCleanup(res.close)
+        self.assertTrue(res.is_streamed)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+
+    def test_etag_of_compressed_response(self):
+        """Tests that compressed responses have their own ETag and still revalidate."""
+        plain = self.get('/api/projects/1/tasks/')
+        res = self.get('/api/projects/1/tasks/', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['ETag'], plain.headers['ETag'][:-1] + '-gzip"')
+        res = self.get('/api/projects/1/tasks/', **{'Accept-Encoding': 'gzip',
+                                                    'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+
+class TestConditionalRequests(TestBase):
+    """Tests for the ETags of the project and task endpoints."""
+
+    def setUp(self):
+        super().setUp()
+        self.credentials = auth_header('homer', '1234')
+
+    def get(self, url, etag=None, credentials=None):
+        headers = dict(credentials or self.credentials)
+        if etag:
+            headers['If-None-Match'] = f'"{etag}"'
+        return self.client.get(url, headers=headers)
+
+    def test_guessed_etag(self):
+        """Tests that an ETag computed without the server secret does not match."""
+        bart = auth_header('bart', '1234')
+        for pk in (2, 999):
+            stamp = (db.execute_query("SELECT version FROM version_stamp WHERE scope='project' "
+                                      'AND id=?', (pk,)).fetchone() or {'version': 0})['version']
+            path = f'/api/projects/{pk}/'
+            guess = hashlib.sha1('\0'.join(('project', str(pk), str(stamp), '2', path + '?', ''))
+                                 .encode()).hexdigest()
+            res = self.client.get(path, headers={**bart, 'If-None-Match': f'"{guess}"'})
+            self.assertEqual(res.status_code, 404, pk)
+
+    def test_not_modified(self):
+        """Tests that a matching ETag answers 304 after reading the version stamp only."""
+        for url in ('/api/projects/', '/api/projects/1/', '/api/projects/1/tasks/'):
+            res = self.get(url)
+            etag = res.get_etag()[0]
+            self.assertTrue(etag, url)
+            statements = []
+            db.conn.set_trace_callback(statements.append)
+            try:
+                res = self.get(url, etag)
+            finally:
+                db.conn.set_trace_callback(None)
+            self.assertEqual(res.status_code, 304, url)
+            self.assertEqual(res.get_data(), b'')
+            self.assertEqual(res.get_etag()[0], etag)
+            self.assertEqual(len(statements), 1, url)
+            self.assertTrue(statements[0].startswith('SELECT version FROM version_stamp'), url)
+
+    def test_writes_from_other_processes_update_etag(self):
+        """Tests that ETags change with writes that did not go through this process."""
+        etag = self.get('/api/projects/1/').get_etag()[0]
+        db.execute_update('UPDATE project SET title=? WHERE id=?', ('Elsewhere', 1))
+        res = self.get('/api/projects/1/', etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.get_etag()[0], etag)
+        # The body matches the new ETag, although the project was cached
+        self.assertEqual(res.json['title'], 'Elsewhere')
+
+    def test_task_changes_update_etag(self):
+        """Tests that changing a task changes the ETags of its project."""
+        etag = self.get('/api/projects/1/tasks/').get_etag()[0]
+        self.client.patch('/api/tasks/1/completed/', json={'completed': 0}, headers=self.credentials)
+        res = self.get('/api/projects/1/tasks/', etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.get_etag()[0], etag)
+
+    def test_project_changes_update_etag(self):
+        """Tests that creating a project changes the ETag of the list."""
+        etag = self.get('/api/projects/').get_etag()[0]
+        self.client.post('/api/projects/', json={'title': 'New Project'}, headers=self.credentials)
+        res = self.get('/api/projects/', etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.json), 3)
+
+    def test_etag_depends_on_user_and_query(self):
+        """Tests that ETags differ between users and pages."""
+        etag = self.get('/api/projects/1/').get_etag()[0]
+        res = self.get('/api/projects/1/', etag, auth_header('bart', '1234'))
+        self.assertEqual(res.status_code, 404)
+        etag = self.get('/api/projects/1/tasks/?limit=1').get_etag()[0]
+        res = self.get('/api/projects/1/tasks/', etag)
+        self.assertEqual(res.status_code, 200)
+
+
+class TestResponseCache(TestBase):
+    """Tests for the read-through cache of the detail views."""
+
+    def setUp(self):
+        super().setUp()
+        self.credentials = auth_header('homer', '1234')
+
+    def traced_get(self, url):
+        """Returns the response and the statements executed for a GET."""
+        statements = []
+        db.conn.set_trace_callback(statements.append)
+        try:
+            res = self.client.get(url, headers=self.credentials)
+        finally:
+            db.conn.set_trace_callback(None)
+        return res, statements
+
+    def test_repeated_reads_skip_database(self):
+        """Tests that repeated reads are served from the cache, but for the version stamp."""
+        for url in ('/api/projects/1/', '/api/projects/1/tasks/1/'):
+            self.client.get(url, headers=self.credentials)
+            res, statements = self.traced_get(url)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual([stmt for stmt in statements
+                              if not stmt.startswith('SELECT version FROM version_stamp')], [], url)
+
+    def test_stale_loads_are_not_cached(self):
+        """Tests that a value loaded before an invalidation is not cached."""
+        cache = TTLCache(maxsize=2)
+        generation = cache.generation()
+        cache.invalidate('a')
+        self.assertFalse(cache.set('a', 'old', generation))
+        self.assertTrue(cache.set('b', 'new', generation))
+        self.assertTrue(cache.set('a', 'new', cache.generation()))
+        # Keys invalidated by predicate, or forgotten, refuse older loads too
+        generation = cache.generation()
+        cache.invalidate_where(lambda key: key == 'c')
+        self.assertFalse(cache.set('d', 'old', generation))
+        generation = cache.generation()
+        for key in 'xyz':
+            cache.invalidate(key)
+        self.assertFalse(cache.set('x', 'old', generation))
+        self.assertEqual(cache.get('a'), 'new')
+
+    def test_read_through_race(self):
+        """Tests that a read racing with a write does not cache the old row."""
+        with app.test_request_context(headers=self.credentials):
+            g.user = {'id': 1}
+
+            def load():
+                row = db.execute_query('SELECT * FROM project WHERE id=1').fetchone()
+                db.execute_update('UPDATE project SET title=? WHERE id=1', ('Renamed',))
+                invalidate_project(1)
+                return row
+
+            self.assertEqual(read_through(('project', 1, 1), load)['title'], 'Doughnuts')
+            self.assertIsNone(response_cache.get(('project', 1, 1)))
+
+    def test_project_update_invalidates(self):
+        """Tests that updating a project invalidates its cached copy."""
+        self.client.get('/api/projects/1/', headers=self.credentials)
+        self.client.put('/api/projects/1/', json={'title': 'Renamed'}, headers=self.credentials)
+        res = self.client.get('/api/projects/1/', headers=self.credentials)
+        self.assertEqual(res.json['title'], 'Renamed')
+
+    def test_project_delete_invalidates_tasks(self):
+        """Tests that deleting a project invalidates its cached tasks."""
+        self.client.get('/api/projects/1/tasks/1/', headers=self.credentials)
+        self.client.delete('/api/projects/1/', headers=self.credentials)
+        res = self.client.get('/api/projects/1/', headers=self.credentials)
+        self.assertEqual(res.status_code, 404)
+        res = self.client.get('/api/projects/1/tasks/1/', headers=self.credentials)
+        self.assertEqual(res.status_code, 404)
+
+    def test_task_writes_invalidate(self):
+        """Tests that task updates, completion and batches invalidate the cache."""
+        url = '/api/projects/1/tasks/1/'
+        self.client.get(url, headers=self.credentials)
+        self.client.put(url, json={'title': 'Renamed', 'completed': 1}, headers=self.credentials)
+        self.assertEqual(self.client.get(url, headers=self.credentials).json['title'], 'Renamed')
+        self.client.patch('/api/tasks/1/completed/', json={'completed': 0}, headers=self.credentials)
+        self.assertEqual(self.client.get(url, headers=self.credentials).json['completed'], 0)
+        self.client.post('/api/projects/1/tasks/batch/', json=[{'op': 'delete', 'id': 1}],
+                         headers=self.credentials)
+        self.assertEqual(self.client.get(url, headers=self.credentials).status_code, 404)
+
+    def test_stats(self):
+        """Tests that the cache counters are exposed."""
+        self.client.get('/api/projects/1/', headers=self.credentials)
+        self.client.get('/api/projects/1/', headers=self.credentials)
+        stats = self.client.get('/api/stats/', headers=self.credentials).json['response_cache']
+        self.assertGreater(stats['hits'], 0)
+        self.assertIn('evictions', stats)
+
+
+class TestLoadBenchmark(TestBase):
+    """Smoke test for the load benchmark harness."""
+
+    def test_run(self):
+        """Tests seeding data and driving every endpoint through the test client."""
+        from benchmarks import load
+        dataset = load.seed(self.db, users=3, projects=2, tasks=3, messages=2)
+        self.assertEqual(len(dataset.tasks[dataset.users[0][0]]), 6)
+        result = load.run(load.TestClientDriver(app), dataset, 'mixed', threads=2,
+                          duration=10, requests=200)
+        self.assertEqual(result['overall']['requests'], 200)
+        self.assertEqual(result['overall']['errors'], 0)
+        self.assertIsNotNone(result['overall']['p99_ms'])
+
+
+class TestMetrics(TestBase):
+    """Tests for the metrics endpoint."""
+
+    def test_metrics(self):
+        """Tests that requests, queries and caches are reported."""
+        credentials = auth_header('homer', '1234')
+        self.client.get('/api/projects/', headers=credentials)
+        res = self.client.get('/api/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/plain')
+        text = res.get_data(as_text=True)
+        self.assertIn('tasklists_http_request_duration_seconds_count'
+                      '{route="/api/projects/",method="GET"}', text)
+        self.assertIn('tasklists_http_requests_total'
+                      '{route="/api/projects/",method="GET",status="200"}', text)
+        self.assertIn('tasklists_db_query_duration_seconds_bucket'
+                      '{statement="SELECT * FROM user WHERE username=? AND password=?",le="+Inf"}',
+                      text)
+        self.assertIn('tasklists_db_rows_total{statement="SELECT * FROM project WHERE user_id=? '
+                      'AND id>? ORDER BY id LIMIT ?"} ', text)
+        self.assertIn('tasklists_cache_misses_total{cache="auth"} 1', text)
+
+    def test_slow_query_log(self):
+        """Tests that slow queries are logged."""
+        observer = db.observer
+        threshold = observer.slow_query_seconds
+        observer.slow_query_seconds = 0
+        try:
+            with self.assertLogs('metrics', level='WARNING') as logs:
+                db.execute_query('SELECT * FROM user WHERE id=?', (1,)).fetchone()
+        finally:
+            observer.slow_query_seconds = threshold
+        self.assertIn('SELECT * FROM user WHERE id=?', logs.output[0])
+
+    def test_wait_time(self):
+        """Tests that waiting for the write lock is recorded."""
+        before = db.observer.wait_duration.count(('lock',))
+        with db.transaction():
+            pass
+        self.assertEqual(db.observer.wait_duration.count(('lock',)), before + 1)
+
+
+class TestLimits(TestBase):
+    """Tests for the rate limits and load shedding."""
+
+    def test_rate_limit(self):
+        """Tests that each user's budget of an endpoint is limited on its own."""
+        homer = auth_header('homer', '1234')
+        with mock.patch.dict(rate_limiter.budgets, {'project_list': (1.0, 2)}):
+            for _ in range(2):
+                self.assertEqual(self.client.get('/api/projects/', headers=homer).status_code, 200)
+            res = self.client.get('/api/projects/', headers=homer)
+            self.assertEqual(res.status_code, 429)
+            self.assertEqual(res.headers['Retry-After'], '1')
+            self.assertEqual(res.json, {'error': 'Too many requests'})
+            # Other endpoints and other users have their own buckets
+            self.assertEqual(self.client.get('/api/projects/1/', headers=homer).status_code, 200)
+            res = self.client.get('/api/projects/', headers=auth_header('bart', '1234'))
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(self.client.get('/api/metrics').status_code, 200)
+        self.assertIn('tasklists_http_requests_rejected_total{reason="rate_limit"}',
+                      self.client.get('/api/metrics').get_data(as_text=True))
+
+    def test_rate_limit_disabled(self):
+        """Tests that the rate limits can be turned off."""
+        homer = auth_header('homer', '1234')
+        with mock.patch.dict(rate_limiter.budgets, {'project_list': (1.0, 1)}), \
+                mock.patch.dict(app.config, {'RATE_LIMIT_ENABLED': False}):
+            for _ in range(3):
+                self.assertEqual(self.client.get('/api/projects/', headers=homer).status_code, 200)
+
+    def test_shed_in_flight(self):
+        """Tests that requests beyond the in-flight limit are shed, but not the metrics."""
+        homer = auth_header('homer', '1234')
+        with mock.patch.object(admission, 'max_in_flight', 1):
+            self.assertTrue(admission.enter())
+            try:
+                res = self.client.get('/api/projects/', headers=homer)
+                self.assertEqual(res.status_code, 503)
+                self.assertEqual(res.headers['Retry-After'], '1')
+                self.assertEqual(self.client.get('/api/metrics').status_code, 200)
+            finally:
+                admission.leave()
+            self.assertEqual(self.client.get('/api/projects/', headers=homer).status_code, 200)
+        self.assertEqual(admission.in_flight, 0)
+        self.assertEqual(admission.stats()['shed'], 1)
+
+    def test_streamed_response_in_flight(self):
+        """Tests that a streamed response is counted in flight until its body is closed."""
+        res = self.client.get('/api/projects/?stream=1', headers=auth_header('homer', '1234'),
+                              buffered=False)
+        self.assertEqual(admission.in_flight, 1)
+        res.close()
+        self.assertEqual(admission.in_flight, 0)
+
+    def test_pool_exhausted(self):
+        """Tests that running out of pooled connections sheds the request."""
+        with mock.patch.object(Database, 'execute_query', side_effect=PoolTimeout('No connection')):
+            res = self.client.get('/api/projects/', headers=auth_header('homer', '1234'))
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '1')
+        self.assertEqual(res.json, {'error': 'Database busy'})
+
+    @unittest.skipIf(db.pool_size, 'Readers only wait for writers on a shared connection')
+    def test_reads_observe_lock_wait(self):
+        """Tests that reads waiting for a transaction on the shared connection are observed."""
+        waits = []
+        started = threading.Event()
+
+        def write():
+            with db.transaction():
+                started.set()
+                time.sleep(0.1)
+
+        thread = threading.Thread(target=write)
+        with mock.patch.object(db.observer, 'on_wait', waits.append):
+            thread.start()
+            started.wait()
+            db.execute_query('SELECT id FROM project').fetchall()
+            thread.join()
+        self.assertGreaterEqual(max(waits), 0.05)
+
+    def test_shed_on_database_wait(self):
+        """Tests that requests are shed while database waits are long."""
+        homer = auth_header('homer', '1234')
+        db.observer.observe_wait('pool', 60.0)
+        self.assertEqual(self.client.get('/api/projects/', headers=homer).status_code, 503)
+        admission.clear()
+        self.assertEqual(self.client.get('/api/projects/', headers=homer).status_code, 200)
+
+
+class TestASGI(TestBase):
+    """Tests for the asyncio serving mode."""
+
+    def setUp(self):
+        super().setUp()
+        self.asgi = ASGIApp(app, max_workers=4)
+        self.credentials = auth_header('homer', '1234')
+
+    def tearDown(self):
+        self.asgi.executor.shutdown()
+        self.asgi.wait_executor.shutdown()
+
+    def call(self, method, path, query=b'', body=b'', headers=None):
+        """Calls the ASGI application and returns the status, headers and body."""
+        return asyncio.run(self.call_async(method, path, query, body, headers))
+
+    async def call_async(self, method, path, query=b'', body=b'', headers=None, on_send=None):
+        headers = [(name.lower().encode(), value.encode())
+                   for name, value in {**self.credentials, **(headers or {})}.items()]
+        scope = {'type': 'http', 'http_version': '1.1', 'method': method, 'path': path,
+                 'query_string': query, 'headers': headers}
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+            if on_send is not None:
+                await on_send(message)
+
+        await self.asgi(scope, receive, send)
+        body = b''.join(message.get('body', b'') for message in sent[1:])
+        return sent[0]['status'], dict(sent[0]['headers']), body, sent
+
+    def test_same_responses_as_flask(self):
+        """Tests that the routes answer as they do under WSGI."""
+        for path in ('/api/user/', '/api/projects/', '/api/projects/1/tasks/', '/api/projects/9/'):
+            status, _, body, _ = self.call('GET', path)
+            res = self.client.get(path, headers=self.credentials)
+            self.assertEqual(status, res.status_code, path)
+            self.assertEqual(body, res.get_data(), path)
+
+    def test_post(self):
+        """Tests a request with a body."""
+        status, _, body, _ = self.call('POST', '/api/projects/', body=b'{"title": "Async"}',
+                                       headers={'Content-Type': 'application/json'})
+        self.assertEqual(status, 201)
+        url = f"/api/projects/{json.loads(body)['id']}/"
+        self.assertEqual(self.client.get(url, headers=self.credentials).json['title'], 'Async')
+        status, _, _, _ = self.call('GET', '/api/user/', headers=auth_header('homer', 'wrong'))
+        self.assertEqual(status, 403)
+
+    def test_streaming(self):
+        """Tests that streamed bodies are sent in several messages."""
+        app.config['STREAM_CHUNK_SIZE'] = 1
+        try:
+            status, headers, body, sent = self.call('GET', '/api/projects/', query=b'stream=1')
+        finally:
+            app.config['STREAM_CHUNK_SIZE'] = 500
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'content-type'], b'application/json')
+        self.assertEqual(len(json.loads(body)), 2)
+        self.assertGreater(len(sent), 2)
+        self.assertFalse(sent[-1].get('more_body', False))
+
+    def test_waiting_requests(self):
+        """Tests that long polls do not delay other requests."""
+        self.asgi = ASGIApp(app, max_workers=2, waits=endpoint_matcher(app, WAITING_ENDPOINTS))
+        bart = auth_header('bart', '1234')
+
+        async def run():
+            polls = [asyncio.ensure_future(self.call_async('GET', '/api/messages/poll/',
+                                                           b'timeout=1', headers=bart))
+                     for _ in range(2)]
+            await asyncio.sleep(0.1)
+            start = time.monotonic()
+            status, _, _, _ = await self.call_async('GET', '/api/projects/')
+            elapsed = time.monotonic() - start
+            await asyncio.gather(*polls)
+            return status, elapsed
+
+        status, elapsed = asyncio.run(run())
+        self.assertEqual(status, 200)
+        self.assertLess(elapsed, 0.5)
+
+    def test_waiting_streams(self):
+        """Tests that event streams hold no thread while they wait for messages."""
+        self.asgi = ASGIApp(app, max_workers=2, waits=endpoint_matcher(app, WAITING_ENDPOINTS),
+                            max_waiting=1)
+        bart = auth_header('bart', '1234')
+
+        async def run():
+            streams = [asyncio.ensure_future(self.call_async('GET', '/api/messages/events/',
+                                                             b'timeout=1', headers=bart))
+                       for _ in range(3)]
+            await asyncio.sleep(0.2)
+            waiting = message_hub.stats()['waiting']
+            status, _, _, _ = await self.call_async(
+                'POST', '/api/messages/', body=b'{"receiver_id": 2, "content": "Hi"}',
+                headers={'Content-Type': 'application/json'})
+            bodies = [body for _, _, body, _ in await asyncio.gather(*streams)]
+            return waiting, status, bodies
+
+        waiting, status, bodies = asyncio.run(run())
+        self.assertEqual(waiting, 3)
+        self.assertEqual(status, 201)
+        self.assertTrue(all(b'event: message' in body for body in bodies))
+
+    def test_slow_client(self):
+        """Tests that a client that stops reading a streamed body holds no thread."""
+        self.asgi = ASGIApp(app, max_workers=1)
+        db.execute_batch([('INSERT INTO project (user_id, title, creation_date, last_updated) '
+                           "VALUES (1, ?, '2024-06-24', '2024-06-24')", (f'Project {idx}',))
+                          for idx in range(30)])
+        app.config['STREAM_CHUNK_SIZE'] = 1
+        self.addCleanup(app.config.__setitem__, 'STREAM_CHUNK_SIZE', 500)
+
+        async def run():
+            resume = asyncio.Event()
+
+            async def stall(message):
+                if message['type'] == 'http.response.body':
+                    await resume.wait()
+
+            stream = asyncio.ensure_future(self.call_async('GET', '/api/projects/', b'stream=1',
+                                                           on_send=stall))
+            await asyncio.sleep(0.1)
+            status, _, _, _ = await asyncio.wait_for(self.call_async('GET', '/api/user/'), 2)
+            resume.set()
+            _, _, body, _ = await stream
+            return status, body
+
+        status, body = asyncio.run(run())
+        self.assertEqual(status, 200)
+        self.assertEqual(len(json.loads(body)), 32)
+
+    def test_http_server(self):
+        """Tests keep-alive requests while many idle clients are connected."""
+        loop = asyncio.new_event_loop()
+        server = HTTPServer(self.asgi, port=0)
+        loop.run_until_complete(server.start())
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        idle = [socket.create_connection(('127.0.0.1', server.port)) for _ in range(200)]
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+            for path in ('/api/projects/', '/api/projects/1/tasks/?stream=1'):
+                conn.request('GET', path, headers=self.credentials)
+                res = conn.getresponse()
+                self.assertEqual(res.status, 200)
+                self.assertEqual(len(json.loads(res.read())), 2)
+            conn.request('POST', '/api/projects/', body=b'{"title": "x"}',
+                         headers={**self.credentials, 'Content-Type': 'application/json'})
+            self.assertEqual(conn.getresponse().status, 201)
+            conn.close()
+        finally:
+            for sock in idle:
+                sock.close()
+            asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+
+class TestQueryPlans(TestBase):
+    """Checks that no statement issued by the API scans a whole table."""
+
+    # Requests that exercise every API view, in an order that keeps the
+    # referenced rows alive until they are deleted.
+    requests = [
+        ('get', '/api/user/', None),
+        ('put', '/api/user/', {'name': 'Homer Simpson', 'email': 'homer@simpsons.org',
+                               'username': 'homer', 'password': '1234'}),
+        ('post', '/api/user/register/', {'name': 'Lisa Simpson', 'email': 'lisa@simpsons.org',
+                                         'username': 'lisa', 'password': '1234'}),
+        ('get', '/api/stats/', None),
+        ('post', '/api/token/', None),
+        ('get', '/api/metrics', None),
+        ('get', '/api/projects/', None),
+        ('get', '/api/projects/?summary=1', None),
+        ('get', '/api/projects/summary/', None),
+        ('get', '/api/projects/?fields=title&summary=1', None),
+        ('post', '/api/projects/', {'title': 'New Project'}),
+        ('get', '/api/projects/1/', None),
+        ('put', '/api/projects/1/', {'title': 'Updated Project'}),
+        ('get', '/api/projects/1/tasks/', None),
+        ('get', '/api/projects/1/tasks/?limit=1&after=1', None),
+        ('get', '/api/projects/1/tasks/?stream=1', None),
+        ('get', '/api/projects/1/tasks/?fields=title,completed', None),
+        ('post', '/api/projects/1/tasks/', {'title': 'New Task', 'completed': 0}),
+        ('get', '/api/projects/1/tasks/1/', None),
+        ('put', '/api/projects/1/tasks/1/', {'title': 'Updated Task', 'completed': 1}),
+        ('post', '/api/projects/1/tasks/batch/', [{'op': 'create', 'title': 'Batch Task'},
+                                                  {'op': 'update', 'id': 2, 'title': 'Batch'},
+                                                  {'op': 'delete', 'id': 99}]),
+        ('patch', '/api/tasks/2/completed/', {'completed': 1}),
+        ('post', '/api/messages/', {'receiver_id': 1, 'content': 'Hello, Homer!'}),
+        ('get', '/api/messages/', None),
+        ('get', '/api/messages/?fields=sender_id,content', None),
+        ('get', '/api/messages/poll/?after=0&timeout=0', None),
+        ('get', '/api/messages/events/?after=0&timeout=0', None),
+        ('get', '/api/messages/1/', None),
+        ('get', '/api/search/?q=hello', None),
+        ('get', '/api/export/', None),
+        ('post', '/api/import/', {'type': 'project', 'id': 7, 'title': 'Imported'}),
+        ('delete', '/api/messages/1/', None),
+        ('delete', '/api/projects/1/tasks/1/', None),
+        ('delete', '/api/projects/1/', None),
+        ('get', '/api/sync/', None),
+        ('get', '/api/sync/?since=3&limit=2', None),
+    ]
+
+    def setUp(self):
+        super().setUp()
+        self.credentials = auth_header('homer', '1234')
+        self.statements = []
+        self.endpoints = set()
+
+    def record_endpoint(self, sender, **extra):
+        """Records the endpoint of every request."""
+        self.endpoints.add(request.endpoint)
+
+    def exercise_api(self):
+        """Issues every request while tracing the executed statements."""
+        db.conn.set_trace_callback(self.statements.append)
+        request_started.connect(self.record_endpoint, app)
+        try:
+            for method, url, data in self.requests:
+                res = getattr(self.client, method)(url, json=data, headers=self.credentials)
+                res.get_data()
+                self.assertLess(res.status_code, 400, f'{method.upper()} {url}')
+        finally:
+            request_started.disconnect(self.record_endpoint, app)
+            db.conn.set_trace_callback(None)
+
+    def test_every_endpoint_is_exercised(self):
+        """Tests that the suite covers every API view."""
+        self.exercise_api()
+        api_endpoints = {rule.endpoint for rule in app.url_map.iter_rules()
+                         if rule.rule.startswith('/api/')}
+        self.assertEqual(api_endpoints - self.endpoints, set())
+
+    def test_no_table_scans(self):
+        """Tests that every statement uses an index or the primary key."""
+        self.exercise_api()
+        # Leaves out the statements FTS5 runs on its own shadow tables
+        statements = {stmt for stmt in self.statements
+                      if stmt.split(None, 1)[0].upper() in ('SELECT', 'INSERT', 'UPDATE', 'DELETE')
+                      and "'main'." not in stmt}
+        self.assertTrue(statements)
+        for stmt in statements:
+            plan = db.execute_query('EXPLAIN QUERY PLAN ' + stmt).fetchall()
+            # Full-text MATCH queries show as virtual table scans with an
+            # 'M' (match) constraint in their index; json_each scans the
+            # list of ids bound to the statement
+            scans = [row['detail'] for row in plan
+                     if row['detail'].startswith('SCAN ') and row['detail'] != 'SCAN CONSTANT ROW'
+                     and not row['detail'].startswith('SCAN json_each ')
+                     and not re.search(r'VIRTUAL TABLE INDEX \d+:.*M', row['detail'])]
+            self.assertEqual(scans, [], stmt)
+
+
+class TestDatabasePool(unittest.TestCase):
+    """Tests for the pooled, file-backed database mode."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = Database(filename=os.path.join(self.tmpdir, 'tasklists.db'),
+                           schema='schema.sql', pool_size=2, pool_timeout=0.1,
+                           busy_timeout=1000, synchronous='FULL', cache_size=-4000)
+        self.db.recreate()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_ensure_schema_returns_its_connection(self):
+        """Tests that creating the schema does not keep a pooled connection bound."""
+        database = Database(filename=os.path.join(self.tmpdir, 'single.db'),
+                            schema='schema.sql', pool_size=1, pool_timeout=0.1)
+        try:
+            database.ensure_schema()
+            database.ensure_schema()
+            result = []
+            thread = threading.Thread(target=lambda: result.append(
+                database.execute_query('SELECT COUNT(*) AS n FROM user').fetchone()['n']))
+            thread.start()
+            thread.join()
+            self.assertEqual(result, [2])
+        finally:
+            database.close()
+
+    def test_iter_query_across_threads(self):
+        """Tests that a query generator holds its own connection, whichever thread resumes it."""
+        self.db.release()
+        chunks = self.db.iter_query('SELECT id FROM user ORDER BY id', chunk_size=1)
+        self.assertEqual(next(chunks).value(0, 'id'), 1)
+        self.assertIsNone(getattr(self.db._local, 'conn', None))
+        result = []
+        thread = threading.Thread(target=lambda: result.extend(rows.value(0, 'id') for rows in chunks))
+        thread.start()
+        thread.join()
+        self.assertEqual(result, [2])
+        # Both connections are back in the pool
+        with self.db.checkout(), self.db.checkout():
+            pass
+
+    def test_older_schema_is_refused(self):
+        """Tests that a database created from another version of the schema is refused."""
+        filename = os.path.join(self.tmpdir, 'tasklists.db')
+        self.assertEqual(self.db.conn.execute('PRAGMA user_version').fetchone()['user_version'],
+                         schema_version('schema.sql'))
+        self.db.ensure_schema()
+        self.db.close()
+        conn = sqlite3.connect(filename)
+        conn.execute('PRAGMA user_version = 0')
+        conn.close()
+        self.db = Database(filename=filename, schema='schema.sql', pool_size=2)
+        with self.assertRaises(SchemaVersionError):
+            self.db.ensure_schema()
+
+    def test_memory_database_cannot_be_pooled(self):
+        """Tests that an in-memory database is rejected in pooled mode."""
+        with self.assertRaises(ValueError):
+            Database(filename=':memory:', schema='schema.sql', pool_size=2)
+
+    def test_pragmas(self):
+        """Tests that the connection pragmas are applied."""
+        conn = self.db.conn
+        self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()['journal_mode'], 'wal')
+        self.assertEqual(conn.execute('PRAGMA busy_timeout').fetchone()['timeout'], 1000)
+        self.assertEqual(conn.execute('PRAGMA synchronous').fetchone()['synchronous'], 2)
+        self.assertEqual(conn.execute('PRAGMA cache_size').fetchone()['cache_size'], -4000)
+
+    def test_connection_per_thread(self):
+        """Tests that each thread gets its own connection."""
+        seen = []
+
+        def worker():
+            with self.db.connection() as conn:
+                seen.append(conn)
+                self.db.execute_query('SELECT * FROM user').fetchall()
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        self.assertIsNot(seen[0], self.db.conn)
+
+    def test_release_returns_connection(self):
+        """Tests that released connections are reused."""
+        conn = self.db.conn
+        self.db.release()
+        self.assertIs(self.db.conn, conn)
+
+    def test_pool_is_bounded(self):
+        """Tests that checking out more connections than the pool size times out."""
+        errors = []
+        holding = threading.Event()
+        done = threading.Event()
+
+        def holder():
+            with self.db.connection():
+                holding.set()
+                done.wait()
+
+        def waiter():
+            try:
+                with self.db.connection():
+                    pass
+            except PoolTimeout as exc:
+                errors.append(exc)
+
+        self.db.conn
+        thread = threading.Thread(target=holder)
+        thread.start()
+        holding.wait()
+        other = threading.Thread(target=waiter)
+        other.start()
+        other.join()
+        done.set()
+        thread.join()
+        self.assertEqual(len(errors), 1)
+
+    def test_data_survives_reopening(self):
+        """Tests that a file database keeps its data."""
+        self.db.execute_update('INSERT INTO project (user_id, title) VALUES (?, ?)', (1, 'Kept'))
+        self.db.close()
+        reopened = Database(filename=self.db.filename, schema='schema.sql', pool_size=1)
+        reopened.ensure_schema()
+        row = reopened.execute_query('SELECT * FROM project WHERE title=?', ('Kept',)).fetchone()
+        reopened.close()
+        self.assertIsNotNone(row)
+
+
+class TestRows(unittest.TestCase):
+    """Tests for the tuple-backed query results."""
+
+    def setUp(self):
+        self.rows = Rows(('id', 'title', 'score'), [
+            (1, 'Doughnuts', 1.5),
+            (2, 'Caf\u00e9 "quoted", with comma', None),
+            (3, None, 2),
+        ])
+
+    def test_to_json(self):
+        """Tests that the JSON encoding matches the rows as dictionaries."""
+        self.assertEqual(json.loads(self.rows.to_json()), self.rows.to_list())
+        self.assertEqual(Rows(('id',), []).to_json(), '[]')
+
+    def test_to_ndjson(self):
+        """Tests the newline delimited JSON encoding."""
+        lines = self.rows.to_ndjson().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], list(self.rows))
+
+    def test_to_columns_json(self):
+        """Tests the JSON encoding with column names once and rows as arrays."""
+        data = json.loads(self.rows.to_columns_json())
+        self.assertEqual(data['columns'], ['id', 'title', 'score'])
+        self.assertEqual([dict(zip(data['columns'], row)) for row in data['rows']],
+                         self.rows.to_list())
+
+    def test_to_msgpack(self):
+        """Tests the MessagePack encoding."""
+        self.assertEqual(unpack(self.rows.to_msgpack()), self.rows.to_list())
+        self.assertEqual(Rows(('id',), []).to_msgpack(), b'\x90')
+
+    def test_packb(self):
+        """Tests MessagePack values at the boundaries of their encodings."""
+        values = [None, True, False, 0, 127, 128, 255, 256, 65536, 2 ** 32, -1, -32, -33,
+                  -129, -32769, -2 ** 31 - 1, 1.25, '', 'a' * 31, 'a' * 32, 'é' * 200,
+                  'x' * 70000, b'\x00\x01', list(range(20)), {'k': [1, {'n': None}]},
+                  {str(i): i for i in range(17)}]
+        for value in values:
+            self.assertEqual(unpack(packb(value)), value)
+        self.assertEqual(packb(1), b'\x01')
+        self.assertEqual(packb(-1), b'\xff')
+        self.assertEqual(packb('ab'), b'\xa2ab')
+        self.assertEqual(packb(300), b'\xcd\x01\x2c')
+
+    def test_indexing(self):
+        """Tests accessing rows and values."""
+        self.assertEqual(self.rows[0], {'id': 1, 'title': 'Doughnuts', 'score': 1.5})
+        self.assertEqual(len(self.rows[1:]), 2)
+        self.assertEqual(self.rows.value(2, 'id'), 3)
+
+    def test_fetch_rows(self):
+        """Tests fetching rows from the database."""
+        db.recreate()
+        rows = db.fetch_rows('SELECT id, title FROM project WHERE user_id=?', (1,))
+        self.assertEqual(rows.columns, ('id', 'title'))
+        self.assertEqual(rows.to_list(), [{'id': 1, 'title': 'Doughnuts'},
+                                          {'id': 2, 'title': 'Eat well'}])
+
+
+class TestLimiters(unittest.TestCase):
+    """Tests for the token buckets and the admission controller."""
+
+    def setUp(self):
+        self.now = 0.0
+        self.clock = lambda: self.now
+
+    def test_token_bucket(self):
+        """Tests that buckets allow bursts and refill at their rate."""
+        limiter = RateLimiter({'default': (2.0, 3)}, clock=self.clock)
+        self.assertEqual([limiter.acquire('a', 'default') for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(limiter.acquire('a', 'default'), 0.5)
+        self.assertEqual(limiter.acquire('b', 'default'), 0)
+        self.now += 0.5
+        self.assertEqual(limiter.acquire('a', 'default'), 0)
+        self.now += 10
+        self.assertEqual([limiter.acquire('a', 'default') for _ in range(4)][-1], 0.5)
+        self.assertEqual(limiter.stats(), {'buckets': 2, 'allowed': 8, 'limited': 2})
+
+    def test_bounded_buckets(self):
+        """Tests that the least recently used buckets are dropped."""
+        limiter = RateLimiter({'default': (1.0, 1)}, maxsize=2, clock=self.clock)
+        for key in 'abc':
+            limiter.acquire(key, 'default')
+        self.assertEqual(limiter.stats()['buckets'], 2)
+        self.assertEqual(limiter.acquire('a', 'default'), 0)
+        self.assertEqual(limiter.acquire('c', 'default'), 1.0)
+
+    def test_admission(self):
+        """Tests that the in-flight limit and recent waits shed requests."""
+        controller = AdmissionController(max_in_flight=2, max_wait=0.1, clock=self.clock)
+        self.assertTrue(controller.enter())
+        self.assertTrue(controller.enter(counted=False))
+        self.assertTrue(controller.enter())
+        self.assertFalse(controller.enter())
+        controller.leave()
+        self.assertTrue(controller.enter())
+        controller.leave()
+        controller.leave()
+        controller.observe_wait(1.0)
+        self.assertAlmostEqual(controller.recent_wait(), 0.25)
+        self.assertFalse(controller.enter())
+        # The recent wait halves every second without new waits
+        self.now += 2
+        self.assertAlmostEqual(controller.recent_wait(), 0.0625)
+        self.assertTrue(controller.enter())
+        self.assertEqual(controller.stats()['shed'], 2)
+
+    def test_parse_budgets(self):
+        """Tests parsing budgets from the environment."""
+        self.assertEqual(parse_budgets(''), {})
+        self.assertEqual(parse_budgets('default=50:100, project_list=0.5'),
+                         {'default': (50.0, 100), 'project_list': (0.5, 1)})
+
+
+class TestTransactions(unittest.TestCase):
+    """Tests for the transaction context manager."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = Database(filename=os.path.join(self.tmpdir, 'tasklists.db'),
+                           schema='schema.sql', pool_size=2)
+        self.db.recreate()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def count_projects(self):
+        """Counts the committed projects from another thread's connection."""
+        counts = []
+
+        def reader():
+            with self.db.connection():
+                counts.append(self.db.execute_query(
+                    'SELECT COUNT(*) AS n FROM project').fetchone()['n'])
+
+        thread = threading.Thread(target=reader)
+        thread.start()
+        thread.join()
+        return counts[0]
+
+    def test_commit_once(self):
+        """Tests that the writes are only visible after the block."""
+        with self.db.transaction():
+            self.db.execute_update('INSERT INTO project (user_id, title) VALUES (?, ?)', (1, 'A'))
+            self.db.execute_update('INSERT INTO project (user_id, title) VALUES (?, ?)', (1, 'B'))
+            self.assertEqual(self.count_projects(), 3)
+        self.assertEqual(self.count_projects(), 5)
+
+    def test_rollback(self):
+        """Tests that an exception undoes the whole block."""
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.db.execute_update('DELETE FROM task WHERE project_id=?', (1,))
+                raise RuntimeError
+        count = self.db.execute_query(
+            'SELECT COUNT(*) AS n FROM task WHERE project_id=?', (1,)).fetchone()['n']
+        self.assertEqual(count, 2)
+
+    def test_nested_savepoint(self):
+        """Tests that a failing nested block only undoes itself."""
+        with self.db.transaction():
+            self.db.execute_update('INSERT INTO project (user_id, title) VALUES (?, ?)', (1, 'Outer'))
+            with self.assertRaises(sqlite3.IntegrityError):
+                with self.db.transaction():
+                    self.db.execute_update('INSERT INTO project (user_id, title) VALUES (?, ?)',
+                                           (1, 'Inner'))
+                    self.db.execute_update('INSERT INTO user (username) VALUES (?)', ('homer',))
+        titles = [row['title'] for row in self.db.execute_query(
+            'SELECT title FROM project WHERE id>3').fetchall()]
+        self.assertEqual(titles, ['Outer'])
+
+    def test_shared_connection_readers_wait(self):
+        """Tests that readers of a shared connection never see an open transaction."""
+        database = Database(filename=':memory:', schema='schema.sql')
+        database.recreate()
+        written, counts = threading.Event(), []
+
+        def reader():
+            written.wait()
+            counts.append(database.execute_query('SELECT COUNT(*) AS n FROM project')
+                          .fetchone()['n'])
+            counts.append(len(database.fetch_rows('SELECT id FROM project')))
+
+        thread = threading.Thread(target=reader)
+        thread.start()
+        try:
+            with self.assertRaises(RuntimeError), database.transaction():
+                database.execute_update('INSERT INTO project (user_id, title) VALUES (?, ?)',
+                                        (1, 'Rolled back'))
+                written.set()
+                thread.join(0.1)
+                raise RuntimeError
+        finally:
+            thread.join()
+            database.close()
+        self.assertEqual(counts, [3, 3])
+
+
+class TestSnapshots(unittest.TestCase):
+    """Tests for recreating databases from snapshots."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = Database(filename=':memory:', schema='schema.sql')
+        self.db.recreate()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def count(self, table):
+        return self.db.execute_query(f'SELECT COUNT(*) AS n FROM {table}').fetchone()['n']
+
+    def test_recreate_discards_changes(self):
+        """Tests that recreating restores the schema's rows, indexes and triggers."""
+        self.db.execute_update('DELETE FROM task')
+        self.db.execute_update('INSERT INTO project (user_id, title) VALUES (?, ?)', (1, 'Extra'))
+        self.db.recreate()
+        self.assertEqual(self.count('task'), 8)
+        self.assertEqual(self.count('project'), 3)
+        self.db.execute_update('INSERT INTO task (project_id, title, completed) VALUES (?, ?, ?)',
+                               (3, 'Save Milhouse', 1))
+        summary = self.db.execute_query(
+            'SELECT task_count FROM project_summary WHERE project_id=?', (3,)).fetchone()
+        self.assertEqual(summary['task_count'], 4)
+
+    def test_baseline_is_built_once(self):
+        """Tests that the schema is only run once per version of the file."""
+        self.assertIs(baseline('schema.sql'), baseline('schema.sql'))
+
+    def test_version_stamps_are_redrawn(self):
+        """Tests that ETag versions do not repeat across restores."""
+        self.db.execute_update('UPDATE project SET title=? WHERE id=?', ('Donuts', 1))
+        snapshot = self.db.snapshot()
+        stmt = "SELECT version FROM version_stamp WHERE scope='user' AND id=1"
+        versions = set()
+        for _ in range(5):
+            self.db.restore(snapshot)
+            versions.add(self.db.execute_query(stmt).fetchone()['version'])
+        self.assertGreater(len(versions), 1)
+
+    def test_snapshot_and_restore(self):
+        """Tests that a snapshot brings back the rows it was taken with."""
+        self.db.execute_update('DELETE FROM message')
+        self.db.execute_update('INSERT INTO project (user_id, title) VALUES (?, ?)', (2, 'Kept'))
+        snapshot = self.db.snapshot()
+        self.db.execute_update('DELETE FROM project')
+        self.db.restore(snapshot)
+        self.assertEqual(self.count('project'), 4)
+
+    def test_file_database(self):
+        """Tests that a pooled file database keeps its journal mode when recreated."""
+        self.db.close()
+        self.db = Database(filename=os.path.join(self.tmpdir, 'tasklists.db'),
+                           schema='schema.sql', pool_size=2)
+        self.db.recreate()
+        self.db.execute_update('DELETE FROM project')
+        self.db.recreate()
+        self.assertEqual(self.count('project'), 3)
+        mode = self.db.conn.execute('PRAGMA journal_mode').fetchone()['journal_mode']
+        self.assertEqual(mode, 'wal')
+
+
+class TestGroupCommit(unittest.TestCase):
+    """Tests for the group commit write path."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = Database(filename=os.path.join(self.tmpdir, 'tasklists.db'),
+                           schema='schema.sql', pool_size=4, group_commit=True,
+                           commit_batch_size=16, commit_max_wait=0.01)
+        self.db.recreate()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def insert_concurrently(self, threads=8, rows=10):
+        """Inserts rows from many threads and returns their ids."""
+        ids = []
+
+        def writer(n):
+            with self.db.connection():
+                for i in range(rows):
+                    ids.append(self.db.execute_update(
+                        'INSERT INTO project (user_id, title) VALUES (?, ?)', (1, f'{n}-{i}')))
+
+        workers = [threading.Thread(target=writer, args=(n,)) for n in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return ids
+
+    def test_concurrent_writes_are_batched(self):
+        """Tests that concurrent writes share commits and keep their ids."""
+        ids = self.insert_concurrently()
+        self.assertEqual(len(set(ids)), 80)
+        count = self.db.execute_query('SELECT COUNT(*) AS n FROM project').fetchone()['n']
+        self.assertEqual(count, 83)
+        self.assertLess(self.db._committer.commits, 80)
+
+    def test_errors_are_isolated(self):
+        """Tests that a failing statement only fails its own caller."""
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.db.execute_update('INSERT INTO user (username) VALUES (?)', ('homer',))
+        uid = self.db.execute_update('INSERT INTO user (username) VALUES (?)', ('lisa',))
+        row = self.db.execute_query('SELECT * FROM user WHERE id=?', (uid,)).fetchone()
+        self.assertEqual(row['username'], 'lisa')
+
+    def test_batch(self):
+        """Tests that a batch goes through the writer thread."""
+        results = self.db.execute_batch([
+            ('INSERT INTO project (user_id, title) VALUES (?, ?)', (1, 'A')),
+            ('DELETE FROM project WHERE id=?', (999,)),
+        ])
+        self.assertEqual(results[0][0], 4)
+        self.assertEqual(results[1][1], 0)
+
+    def test_writes_after_restore(self):
+        """Tests that the committer and pooled connections see the restored schema."""
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.db.execute_update("INSERT INTO user (name, email, username, password) "
+                                   "VALUES ('Homer', 'homer@simpsons.org', 'homer', 'x')")
+        self.db.recreate()
+        self.db.release()
+        ids = self.insert_concurrently(threads=2, rows=2)
+        self.assertEqual(len(set(ids)), 4)
+        with self.db.connection():
+            count = self.db.execute_query('SELECT COUNT(*) AS n FROM project').fetchone()['n']
+        self.assertEqual(count, 7)
+
+    def test_writes_after_lost_transaction(self):
+        """Tests that the writer survives SQLite rolling back a whole batch."""
+        def lose_transaction(cursor):
+            cursor.execute('INSERT INTO project (user_id, title) VALUES (?, ?)', (1, 'lost'))
+            cursor.execute('ROLLBACK')
+        with self.assertRaises(sqlite3.OperationalError):
+            self.db._committer.submit(lose_transaction)
+        self.assertTrue(self.db._committer._thread.is_alive())
+        ids = self.insert_concurrently(threads=2, rows=2)
+        self.assertEqual(len(set(ids)), 4)
+        count = self.db.execute_query('SELECT COUNT(*) AS n FROM project').fetchone()['n']
+        self.assertEqual(count, 7)
+
+    def test_writes_observe_wait(self):
+        """Tests that the time writes wait to run is observed."""
+        waits = []
+        self.db.observer = mock.Mock(observe_wait=lambda kind, seconds: waits.append(kind))
+        self.insert_concurrently(threads=2, rows=2)
+        self.db.execute_batch([('UPDATE project SET title=? WHERE id=1', ('x',))])
+        self.assertEqual(waits, ['lock'] * 5)
+
+    def test_without_waiting_for_commit(self):
+        """Tests the relaxed durability mode."""
+        self.db.close()
+        self.db = Database(filename=os.path.join(self.tmpdir, 'tasklists.db'),
+                           schema='schema.sql', pool_size=4, group_commit=True,
+                           wait_for_commit=False)
+        ids = self.insert_concurrently(threads=4, rows=5)
+        self.db.close()
+        self.db = Database(filename=os.path.join(self.tmpdir, 'tasklists.db'), schema='schema.sql')
+        count = self.db.execute_query('SELECT COUNT(*) AS n FROM project').fetchone()['n']
+        self.assertEqual(len(set(ids)), 20)
+        self.assertEqual(count, 23)
+
+    def test_memory_database_is_rejected(self):
+        """Tests that group commit needs a file-backed database."""
+        with self.assertRaises(ValueError):
+            Database(filename=':memory:', schema='schema.sql', group_commit=True)
+
+
+class TestSharding(unittest.TestCase):
+    """Tests for users spread over several databases."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = ShardedDatabase(filename=os.path.join(self.tmpdir, 'tasklists.db'),
+                                  schema='schema.sql', shards=4, pool_size=2)
+        self.db.recreate()
+        self.db.release()
+        self.patch = mock.patch('app.db', self.db)
+        self.patch.start()
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        auth_cache.clear()
+        response_cache.clear()
+        message_hub.clear()
+        token_revocations.clear()
+        # Homer (1) and Bart (2) live on different shards
+        self.homer = self.db.for_user(1)
+        self.bart = self.db.for_user(2)
+
+    def tearDown(self):
+        self.patch.stop()
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def count(self, database, table, where='1', args=()):
+        with database.connection():
+            return database.execute_query(
+                f'SELECT COUNT(*) AS n FROM {table} WHERE {where}', args).fetchone()['n']
+
+    def test_placement(self):
+        """Tests that users are placed stably and evenly."""
+        self.assertEqual([self.db.shard_index(uid) for uid in range(1, 9)],
+                         [self.db.shard_index(uid) for uid in range(1, 9)])
+        self.assertNotEqual(self.db.shard_index(1), self.db.shard_index(2))
+        counts = [0] * 4
+        for uid in range(1, 4001):
+            counts[self.db.shard_index(uid)] += 1
+        self.assertLess(max(counts) - min(counts), 200)
+
+    def test_fixtures_are_split(self):
+        """Tests that the catalog keeps the users and each shard its own users' data."""
+        self.assertEqual(self.count(self.db.catalog, 'user'), 2)
+        self.assertEqual(self.count(self.db.catalog, 'project'), 0)
+        self.assertEqual(self.count(self.homer, 'project'), 2)
+        self.assertEqual(self.count(self.homer, 'task'), 5)
+        self.assertEqual(self.count(self.bart, 'project'), 1)
+        self.assertEqual(self.count(self.bart, 'user'), 0)
+        self.assertEqual(sum(self.count(shard, 'task') for shard in self.db.shards), 8)
+
+    def reopen(self, shards=4):
+        """Closes the databases and opens the files again with ensure_schema()."""
+        self.db.close()
+        self.db = ShardedDatabase(filename=os.path.join(self.tmpdir, 'tasklists.db'),
+                                  schema='schema.sql', shards=shards, pool_size=2)
+        self.db.ensure_schema()
+
+    def test_ensure_schema_creates_missing_databases(self):
+        """Tests that only missing databases are created, empty, and existing ones are kept."""
+        with self.bart.connection():
+            self.bart.execute_update("INSERT INTO project (user_id, title) VALUES (2, 'Skate')")
+        self.db.close()
+        for suffix in ('', '-wal', '-shm'):
+            path = self.homer.filename + suffix
+            if os.path.exists(path):
+                os.remove(path)
+        self.reopen()
+        self.homer, self.bart = self.db.for_user(1), self.db.for_user(2)
+        self.assertEqual(self.count(self.db.catalog, 'user'), 2)
+        self.assertEqual(self.count(self.bart, 'project'), 2)
+        self.assertEqual(self.count(self.homer, 'project'), 0)
+        self.assertEqual(self.count(self.homer, 'user'), 0)
+        with self.homer.connection():
+            seq = self.homer.execute_query(
+                "SELECT seq FROM sqlite_sequence WHERE name='message'").fetchone()['seq']
+        self.assertEqual(seq, self.db.shard_index(1) * ShardedDatabase.MESSAGE_ID_RANGE)
+
+    def test_shard_count_is_checked(self):
+        """Tests that databases created for another number of shards are refused."""
+        self.reopen()
+        for shards in (2, 8):
+            with self.assertRaises(ValueError):
+                self.reopen(shards)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'tasklists.shard4.db')))
+        self.reopen()
+        self.assertEqual(self.count(self.db.for_user(2), 'project'), 1)
+
+    def test_views_reach_the_user_shard(self):
+        """Tests that writes and reads go to the shard of the authenticated user."""
+        headers = auth_header('bart', '1234')
+        res = self.client.post('/api/projects/', json={'title': 'Skate'}, headers=headers)
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(self.count(self.bart, 'project', 'title=?', ('Skate',)), 1)
+        self.assertEqual(self.count(self.homer, 'project', 'title=?', ('Skate',)), 0)
+        res = self.client.get('/api/projects/', headers=auth_header('homer', '1234'))
+        self.assertEqual([p['title'] for p in res.get_json()], ['Doughnuts', 'Eat well'])
+
+    def test_cross_shard_message(self):
+        """Tests that a message is stored with its receiver and reachable by its sender."""
+        res = self.client.post('/api/messages/', json={'receiver_id': 2, 'content': 'Hi Bart'},
+                               headers=auth_header('homer', '1234'))
+        self.assertEqual(res.status_code, 201)
+        message_id = res.get_json()['id']
+        self.assertIs(self.db.for_message(message_id), self.bart)
+        self.assertEqual(self.count(self.homer, 'message'), 0)
+        res = self.client.get('/api/messages/', headers=auth_header('bart', '1234'))
+        self.assertEqual([m['id'] for m in res.get_json()], [message_id])
+        res = self.client.get(f'/api/messages/{message_id}/', headers=auth_header('homer', '1234'))
+        self.assertEqual(res.get_json()['content'], 'Hi Bart')
+        res = self.client.delete(f'/api/messages/{message_id}/',
+                                 headers=auth_header('homer', '1234'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.count(self.bart, 'message'), 0)
+
+    def test_sync(self):
+        """Tests that each shard logs the changes of its own users only."""
+        res = self.client.get('/api/sync/', headers=auth_header('bart', '1234'))
+        self.assertEqual([(c['type'], c['id']) for c in res.get_json()['changes']],
+                         [('project', 3), ('task', 6), ('task', 7), ('task', 8)])
+        self.assertEqual(self.count(self.homer, 'change_log'), 7)
+        self.assertEqual(self.count(self.db.catalog, 'change_log'), 0)
+
+    def test_register(self):
+        """Tests that new users are kept in the catalog."""
+        res = self.client.post('/api/user/register/', json={
+            'name': 'Lisa', 'email': 'lisa@simpsons.org', 'username': 'lisa', 'password': 'sax'})
+        self.assertEqual(res.status_code, 201)
+        res = self.client.post('/api/projects/', json={'title': 'Jazz'},
+                               headers=auth_header('lisa', 'sax'))
+        self.assertEqual(res.status_code, 201)
+        with self.db.catalog.connection():
+            lisa = self.db.catalog.execute_query(
+                'SELECT id FROM user WHERE username=?', ('lisa',)).fetchone()['id']
+        self.assertEqual(self.count(self.db.for_user(lisa), 'project', 'title=?', ('Jazz',)), 1)
+
+    def test_recreate_restores_split(self):
+        """Tests that recreating restores each shard's own data."""
+        with self.db.for_user(1).connection():
+            self.db.for_user(1).execute_update('DELETE FROM project')
+        self.db.recreate()
+        self.assertEqual(self.count(self.homer, 'project'), 2)
+        self.assertEqual(self.count(self.bart, 'project'), 1)
+        self.assertEqual(self.count(self.db.catalog, 'project'), 0)
+
+    def test_unrouted_statement(self):
+        """Tests that statements need a routed shard."""
+        with self.assertRaises(RuntimeError):
+            self.db.execute_query('SELECT * FROM project')
+
+
 if __name__ == '__main__':
     unittest.main()